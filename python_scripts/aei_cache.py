@@ -0,0 +1,199 @@
+"""Binary sidecar cache for parsed Mercury outputs."""
+
+# internal modules
+import os
+import json
+import hashlib
+
+# external modules
+import numpy as np
+
+# relative modules
+from aei_reader import read_aei
+
+# global attributes
+__all__ = ('test', 'load_aei', 'file_identity', 'evict')
+__doc__ = """Memory-mappable cache of parsed .aei files.
+
+The first parse of an .aei file stores the (cols, rows) array as a .npy
+file and the header plus the identity of the source (size, mtime and a hash
+of its first and last blocks) as a .json file. Later reads memory-map the
+.npy as long as the identity still matches, otherwise the source is parsed
+again and the entry rewritten. evict keeps the cache directory under a size
+limit by dropping the least recently used entries. A cache that cannot be
+created or written (read only results) is skipped, the file is just
+parsed."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__cache_name__ = '.aei_cache'
+__hash_block__ = 2 ** 20
+
+
+def file_identity(fname):
+    """Return the size, mtime and edge hash of a file."""
+    st = os.stat(fname)
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        h.update(f.read(__hash_block__))
+        if st.st_size > __hash_block__:
+            f.seek(max(__hash_block__, st.st_size - __hash_block__))
+            h.update(f.read(__hash_block__))
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns,
+            'hash': h.hexdigest()}
+
+
+def _entry(fname, cache_dir=None):
+    """Return the (npy, json) paths of the cache entry for fname."""
+    fname = os.path.realpath(fname)
+    src_dir, base = os.path.split(fname)
+    if cache_dir is None:
+        cache_dir = os.path.join(src_dir, __cache_name__)
+    else:
+        # one shared directory for many sims, keep the names unique
+        base = hashlib.sha1(fname.encode()).hexdigest()[:12] + '_' + base
+    stem = os.path.join(cache_dir, base)
+    return f'{stem}.npy', f'{stem}.json'
+
+
+def _valid(meta, ident):
+    """Compare a stored entry against the current source identity."""
+    return meta.get('source') == ident
+
+
+def _store(npy, js, data, meta):
+    """Write a cache entry, each file replaced atomically."""
+    os.makedirs(os.path.dirname(npy), exist_ok=True)
+    for fname, write in ((npy, lambda f: np.save(f, data)),
+                         (js, lambda f: f.write(json.dumps(meta).encode()))):
+        tmp = f'{fname}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                write(f)
+            os.replace(tmp, fname)
+        finally:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+
+def load_aei(fname, cache_dir=None, max_bytes=None, usecols=None, **kwargs):
+    """Return (header, data) for an .aei file, going through the cache.
+
+    data is a read only memmap of the full (cols, rows) array, or a copy of
+    the selected rows when usecols is given. Extra keyword arguments are
+    passed through to read_aei on a cache miss.
+    """
+    npy, js = _entry(fname, cache_dir)
+    ident = file_identity(fname)
+    meta = None
+    if os.path.isfile(npy) and os.path.isfile(js):
+        try:
+            with open(js, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+    if meta is not None and _valid(meta, ident):
+        try:
+            os.utime(js)
+        except OSError:
+            # read only cache, the entry is still good
+            pass
+        data = np.load(npy, mmap_mode='r')
+    else:
+        header, data = read_aei(fname, **kwargs)
+        meta = {'source': ident, 'header': header,
+                'shape': list(data.shape)}
+        try:
+            _store(npy, js, data, meta)
+            if max_bytes is not None:
+                evict(os.path.dirname(npy), max_bytes, keep=(npy,))
+            data = np.load(npy, mmap_mode='r')
+        except OSError as e:
+            print(f'Not caching <{fname}>: {e}')
+    if usecols is not None:
+        data = np.asarray(data[usecols, :])
+    return meta['header'], data
+
+
+def evict(cache_dir, max_bytes, keep=()):
+    """Drop least recently used entries until cache_dir fits in max_bytes."""
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy'):
+            continue
+        npy = os.path.join(cache_dir, name)
+        js = npy[:-4] + '.json'
+        size = os.path.getsize(npy)
+        if os.path.isfile(js):
+            size += os.path.getsize(js)
+            used = os.path.getmtime(js)
+        else:
+            used = 0.
+        entries.append((used, size, npy, js))
+        total += size
+    entries.sort()
+    removed = []
+    for used, size, npy, js in entries:
+        if total <= max_bytes:
+            break
+        if npy in keep:
+            continue
+        for x in (js, npy):
+            if os.path.isfile(x):
+                os.remove(x)
+        total -= size
+        removed.append(npy)
+    return removed
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    import time
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'TESTP.aei')
+
+    def write(n):
+        with open(fname, 'w') as f:
+            f.write('\n' + ' ' * 30 + 'TESTP\n\n   Time (years)   x\n')
+            for i in range(n):
+                f.write(f' {i}.0D+00  {i}.5D+00\n')
+
+    write(3)
+    header, data = load_aei(fname)
+    assert isinstance(data, np.memmap) and data.shape == (2, 3)
+    assert header == ['Time(years)', 'x']
+    time.sleep(0.01)
+    write(4)
+    header, data = load_aei(fname)
+    assert data.shape == (2, 4)
+    cache_dir = os.path.join(tmpdir, __cache_name__)
+    assert evict(cache_dir, 0) != []
+    assert os.listdir(cache_dir) == []
+    # a results directory the cache cannot be written to is only read
+    ro = os.path.join(tmpdir, 'ro')
+    os.mkdir(ro)
+    fname = os.path.join(ro, 'TESTP.aei')
+    write(5)
+    # a plain file in the way fails even for root, unlike the mode bits
+    open(os.path.join(ro, __cache_name__), 'w').close()
+    os.chmod(ro, 0o555)
+    try:
+        header, data = load_aei(fname)
+        assert data.shape == (2, 5) and not isinstance(data, np.memmap)
+        assert sorted(os.listdir(ro)) == [__cache_name__, 'TESTP.aei']
+    finally:
+        os.chmod(ro, 0o755)
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,257 @@
+"""Chunked reader for Mercury .aei output files."""
+
+# internal modules
+import os
+import re
+import warnings
+from itertools import islice
+
+# external modules
+import numpy as np
+
+# relative modules
+import instrument
+
+# global attributes
+__all__ = ('test', 'read_aei', 'iter_aei_chunks', 'tail_aei',
+           'resolve_header')
+__doc__ = """Parse element6 .aei files straight into float64 arrays.
+
+The file is read in binary, a bounded number of lines at a time, and each
+block is handed to numpy's C parser in one call. The Fortran `D` exponent is
+rewritten to `E` before parsing. The returned data is laid out as
+(columns, rows), matching the old find_jacobi._list_array output."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+# element6 writes '(/,30x,a25,//,a)' before the data, so the column header
+# is normally the 4th line; allow for some junk ahead of it
+__max_header__ = 64
+__chunk_lines__ = 2 ** 16
+
+# Fortran drops the `E` for three digit exponents, eg. 1.234567-100
+_bare_exponent = re.compile(rb'(?<=[0-9.])([+-][0-9]{3})(?![0-9])')
+
+
+def resolve_header(ite):
+    """Merge unit tokens like '(years)' into the previous column name."""
+    _return = []
+    for i, x in enumerate(ite):
+        if ('(' in x) and (')' in x) and _return:
+            _return[-1] = _return[-1] + x
+        else:
+            _return.append(x)
+    return _return
+
+
+def _parse_block(lines, ncols):
+    """Parse a list of raw row lines into a (rows, ncols) array."""
+    lines = [x for x in lines if x.strip()]
+    if not lines:
+        return np.empty((0, ncols), dtype=np.float64)
+    block = b''.join(lines).replace(b'D', b'E').replace(b'd', b'e')
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            vals = np.fromstring(block, dtype=np.float64, sep=' ')
+    except ValueError:
+        vals = np.empty(0)
+    if vals.shape[0] != len(lines) * ncols:
+        # numpy stops at the first token it can't read, fall back to
+        # patching the bare exponents and splitting the tokens out
+        block = _bare_exponent.sub(rb'E\1', block)
+        vals = np.array(block.split(), dtype=np.float64)
+        if vals.shape[0] != len(lines) * ncols:
+            raise ValueError(f'Ragged rows found, expected {ncols} columns')
+    return vals.reshape(-1, ncols)
+
+
+def _count_lines(f, blocksize=2 ** 24):
+    """Count newlines from the current offset without decoding."""
+    count = 0
+    last = b''
+    while True:
+        buf = f.read(blocksize)
+        if not buf:
+            break
+        count += buf.count(b'\n')
+        last = buf
+    if last and not last.endswith(b'\n'):
+        count += 1
+    return count
+
+
+def _is_row(line):
+    """Check whether a raw line is a row of Fortran floats."""
+    tokens = _bare_exponent.sub(rb'E\1', line.replace(b'D', b'E')).split()
+    if not tokens:
+        return False
+    try:
+        for x in tokens:
+            float(x)
+    except ValueError:
+        return False
+    return True
+
+
+def _open_aei(f, max_header=__max_header__):
+    """Consume the header lines, return (header, ncols, first data line).
+
+    The data start is the first line that parses as a row of floats and the
+    header is the last non-blank line before it. Header bytes that aren't
+    valid utf-8 are dropped instead of failing the read, so a damaged
+    preamble never needs the file itself to be edited.
+    """
+    header = None
+    for i in range(max_header):
+        line = f.readline()
+        if not line:
+            break
+        if _is_row(line):
+            return header, len(line.split()), line
+        text = line.decode('utf-8', errors='ignore')
+        text = ''.join(x for x in text if x.isprintable())
+        if text.strip():
+            header = text.split()
+    return header, 0, b''
+
+
+def iter_aei_chunks(fname, usecols=None, chunk_lines=__chunk_lines__):
+    """Yield (rows, cols) float64 blocks of at most chunk_lines rows.
+
+    The first item yielded is the resolved header list.
+    """
+    with open(fname, 'rb') as f:
+        header, ncols, first = _open_aei(f)
+        yield resolve_header(header) if header else header
+        if ncols == 0:
+            return
+        pending = [first]
+        while True:
+            pending.extend(islice(f, chunk_lines - len(pending)))
+            if not pending:
+                break
+            block = _parse_block(pending, ncols)
+            pending = []
+            if usecols is not None:
+                block = block[:, usecols]
+            yield block
+
+
+def read_aei(fname, usecols=None, chunk_lines=__chunk_lines__,
+             dtype=np.float64):
+    """Read an .aei file into (header, data) with data as (cols, rows).
+
+    usecols selects a subset of the columns (by index) so only those are
+    kept in memory. The output array is allocated once from a newline count
+    and filled chunk by chunk, so peak memory is about the final array plus
+    one chunk.
+    """
+    with open(fname, 'rb') as f:
+        _, ncols, first = _open_aei(f)
+        offset = f.tell() - len(first)
+        f.seek(offset)
+        nrows = _count_lines(f)
+    if usecols is not None:
+        usecols = np.atleast_1d(np.asarray(usecols, dtype=np.intp))
+        ncols = usecols.shape[0]
+    chunks = iter_aei_chunks(fname, usecols, chunk_lines)
+    header = chunks.__next__()
+    data = np.empty((ncols, nrows), dtype=dtype)
+    filled = 0
+    with instrument.span('aei.parse'):
+        for block in chunks:
+            n = block.shape[0]
+            data[:, filled:filled + n] = block.T
+            filled += n
+    instrument.count('aei.bytes_parsed', os.path.getsize(fname))
+    instrument.count('aei.rows_parsed', filled)
+    if filled != nrows:
+        # blank trailing lines are counted but never parsed
+        data = data[:, :filled].copy()
+    return header, data
+
+
+def tail_aei(fname, offset=0, max_bytes=None):
+    """Parse only the complete rows written after a byte offset.
+
+    Returns (header, data, row_ends) where data is (cols, rows) and
+    row_ends holds the byte offset just past each parsed row, so a caller
+    can checkpoint after any number of them. header is only filled in when
+    starting from the top of the file. A trailing line without a newline is
+    still being written and is left for the next call.
+    """
+    header = None
+    with open(fname, 'rb') as f:
+        if offset == 0:
+            header, ncols, first = _open_aei(f)
+            if ncols == 0:
+                return resolve_header(header) if header else header, \
+                    np.empty((0, 0)), np.empty(0, dtype=np.int64)
+            offset = f.tell() - len(first)
+            header = resolve_header(header) if header else header
+        f.seek(offset)
+        raw = f.read() if max_bytes is None else f.read(max_bytes)
+    raw = raw[:raw.rfind(b'\n') + 1]
+    instrument.count('aei.bytes_parsed', len(raw))
+    lines = raw.splitlines(keepends=True)
+    if not lines:
+        return header, np.empty((0, 0)), np.empty(0, dtype=np.int64)
+    ends = offset + np.cumsum([len(x) for x in lines], dtype=np.int64)
+    rows = [i for i, x in enumerate(lines) if x.strip()]
+    if not rows:
+        return header, np.empty((0, 0)), ends[-1:]
+    row_ends = ends[rows]
+    # trailing blank lines only move the offset along
+    row_ends[-1] = ends[-1]
+    block = _parse_block(lines, len(lines[rows[0]].split()))
+    return header, np.ascontiguousarray(block.T), row_ends
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    rows = ' 0.0D+00  1.5D+00 -2.0E-01\n 1.0D+00  2.5D+00 -3.0-100\n'
+    with tempfile.NamedTemporaryFile('w', suffix='.aei',
+                                     delete=False) as f:
+        f.write('\n' + ' ' * 30 + 'TESTP\n\n')
+        f.write('   Time (years)   x   y\n' + rows)
+    header, data = read_aei(f.name, chunk_lines=1)
+    os.remove(f.name)
+    assert header == ['Time(years)', 'x', 'y']
+    assert data.shape == (3, 2)
+    assert data[2, 1] == -3.0e-100
+    with tempfile.NamedTemporaryFile('wb', suffix='.aei',
+                                     delete=False) as f:
+        f.write(b'\xff\xfe\x00junk\n\n' + b' ' * 30 + b'TESTP\n\n')
+        f.write(b'   Time (years) \xe9  x   y\n' + rows.encode())
+    before = os.path.getsize(f.name)
+    header, data = read_aei(f.name)
+    assert os.path.getsize(f.name) == before
+    os.remove(f.name)
+    assert header == ['Time(years)', 'x', 'y']
+    assert data.shape == (3, 2)
+    with tempfile.NamedTemporaryFile('w', suffix='.aei',
+                                     delete=False) as f:
+        f.write('\n' + ' ' * 30 + 'TESTP\n\n   Time (years)   x   y\n')
+        f.write(rows + ' 2.0D+00  3.5')
+    header, data, ends = tail_aei(f.name)
+    assert header == ['Time(years)', 'x', 'y'] and data.shape == (3, 2)
+    with open(f.name, 'a') as g:
+        g.write('D+00 -4.0E-01\n')
+    header, data, ends = tail_aei(f.name, ends[-1])
+    assert ends[-1] == os.path.getsize(f.name)
+    os.remove(f.name)
+    assert header is None and data.shape == (3, 1) and data[1, 0] == 3.5
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,500 @@
+"""Asyncio pipeline that generates, renders, submits and tracks sims."""
+
+# internal modules
+import os
+import re
+import asyncio
+import itertools
+import signal
+from asyncio.subprocess import PIPE
+
+# external modules
+import numpy as np
+
+# relative modules
+import instrument
+import job_status
+from param_sampling import sample_each, block_size
+from stability import screen
+
+# global attributes
+__all__ = ('test', 'Pipeline', 'run')
+__doc__ = """generate -> render -> submit -> track
+
+generate draws the parameters of generate_batch sims at a time (out of
+the param_sampling blocks of the sweep seed, as construct_jobs), render
+writes the sim directories in worker threads, submit calls sbatch as an
+async subprocess and track runs one squeue every status_ttl seconds. The
+stages are joined by bounded queues and each has its own concurrency limit.
+Submission also waits while max_pending of our jobs are pending in the
+cluster queue, the tracker wakes the submitters after every poll so nothing
+spins. With cfg.screen_sims every batch goes through stability.screen
+first, sims it decides are recorded as skipped and never rendered.
+SIGINT/SIGTERM stop generation, queued sims are dropped (they are
+already in the restart script) and the run returns what was submitted."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+
+class Pipeline(object):
+    """One sweep driven from a single event loop.
+
+    render(cfg, modelnum, params) writes a sim and returns the path of its
+    slurm script, it runs in a worker thread. params are drawn from the
+    sweep seed cfg.seed (fresh entropy when None) and carry the seed record
+    of the sim. numbers
+    are the sim numbers to generate (default all of cfg.num_simulations).
+    With a job_ledger Ledger every state change is recorded, resume takes
+    its incomplete() rows: generated or failed sims are resubmitted,
+    submitted or running ones are first looked up in squeue and sacct,
+    still queued jobs are tracked again, completed ones recorded finished
+    and failed ones resubmitted. wait (cfg.track_jobs, default True) keeps
+    tracking after submission until every job left the queue, so the
+    ledger ends with each sim finished or failed.
+    """
+
+    def __init__(self, cfg, render, sbatch='sbatch', squeue='squeue',
+                 wait=None, retries=5, ledger=None, numbers=None,
+                 resume=(), sacct='sacct'):
+        """Read the stage limits from the configuration."""
+        self.cfg = cfg
+        self.render = render
+        self.sbatch = sbatch
+        self.squeue = squeue
+        self.wait = getattr(cfg, 'track_jobs', True) if wait is None \
+            else wait
+        self.retries = retries
+        self.ledger = ledger
+        self.numbers = numbers
+        self.resume = resume
+        self.sacct = sacct
+        self.render_workers = max(1, getattr(cfg, 'render_workers', 1))
+        self.submit_workers = max(1, getattr(cfg, 'submit_workers', 4))
+        self.max_pending = getattr(cfg, 'max_pending', 0)
+        self.batch = max(1, getattr(cfg, 'generate_batch', 256))
+        self.interval = getattr(cfg, 'status_ttl', job_status.__ttl__)
+        self.seed = np.random.SeedSequence(getattr(cfg, 'seed', None))
+        self.blocks = {}  # sample blocks drawn for the current batch
+        self.jobs = {}  # job id -> modelnum
+        self.sims = {}  # job id -> sim number
+        self.running = set()
+        self.outstanding = set()
+        self.finished = set()
+        self.skipped = {}  # sim number -> screen tag
+        self.screen = getattr(cfg, 'screen_sims', False)
+        self.polls = 0
+        self._queued = 0  # pending in the last squeue snapshot
+        self._reserved = 0  # slots taken by sbatch calls in flight
+        self._unseen = set()  # job ids submitted since that snapshot
+
+    def _pending(self):
+        """Our jobs believed to be pending right now."""
+        return self._queued + self._reserved + len(self._unseen)
+
+    def shutdown(self):
+        """Stop generating, drain and return."""
+        if not self.stop.is_set():
+            print('Stopping, no new sims will be submitted')
+        self.stop.set()
+        self.submitted.set()
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        """Wake everything waiting on the queue state."""
+        async with self.cond:
+            self.cond.notify_all()
+
+    def _record(self, sim, state, **kwargs):
+        """Record a state change when a ledger is attached."""
+        if self.ledger is not None:
+            self.ledger.record(self.cfg.time, sim, state, **kwargs)
+
+    async def generate(self, out):
+        """Sample sims in batches and feed the render stage."""
+        numbers = self.numbers
+        if numbers is None:
+            total = self.cfg.num_simulations
+            numbers = itertools.count() if total == -1 else range(total)
+        numbers = iter(numbers)
+        while not self.stop.is_set():
+            chunk = list(itertools.islice(numbers, self.batch))
+            if not chunk:
+                break
+            # sims come out of their sample blocks whatever the batch
+            # boundaries, a block spanning two batches is drawn once
+            size = block_size(self.cfg)
+            self.blocks = {k: v for k, v in self.blocks.items()
+                           if k >= min(chunk) // size}
+            with instrument.span('submit.sample', sims=len(chunk)):
+                sims, bodies, drawn = sample_each(self.cfg, chunk,
+                                                  self.seed, self.blocks)
+            rows = None
+            if self.screen:
+                with instrument.span('submit.screen', sims=len(chunk)):
+                    rows = screen(self.cfg, sims, bodies)
+            for i, n in enumerate(chunk):
+                if self.stop.is_set():
+                    break
+                params = drawn[n]
+                if rows is not None and rows[i]['tag'] != 'run':
+                    self.skipped[n] = str(rows[i]['tag'])
+                    self._record(n, 'skipped', params=dict(
+                        params, screen=self.skipped[n],
+                        reason=str(rows[i]['reason'])))
+                    continue
+                await out.put((n, params))
+        for _ in range(self.render_workers):
+            await out.put(None)
+
+    async def feed_resume(self, out):
+        """Queue the unfinished sims of a resumed sweep.
+
+        Jobs the ledger lists as submitted or running are reconciled with
+        squeue and sacct before anything is resubmitted.
+        """
+        live = {x[3] for x in self.resume
+                if x[4] in ('submitted', 'running') and x[3]}
+        gone, final = set(), {}
+        if live:
+            states = await self._poll()
+            if states is not None:
+                gone = live - {x.split('_')[0] for x in states}
+            if gone:
+                final = await self._accounting(gone)
+        for n, modelnum, directory, job, state in self.resume:
+            if self.stop.is_set():
+                break
+            if job in live:
+                self.jobs[job] = modelnum
+                self.sims[job] = n
+            if job in live and job not in gone:
+                self.outstanding.add(job)
+            elif job in live and final.get(job, 'COMPLETED') == 'COMPLETED':
+                # without accounting, leaving the queue counts as done
+                self.finished.add(job)
+                self._record(n, 'finished')
+            elif directory:
+                if job in live:
+                    print(f'Job {job} of {modelnum} ended {final[job]}, '
+                          'resubmitting')
+                    self._record(n, 'failed')
+                await out.put((n, modelnum, f'{directory}/slurm.sh'))
+
+    async def render_worker(self, inp, out):
+        """Write sim directories in a thread, one at a time per worker."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await inp.get()
+            if item is None:
+                break
+            if self.stop.is_set():
+                continue
+            n, params = item
+            modelnum = f'{self.cfg.time}-{n}'
+            print(f'Working on {n + 1}')
+            with instrument.span('submit.render'):
+                script = await loop.run_in_executor(
+                    None, self.render, self.cfg, modelnum, params)
+            self._record(n, 'generated', modelnum=modelnum,
+                         directory=os.path.dirname(script), params=params)
+            await out.put((n, modelnum, script))
+
+    async def _room(self):
+        """Wait until a job may be submitted, reserve its pending slot."""
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.stop.is_set() or not self.max_pending or
+                self._pending() < self.max_pending)
+            if self.stop.is_set():
+                return False
+            self._reserved += 1
+            return True
+
+    async def _sbatch(self, script):
+        """Submit one script, returns the job id or None."""
+        for i in range(self.retries):
+            with instrument.span('submit.sbatch'):
+                proc = await asyncio.create_subprocess_exec(
+                    self.sbatch, '--parsable', script, stdout=PIPE,
+                    stderr=PIPE)
+                out, err = await proc.communicate()
+            # --parsable prints <jobid>[;cluster]
+            match = re.match(r'\s*(\d+)', out.decode('utf-8'))
+            if proc.returncode == 0 and match:
+                return match.group(1)
+            print(f'sbatch failed for {script}:',
+                  err.decode('utf-8').strip())
+            instrument.count('submit.sbatch_retries')
+            if self.stop.is_set():
+                break
+            await asyncio.sleep(2 ** i)
+        return None
+
+    async def submit_worker(self, inp):
+        """Submit rendered sims, respecting the pending limit."""
+        while True:
+            item = await inp.get()
+            if item is None:
+                break
+            n, modelnum, script = item
+            with instrument.span('submit.wait_pending'):
+                room = await self._room()
+            if not room:
+                continue
+            job = await self._sbatch(script)
+            async with self.cond:
+                # the reservation becomes a job the next snapshot sees
+                self._reserved = max(0, self._reserved - 1)
+                if job is not None:
+                    self._unseen.add(job)
+                self.cond.notify_all()
+            if job is None:
+                print('Timeout occured')
+                continue
+            print(f'Submitted Job {modelnum} ID: {job}...script: <{script}>')
+            self.jobs[job] = modelnum
+            self.sims[job] = n
+            self.outstanding.add(job)
+            self._record(n, 'submitted', job_id=job)
+
+    async def _poll(self):
+        """One async squeue, returns {job id: state} or None."""
+        with instrument.span('submit.squeue'):
+            proc = await asyncio.create_subprocess_exec(
+                self.squeue, '-h', '-u', job_status.username(), '-o',
+                '%i|%T', stdout=PIPE, stderr=PIPE)
+            out, err = await proc.communicate()
+        self.polls += 1
+        if proc.returncode != 0:
+            print('squeue failed:', err.decode('utf-8').strip())
+            return None
+        return job_status._parse(out.decode('utf-8'))
+
+    async def _accounting(self, jobs):
+        """Final states of jobs that left the queue, {} without sacct."""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                self.sacct, '-n', '-X', '-P', '-j', ','.join(sorted(jobs)),
+                '-o', 'JobID,State', stdout=PIPE, stderr=PIPE)
+        except OSError:
+            return {}
+        out, err = await proc.communicate()
+        if proc.returncode != 0:
+            return {}
+        return job_status._parse(out.decode('utf-8'))
+
+    async def track(self):
+        """Poll the queue once per interval while there is work."""
+        while not self.stop.is_set() and (
+                not self.submitted.is_set() or
+                (self.wait and self.outstanding)):
+            # jobs submitted before the poll starts are in its snapshot
+            unseen, known = set(self._unseen), set(self.outstanding)
+            gone = ()
+            states = await self._poll()
+            async with self.cond:
+                if states is not None:
+                    parents = {x.split('_')[0] for x in states}
+                    self._queued = sum(1 for x in states.values()
+                                       if x == 'PENDING')
+                    self._unseen -= unseen
+                    for job in known & set(states):
+                        if states[job] == 'RUNNING' and \
+                                job not in self.running:
+                            self.running.add(job)
+                            self._record(self.sims[job], 'running')
+                    gone = known - parents
+                    for job in gone:
+                        print('Job finished:', job)
+                        self.outstanding.discard(job)
+                        self.finished.add(job)
+                self.cond.notify_all()
+            if states is not None and gone and self.ledger is not None:
+                final = await self._accounting(gone)
+                for job in gone:
+                    # without accounting, leaving the queue counts as done
+                    ok = final.get(job, 'COMPLETED') == 'COMPLETED'
+                    self._record(self.sims[job],
+                                 'finished' if ok else 'failed')
+            if self.ledger is not None:
+                self.ledger.flush()
+            if self.submitted.is_set():
+                if not (self.wait and self.outstanding):
+                    break
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                # the end of submission is polled at once
+                await asyncio.wait_for(self.submitted.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """Run every stage to completion, returns {job id: modelnum}."""
+        self.stop = asyncio.Event()
+        self.submitted = asyncio.Event()
+        self.cond = asyncio.Condition()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.shutdown)
+            except (NotImplementedError, RuntimeError):
+                pass
+        to_render = asyncio.Queue(maxsize=self.batch)
+        to_submit = asyncio.Queue(maxsize=2 * self.submit_workers)
+
+        async def render_stage():
+            await self.feed_resume(to_submit)
+            await asyncio.gather(*[self.render_worker(to_render, to_submit)
+                                   for _ in range(self.render_workers)])
+            for _ in range(self.submit_workers):
+                await to_submit.put(None)
+
+        async def submit_stage():
+            await asyncio.gather(*[self.submit_worker(to_submit)
+                                   for _ in range(self.submit_workers)])
+            self.submitted.set()
+
+        tracker = asyncio.ensure_future(self.track())
+        try:
+            await asyncio.gather(self.generate(to_render), render_stage(),
+                                 submit_stage())
+            await tracker
+        finally:
+            tracker.cancel()
+            if self.ledger is not None:
+                self.ledger.flush()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
+        return self.jobs
+
+
+def run(cfg, render, **kwargs):
+    """Drive a whole sweep, see Pipeline for the arguments."""
+    return asyncio.run(Pipeline(cfg, render, **kwargs).run())
+
+
+def test():
+    """Testing function for module."""
+    import types
+    import tempfile
+    import job_ledger
+    from param_sampling import sample_each
+    tmpdir = tempfile.mkdtemp()
+    # fake sbatch answers sim number + 1 as job id, fake squeue shows
+    # every job above 2 * (number of polls) as pending
+    with open(f'{tmpdir}/sbatch', 'w') as f:
+        f.write('#!/bin/sh\necho "$@" >> "{0}/calls"\n'
+                'n=$(basename $(dirname "$2"))\n'
+                'echo "$((${{n#sim*-}} + 1));cluster"\n'.format(tmpdir))
+    with open(f'{tmpdir}/squeue', 'w') as f:
+        f.write('#!/bin/sh\necho x >> "{0}/polls"\n'
+                'p=$(wc -l < "{0}/polls")\n'
+                'n=$(cat "{0}/calls" 2>/dev/null | wc -l)\n'
+                'i=$((2 * p + 1))\n'
+                'while [ $i -le $n ]; do echo "$i|PENDING"; '
+                'i=$((i + 1)); done\n'.format(tmpdir))
+    for x in ('sbatch', 'squeue'):
+        os.chmod(f'{tmpdir}/{x}', 0o755)
+    cfg = types.SimpleNamespace(
+        time='0', num_simulations=10, generate_batch=4, sample_block=3,
+        render_workers=2,
+        submit_workers=3, max_pending=3, status_ttl=0.01,
+        central_l_mass=1., central_u_mass=1., binary_l_mass=.5,
+        binary_u_mass=1., binary_l_sma=5, binary_u_sma=10, binary_l_ecc=0.,
+        binary_u_ecc=.1, binary_l_inc=0, binary_u_inc=90, num_bodies_l=1,
+        num_bodies_u=3, bodies_l_mass=.001, bodies_u_mass=.1,
+        bodies_l_density=5.43, bodies_u_density=5.43, avg_dist=100,
+        lower_smajora=5, upper_smajora=8, lower_ecc=0., upper_ecc=.1,
+        lower_inc=0, upper_inc=90)
+
+    def render(cfg, modelnum, params):
+        assert params['num_bodies'] == len(params['orbitals'])
+        # the seed record (pickled with the sim) reproduces it
+        seed = params['seed']
+        n = seed['block'] * seed['block_size'] + seed['offset']
+        assert modelnum.endswith(f'-{n}')
+        again = sample_each(cfg, [n], seed['entropy'])[2][n]
+        assert np.array_equal(again['mass_bodies'], params['mass_bodies'])
+        assert np.array_equal(again['testp'], params['testp'])
+        return f'{tmpdir}/sim{modelnum}/slurm.sh'
+
+    ledger = job_ledger.Ledger(f'{tmpdir}/ledger.sqlite')
+    ledger.start(cfg.time, cfg.num_simulations)
+    pipe = Pipeline(cfg, render, sbatch=f'{tmpdir}/sbatch',
+                    squeue=f'{tmpdir}/squeue', wait=True, ledger=ledger,
+                    sacct=f'{tmpdir}/no_sacct')
+    jobs = asyncio.run(pipe.run())
+    assert sorted(jobs.values()) == sorted(f'0-{i}' for i in range(10))
+    assert not pipe.outstanding and len(pipe.finished) == 10
+    # the pending limit made submission wait on the tracker
+    assert pipe.polls >= 3
+    assert ledger.counts('0') == {'finished': 10}
+    assert pipe._reserved == 0 and pipe._pending() >= 0
+
+    # a refused sbatch gives its pending slot back exactly once
+    with open(f'{tmpdir}/sbatch_fail', 'w') as f:
+        f.write('#!/bin/sh\ncase "$2" in */sim2-2/*) exit 1;; esac\n'
+                'exec "{0}/sbatch" "$@"\n'.format(tmpdir))
+    os.chmod(f'{tmpdir}/sbatch_fail', 0o755)
+    pipe = Pipeline(types.SimpleNamespace(**dict(vars(cfg), time='2',
+                                                  num_simulations=4)),
+                    render, sbatch=f'{tmpdir}/sbatch_fail',
+                    squeue=f'{tmpdir}/squeue', wait=True, retries=1,
+                    sacct=f'{tmpdir}/no_sacct')
+    jobs = asyncio.run(pipe.run())
+    assert sorted(jobs.values()) == ['2-0', '2-1', '2-3']
+    assert pipe._reserved == 0 and not pipe._unseen - set(jobs)
+
+    # resume: sim 3 failed, sim 7 was never generated, the jobs of sims
+    # 4 and 5 left the queue while nothing tracked them
+    with open(f'{tmpdir}/sacct', 'w') as f:
+        # job 5 failed, its resubmission (same fake id) completes
+        f.write('#!/bin/sh\n[ -e "{0}/acct" ] || echo "5|FAILED"\n'
+                'touch "{0}/acct"\necho "6|COMPLETED"\n'.format(tmpdir))
+    os.chmod(f'{tmpdir}/sacct', 0o755)
+    ledger.record('0', 3, 'failed')
+    ledger.record('0', 4, 'submitted', directory=f'{tmpdir}/sim0-4',
+                  job_id=5)
+    ledger.record('0', 5, 'running', job_id=6)
+    ledger.db.execute('DELETE FROM sims WHERE sim = 7')
+    missing = set(range(10)) - ledger.known('0')
+    pipe = Pipeline(cfg, render, sbatch=f'{tmpdir}/sbatch',
+                    squeue=f'{tmpdir}/squeue', ledger=ledger,
+                    numbers=sorted(missing), resume=ledger.incomplete('0'),
+                    sacct=f'{tmpdir}/sacct')
+    jobs = asyncio.run(pipe.run())
+    assert sorted(set(jobs.values()) - {'0-5'}) == ['0-3', '0-4', '0-7']
+    assert '6' in pipe.finished
+    assert ledger.counts('0') == {'finished': 10}
+
+    # screened: bodies 100 AU apart with a wide binary are skip-stable
+    cfg = types.SimpleNamespace(**dict(vars(cfg), time='1', screen_sims=True,
+                                       binary_l_sma=1e3, binary_u_sma=2e3,
+                                       cluster_mass=0., cluster_radius=0.))
+    ledger.start(cfg.time, cfg.num_simulations)
+    pipe = Pipeline(cfg, render, sbatch=f'{tmpdir}/sbatch',
+                    squeue=f'{tmpdir}/squeue', wait=True, ledger=ledger,
+                    sacct=f'{tmpdir}/no_sacct')
+    jobs = asyncio.run(pipe.run())
+    assert len(pipe.skipped) + len(jobs) == 10 and pipe.skipped
+    assert ledger.counts('1')['skipped'] == len(pipe.skipped)
+    n = min(pipe.skipped)
+    assert ledger.params('1', n)['screen'] == pipe.skipped[n]
+    assert not {x[0] for x in ledger.incomplete('1')} & set(pipe.skipped)
+    ledger.close()
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
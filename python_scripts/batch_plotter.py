@@ -1,6 +1,7 @@
 """Batch plotting sequence."""
 
 # internal modules
+import os
 import threading
 import queue
 from glob import glob
@@ -9,12 +10,14 @@ import re
 # external modules
 from nkrpy.load import load_cfg
 from nkrpy.mercury.file_loader import parse_aei
-from nkrpy.miscmath import cross, dot, mag
 from nkrpy.mp import run_seq_command as run_command
 import matplotlib.pyplot as plt
 import numpy as np
 
 # relative modules
+import instrument
+from jacobi import jacobi_constant
+from ensemble_store import ingest, open_store, is_current
 
 # global attributes
 __all__ = ('test', 'main')
@@ -27,19 +30,11 @@ __max_queue__ = -1
 
 
 def find_jacobi(ob3, ob2):
-    """Given values, return jacobi constant."""
-    # https://farside.ph.utexas.edu/teaching/336k/Newtonhtml/node121.html
-    t, x, y, z, vx, vy, vz, mass3 = ob3
-    pe = -1. * mass3 / mag((x, y, z))
-    ke = 0.5 * mass3 * mag((vx, vy, vz)) ** 2
-    energy = pe + ke
-    angular_momentum = (x * vx, y * vy, z * vz)
-    t, x, y, z, vx, vy, vz, m2 = ob2
-    angular_velocity = cross((x, y, z), (vx, vy, vz)) / mag((x, y, z)) ** 2
-    # c = 2*(E-w*h)
-    # print(cross((x, y, z),(vx, vy, vz)))
-    # print(energy,angular_momentum,angular_velocity)
-    return 2. * (energy - dot(angular_momentum, angular_velocity))
+    """Given values, return jacobi constant.
+
+    Accepts (fields, steps) or stacked (sims, fields, steps) arrays.
+    """
+    return jacobi_constant(ob3, ob2)
 
 
 def get_data(file):
@@ -54,15 +49,30 @@ def get_sim_num(cfg, files):
 
 
 def gather_files(directory: str):
-    all_aei_files = glob(f'{directory}/*.aei')
+    all_aei_files = glob(f'{directory}/*/*.aei')
     all_params = glob(f'{directory}/*/param.in')
     all_big = glob(f'{directory}/*/big.in')
-    if len(all_files) == 0:
-        print('No aei files found.')
+    if len(all_params) == 0:
+        print('No sims found.')
         exit(1)
     return all_aei_files, all_params, all_big
 
 
+def load_store(cfg_p, cfg_j, rebuild=False):
+    """Open the ensemble store, ingesting again when the sims changed.
+
+    The store is rebuilt when sims were added or removed or their outputs
+    changed since it was built, or always with rebuild (cfg.store_rebuild).
+    """
+    store_dir = getattr(cfg_p, 'store_location',
+                        f'{cfg_p.file_location}/ensemble_store')
+    sims = sorted(set(os.path.dirname(x) for x in cfg_p.all_params))
+    rebuild = rebuild or getattr(cfg_p, 'store_rebuild', False)
+    if not rebuild and is_current(store_dir, sims):
+        return open_store(store_dir)
+    return ingest(sims, store_dir, cfg_j.naming_schema)
+
+
 def main(cfgname_plotter, cfgname_job):
     """Main caller function."""
     """
@@ -75,9 +85,17 @@ def main(cfgname_plotter, cfgname_job):
     """
     cfg_p = load_cfg(cfgname_plotter)
     cfg_j = load_cfg(cfgname_job)
-    cfg_p.all_aei_files, cfg_p.all_params, cfg_p.all_big = \
-        gather_files(cfg_p.file_location)
+    if getattr(cfg_p, 'trace', None):
+        print('Recording timings to', instrument.enable(cfg_p.trace))
+    with instrument.span('plotter.gather'):
+        cfg_p.all_aei_files, cfg_p.all_params, cfg_p.all_big = \
+            gather_files(cfg_p.file_location)
     cfg_p.sims = get_sim_num(cfg_j, cfg_p.all_params)
+    with instrument.span('plotter.load_store'):
+        cfg_p.store = load_store(cfg_p, cfg_j)
+    masterbinaries = cfg_p.store['binaries']
+    masterbody = cfg_p.store['bodies']
+    print('Binaries:', masterbinaries.shape, 'Bodies:', masterbody.shape)
 
     pass
 
@@ -137,7 +155,7 @@ def fill_queue(cfg, q):
         except queue.Full:
             print("Filler exiting, timeout/full")
             break
-        if (n >= cfg.):
+        if (n >= cfg.num_simulations):
             print(f'Queue filled: {n}')
             break
         sleep(0.01)
@@ -0,0 +1,432 @@
+"""Synthetic data benchmarks of the analysis and job construction paths."""
+
+# internal modules
+import os
+import io
+import sys
+import json
+import types
+import resource
+import subprocess
+import platform
+import shutil
+import tempfile
+import contextlib
+import multiprocessing
+from argparse import ArgumentParser as ap
+from time import perf_counter, time
+
+# external modules
+import numpy as np
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'write_aei', 'benchmarks', 'run', 'compare',
+           'over_budget')
+__doc__ = """Benchmark suite.
+
+Every benchmark runs in its own forked process on synthetic inputs that
+are generated once per scale under the work directory:
+    parse_aei         aei_reader.read_aei of an element6 .aei of R rows
+    parse_aei_cached  aei_cache.load_aei of the same file, warm cache
+    jacobi            jacobi.jacobi_constant of two (8, R) series
+    jacobi_plot       find_jacobi.plot_series of R samples to a PDF
+    construct         construct_jobs.construct_sweep of S sims
+    submit            submit_jobs.job_manager of S sims against a fake
+                      sbatch/squeue put first on PATH
+    startup_<command> N cold starts of cli.py --import-only <command>
+Only the call itself is timed, the setup is not. Each result holds the
+seconds, the items processed (rows, sims or starts), the throughput and the
+peak RSS of the benchmark process; startup results also hold the fastest
+start and its overhead over a bare `import numpy`, which every command
+needs and which alone costs ~0.1-0.2 s on the cluster nodes. Results are
+written as JSON; compare reads a stored baseline and reports every
+benchmark whose throughput dropped or whose peak RSS grew by more than the
+tolerance, over_budget every command starting slower than its budget
+(__startup_budget__, ms above the numpy floor) whatever the baseline."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__tolerance__ = 0.1
+_columns = ('Time (years)', 'x', 'y', 'z', 'u', 'v', 'w', 'mass')
+
+
+def write_aei(fname, rows, seed=0, chunk=2 ** 16):
+    """Write a synthetic element6 .aei file of rows rows, returns fname."""
+    rng = np.random.default_rng(seed)
+    with open(fname, 'wb') as f:
+        f.write(b'\n' + b' ' * 30 + b'TESTP\n\n')
+        f.write(('   ' + '   '.join(_columns) + '\n').encode())
+        for start in range(0, rows, chunk):
+            n = min(chunk, rows - start)
+            block = np.empty((n, len(_columns)))
+            block[:, 0] = np.arange(start, start + n) * 1e3
+            block[:, 1:4] = rng.normal(0., 10., (n, 3))
+            block[:, 4:7] = rng.normal(0., 1e-2, (n, 3))
+            block[:, 7] = 1e-3
+            buf = io.BytesIO()
+            np.savetxt(buf, block, fmt='%15.7E', delimiter='')
+            # element6 writes Fortran exponents
+            f.write(buf.getvalue().replace(b'E', b'D'))
+    return fname
+
+
+def _aei(workdir, rows):
+    """Synthetic .aei of rows rows, generated once per work directory."""
+    fname = os.path.join(workdir, f'synthetic_{rows}.aei')
+    if not os.path.isfile(fname):
+        write_aei(fname + '.part', rows)
+        os.replace(fname + '.part', fname)
+    return fname
+
+
+def _sweep_cfg(workdir, sims, name):
+    """configuration_jobsubmission pointed at a fresh destination.
+
+    The input templates are copied too, sims link their static inputs and
+    must not add links to the tracked template.
+    """
+    import configuration_jobsubmission
+    from construct_jobs import _cfg_dict, _cwd_
+    cfg = types.SimpleNamespace(**_cfg_dict(configuration_jobsubmission))
+    cfg.destination = tempfile.mkdtemp(dir=workdir)
+    template = f'{cfg.destination}/template'
+    shutil.copytree(os.path.join(_cwd_, cfg.parent_mercury_inputs), template,
+                    symlinks=True)
+    cfg.parent_mercury_inputs = template
+    cfg.naming_schema = name
+    cfg.num_simulations = sims
+    cfg.time = '0'
+    cfg.seed = 0
+    cfg.max_pending = 0
+    cfg.screen_sims = False
+    os.makedirs(f'{cfg.destination}/{name}')
+    # only the mercury binary has to exist, it is never run
+    open(f'{cfg.destination}/{name}/{cfg.program}', 'w').close()
+    return cfg
+
+
+def bench_parse_aei(workdir, rows):
+    """Parse a .aei without the cache."""
+    from aei_reader import read_aei
+    fname = _aei(workdir, rows)
+    begin = perf_counter()
+    read_aei(fname)
+    return perf_counter() - begin, rows
+
+
+def bench_parse_aei_cached(workdir, rows):
+    """Load a .aei through a warm .npy cache."""
+    from aei_cache import load_aei
+    fname = _aei(workdir, rows)
+    cache = os.path.join(workdir, 'cache')
+    load_aei(fname, cache_dir=cache)
+    begin = perf_counter()
+    load_aei(fname, cache_dir=cache)
+    return perf_counter() - begin, rows
+
+
+def bench_jacobi(workdir, rows):
+    """Jacobi constant of a test particle against a perturber."""
+    from jacobi import jacobi_constant
+    rng = np.random.default_rng(0)
+    ob3, ob2 = rng.normal(0., 10., (2, 8, rows))
+    ob3[7] = ob2[7] = 1e-3
+    begin = perf_counter()
+    jacobi_constant(ob3, ob2)
+    return perf_counter() - begin, rows
+
+
+def bench_jacobi_plot(workdir, rows):
+    """Decimated jacobi plot of a series to a PDF."""
+    import find_jacobi
+    E = 1. + 1e-6 * np.random.default_rng(0).normal(size=rows)
+    fname = os.path.join(workdir, f'jacobi_{rows}.pdf')
+    begin = perf_counter()
+    find_jacobi.plot_series(np.arange(rows), E, fname)
+    return perf_counter() - begin, rows
+
+
+def bench_construct(workdir, sims):
+    """Build sim directories in parallel processes."""
+    import construct_jobs
+    cfg = _sweep_cfg(workdir, sims, 'construct')
+    construct_jobs.prepare_destination(cfg)
+    jobnumbers = [(n, f'{cfg.time}-{n}') for n in range(sims)]
+    begin = perf_counter()
+    construct_jobs.construct_sweep(cfg, jobnumbers, cfg.seed)
+    return perf_counter() - begin, sims
+
+
+def bench_submit(workdir, sims):
+    """Generate, render and submit a sweep against a fake sbatch."""
+    import submit_jobs
+    cfg = _sweep_cfg(workdir, sims, 'submit')
+    bindir = tempfile.mkdtemp(dir=workdir)
+    # job id = sim number, squeue reports an empty queue
+    for name, text in (('sbatch', 'n=$(basename $(dirname "$2"))\n'
+                                  'echo "${n##*-}"'),
+                       ('squeue', 'exit 0')):
+        with open(f'{bindir}/{name}', 'w') as f:
+            f.write(f'#!/bin/sh\n{text}\n')
+        os.chmod(f'{bindir}/{name}', 0o755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = f'{bindir}:{path}'
+    try:
+        submit_jobs.construct_jobs.prepare_destination(cfg)
+        begin = perf_counter()
+        jobs = submit_jobs.job_manager(cfg)
+        seconds = perf_counter() - begin
+    finally:
+        os.environ['PATH'] = path
+    if len(jobs) != sims:
+        raise RuntimeError(f'submitted {len(jobs)} of {sims} sims')
+    return seconds, sims
+
+
+def _starts(argv, starts):
+    """Wall seconds of each of starts cold runs of argv."""
+    seconds = []
+    for _ in range(starts):
+        begin = perf_counter()
+        run = subprocess.run(argv, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, cwd=__path__ or None)
+        seconds.append(perf_counter() - begin)
+        if run.returncode != 0:
+            error = run.stderr.decode('utf-8').strip().splitlines()
+            raise RuntimeError(f'{" ".join(argv[1:])} failed: ' +
+                               (error[-1] if error else str(run.returncode)))
+    return seconds
+
+
+def bench_startup(command):
+    """Benchmark of the interpreter start and imports of a cli command."""
+    def bench(workdir, starts):
+        """Start the command with --import-only, against a numpy floor."""
+        floor = _starts([sys.executable, '-c', 'import numpy'], starts)
+        seconds = _starts([sys.executable, 'cli.py', '--import-only',
+                           command], starts)
+        return sum(seconds), starts, {
+            'startup_ms': 1e3 * min(seconds),
+            'overhead_ms': 1e3 * (min(seconds) - min(floor))}
+    bench.__doc__ = f'Cold start of cli.py {command}.'
+    return bench
+
+
+benchmarks = {'parse_aei': (bench_parse_aei, 'rows'),
+              'parse_aei_cached': (bench_parse_aei_cached, 'rows'),
+              'jacobi': (bench_jacobi, 'rows'),
+              'jacobi_plot': (bench_jacobi_plot, 'rows'),
+              'construct': (bench_construct, 'sims'),
+              'submit': (bench_submit, 'sims'),
+              'startup_construct': (bench_startup('construct'), 'starts'),
+              'startup_submit': (bench_startup('submit'), 'starts'),
+              'startup_post_process': (bench_startup('post-process'),
+                                       'starts'),
+              'startup_jacobi': (bench_startup('jacobi'), 'starts')}
+# import time above the numpy floor allowed per command, the jacobi
+# command plots and is left out
+__startup_budget__ = {'startup_construct': 100.,
+                      'startup_submit': 100.,
+                      'startup_post_process': 100.}
+
+
+def _child(conn, name, workdir, scale):
+    """Run one benchmark, send back (seconds, items, extra, peak rss kB)."""
+    try:
+        with open(os.devnull, 'w') as null, \
+                contextlib.redirect_stdout(null):
+            out = benchmarks[name][0](workdir, scale)
+        extra = out[2] if len(out) > 2 else {}
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send((out[0], out[1], extra, rss, None))
+    except BaseException as e:
+        conn.send((None, None, None, None, f'{type(e).__name__}: {e}'))
+    conn.close()
+
+
+def run_one(name, workdir, scale):
+    """Run a benchmark in a forked process, returns its result dict."""
+    ctx = multiprocessing.get_context('fork')
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(child, name, workdir, scale))
+    proc.start()
+    child.close()
+    try:
+        seconds, items, extra, rss, error = parent.recv()
+    except EOFError:
+        seconds, items, extra, rss, error = (None, None, None, None,
+                                             'benchmark died')
+    proc.join()
+    if error:
+        return {'error': error}
+    unit = benchmarks[name][1]
+    return dict(extra, seconds=seconds, items=items, unit=unit,
+                throughput=items / seconds if seconds > 0 else float('inf'),
+                peak_rss_mb=rss / 1024.)
+
+
+def run(names=None, rows=(10 ** 5,), sims=(100,), starts=(5,), workdir=None,
+        repeat=1):
+    """Run the benchmarks at every scale, returns the results document.
+
+    Row benchmarks run at each of rows, sim benchmarks at each of sims and
+    startup benchmarks at each of starts. With repeat, the fastest of the
+    runs is kept. A workdir created here is removed afterwards.
+    """
+    names = names or list(benchmarks)
+    if workdir is None:
+        workdir = tempfile.mkdtemp()
+        try:
+            return run(names, rows, sims, starts, workdir, repeat)
+        finally:
+            shutil.rmtree(workdir)
+    scales = {'rows': rows, 'sims': sims, 'starts': starts}
+    results = {}
+    for name in names:
+        unit = benchmarks[name][1]
+        for scale in scales[unit]:
+            key = f'{name}[{unit}={scale}]'
+            best = None
+            for _ in range(repeat):
+                res = run_one(name, workdir, scale)
+                if 'error' in res or best is None or \
+                        res['seconds'] < best['seconds']:
+                    best = res
+                if 'error' in res:
+                    break
+            results[key] = best
+            if 'error' in best:
+                print(f'{key:32s} failed: {best["error"]}')
+            else:
+                print(f'{key:32s} {best["seconds"]:9.4f} s '
+                      f'{best["throughput"]:12.1f} {unit}/s '
+                      f'{best["peak_rss_mb"]:8.1f} MB' + (
+                          f' {best["overhead_ms"]:7.1f} ms over numpy'
+                          if 'overhead_ms' in best else ''))
+    return {'meta': {'time': time(), 'host': platform.node(),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__, 'cpus': os.cpu_count()},
+            'results': results}
+
+
+def over_budget(current, budget=__startup_budget__):
+    """Return [(benchmark, 'startup', budget ms, overhead ms)] over budget."""
+    over = []
+    for key, res in current['results'].items():
+        limit = budget.get(key.split('[')[0])
+        if limit is not None and res.get('overhead_ms', 0.) > limit:
+            over.append((key, 'startup', limit, res['overhead_ms']))
+    return over
+
+
+def compare(current, baseline, tolerance=__tolerance__):
+    """Return [(benchmark, what, baseline, current)] of the regressions."""
+    regressions = []
+    for key, base in baseline['results'].items():
+        new = current['results'].get(key)
+        if new is None or 'error' in base:
+            continue
+        if 'error' in new:
+            regressions.append((key, 'error', None, new['error']))
+            continue
+        if new['throughput'] < base['throughput'] * (1. - tolerance):
+            regressions.append((key, 'throughput', base['throughput'],
+                                new['throughput']))
+        if new['peak_rss_mb'] > base['peak_rss_mb'] * (1. + tolerance):
+            regressions.append((key, 'peak_rss_mb', base['peak_rss_mb'],
+                                new['peak_rss_mb']))
+    return regressions
+
+
+def main(output, baseline=None, tolerance=__tolerance__, **kwargs):
+    """Main caller function, returns the number of regressions."""
+    current = run(**kwargs)
+    with open(output, 'w') as f:
+        json.dump(current, f, indent=1)
+    print(f'Results written to <{output}>')
+    regressions = over_budget(current)
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            regressions += compare(current, json.load(f), tolerance)
+    for key, what, old, new in regressions:
+        print(f'REGRESSION {key} {what}: {old} -> {new}')
+    if baseline is not None and not regressions:
+        print(f'No regressions against <{baseline}> '
+              f'(tolerance {100 * tolerance:g}%)')
+    return len(regressions)
+
+
+def test():
+    """Testing function for module."""
+    workdir = tempfile.mkdtemp()
+    try:
+        _test(workdir)
+    finally:
+        shutil.rmtree(workdir)
+    pass
+
+
+def _test(workdir):
+    """Body of test, in a workdir removed afterwards."""
+    from aei_reader import read_aei
+    header, data = read_aei(write_aei(f'{workdir}/t.aei', 1000, chunk=300))
+    assert header[0] == 'Time(years)' and data.shape == (8, 1000)
+    assert np.all(data[7] == 1e-3) and data[0, -1] == 999e3
+    current = run(['parse_aei', 'jacobi'], rows=(1000,), workdir=workdir)
+    for key, res in current['results'].items():
+        assert 'error' not in res, f'{key}: {res.get("error")}'
+    res = current['results']['jacobi[rows=1000]']
+    assert res['items'] == 1000 and res['peak_rss_mb'] > 0
+    assert compare(current, current) == []
+    slower = json.loads(json.dumps(current))
+    for x in slower['results'].values():
+        x['throughput'] *= 2.
+    assert len(compare(current, slower)) == 2
+    current = run(['startup_submit'], starts=(2,), workdir=workdir)
+    res = current['results']['startup_submit[starts=2]']
+    assert 'error' not in res, res.get('error')
+    assert res['items'] == 2 and res['startup_ms'] > res['overhead_ms']
+    assert over_budget(current, {'startup_submit': -1e3})
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    parser = ap()
+    parser.add_argument('-o', help='results file', default='benchmark.json')
+    parser.add_argument('-b', help='baseline results file to compare to',
+                        default=None)
+    parser.add_argument('-t', help='relative tolerance before a change is '
+                        'a regression', type=float, default=__tolerance__)
+    parser.add_argument('-n', help='benchmarks to run', nargs='+',
+                        choices=list(benchmarks), default=None)
+    parser.add_argument('--rows', help='.aei rows, one run per value',
+                        nargs='+', type=float, default=[1e5])
+    parser.add_argument('--sims', help='sims per sweep, one run per value',
+                        nargs='+', type=float, default=[100])
+    parser.add_argument('--starts', help='cold starts per startup '
+                        'benchmark, one run per value', nargs='+', type=int,
+                        default=[5])
+    parser.add_argument('--repeat', help='keep the fastest of this many runs',
+                        type=int, default=1)
+    parser.add_argument('-w', help='work directory for the synthetic data',
+                        default=None)
+    parser.add_argument('--test', help='run the module test',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        sys.exit(1 if main(args.o, args.b, args.t, names=args.n,
+                           rows=[int(x) for x in args.rows],
+                           sims=[int(x) for x in args.sims],
+                           starts=args.starts,
+                           workdir=args.w, repeat=args.repeat) else 0)
+
+# end of code
@@ -0,0 +1,301 @@
+"""Run many short mercury sims inside one Slurm allocation."""
+
+# internal modules
+import os
+import json
+import signal
+import subprocess
+import threading
+from argparse import ArgumentParser as ap
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+# external modules
+
+# relative modules
+from slurm_array import submit_array, simlist
+from watcher import SimWatch, stop_sim, record_reason
+
+# global attributes
+__all__ = ('test', 'run_bundle', 'write_bundle_scripts', 'submit_bundles')
+__doc__ = """Bundle mode for submit_jobs.
+
+A bundle is one allocation of K cores and a list of sim directories. The
+runner inside it keeps K mercury processes going and starts the next sim
+as soon as one exits. Every sim gets a line in the bundle status file
+(JSON lines: sim, exit status, start, end) and the finished marker the
+single-sim slurm.sh writes. On SIGTERM (the time limit) the running
+sims are stopped and recorded as terminated without a finished marker,
+so they can be restarted from their dumps. A bundle runs in, and writes
+its stdout/stderr to, the directory of its script. With watch conditions
+(see watcher) each sim is checked every interval seconds and stopped early
+once its outcome is decided."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+_bundle_template = """#!/bin/bash
+#SBATCH --partition={partition}
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cores}
+#SBATCH --chdir={outdir}
+#SBATCH --output={name}_bundle{chunk}_%j_stdout.txt
+#SBATCH --error={name}_bundle{chunk}_%j_stderr.txt
+#SBATCH --time={timelimit}
+#SBATCH --job-name={name}-bundle{chunk}
+#SBATCH --requeue
+
+{python} {runner} -l "{simlist}" -n {cores} -p {cmd} -s "{status}"{watch}
+
+exit 0
+"""
+
+
+def _seconds(timelimit):
+    """Seconds of a Slurm time limit like [d-]hh:mm:ss."""
+    days, _, clock = timelimit.rpartition('-')
+    parts = [int(x) for x in clock.split(':')]
+    if len(parts) == 1:
+        parts = [0, parts[0], 0]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    h, m, s = parts
+    return ((int(days or 0) * 24 + h) * 60 + m) * 60 + s
+
+
+def _timelimit(seconds):
+    """Slurm time limit from seconds."""
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+    return (f'{d}-' if d else '') + f'{h:02d}:{m:02d}:{s:02d}'
+
+
+class _Runner(object):
+    """Keeps cores mercury processes busy over a list of sims."""
+
+    def __init__(self, cmd, status, watch=(), interval=60., encounter_au=0.):
+        """Set up the shared state of the runner."""
+        self.cmd = cmd
+        self.status = status
+        self.watch = tuple(watch)
+        self.interval = interval
+        self.encounter_au = encounter_au
+        self.stopping = False
+        self.procs = set()
+        self.lock = threading.Lock()
+
+    def _write(self, entry):
+        """Append one status line."""
+        with self.lock:
+            with open(self.status, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def run_sim(self, sim):
+        """Run mercury in one sim directory, returns the exit status."""
+        start = time()
+        with self.lock:
+            if self.stopping:
+                return None
+            proc = subprocess.Popen([f'./{self.cmd}'], cwd=sim)
+            self.procs.add(proc)
+        reason = None
+        if self.watch:
+            w = SimWatch(sim, self.watch, self.encounter_au)
+            while True:
+                try:
+                    code = proc.wait(timeout=self.interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    reason = w.check()
+                    if reason:
+                        stop_sim(proc=proc)
+                        code = proc.wait()
+                        record_reason(sim, reason, w.events)
+                        break
+        else:
+            code = proc.wait()
+        with self.lock:
+            self.procs.discard(proc)
+            stopped = self.stopping
+        if stopped:
+            self._write({'sim': sim, 'status': 'terminated', 'exit': code,
+                         'start': start, 'end': time()})
+            return code
+        if reason:
+            self._write({'sim': sim, 'status': 'stopped', 'reason': reason,
+                         'exit': code, 'start': start, 'end': time()})
+            return code
+        # same marker the single sim slurm.sh touches after mercury
+        open(os.path.join(sim, 'finished'), 'a').close()
+        self._write({'sim': sim, 'status': 'done' if code == 0 else
+                     'failed', 'exit': code, 'start': start, 'end': time()})
+        return code
+
+    def stop(self, *args):
+        """Stop every running mercury and start no new ones."""
+        with self.lock:
+            self.stopping = True
+            for proc in self.procs:
+                proc.terminate()
+
+
+def run_bundle(sims, cores, cmd, status, watch=(), interval=60.,
+               encounter_au=0.):
+    """Run cmd in every sim directory, cores at a time.
+
+    Returns {sim: exit status}, None for sims never started.
+    """
+    runner = _Runner(cmd, status, watch, interval, encounter_au)
+    previous = signal.signal(signal.SIGTERM, runner.stop)
+    try:
+        with ThreadPoolExecutor(max_workers=cores) as pool:
+            codes = list(pool.map(runner.run_sim, sims))
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    return dict(zip(sims, codes))
+
+
+def write_bundle_scripts(cfg, sims, outdir, cores=None, size=None):
+    """Write the sim lists and bundle scripts, returns the script paths."""
+    cores = cores or getattr(cfg, 'bundle_cores', 16)
+    size = size or getattr(cfg, 'bundle_size', 4 * cores)
+    per_sim = _seconds(cfg.timelimit)
+    conditions = getattr(cfg, 'watch_conditions', ())
+    watch = f' -w {",".join(conditions)} -i ' + \
+        f'{getattr(cfg, "watch_interval", 60.)} -e ' + \
+        f'{getattr(cfg, "watch_encounter_au", 0.)}' if conditions else ''
+    outdir = os.path.abspath(outdir)
+    scripts = []
+    for chunk, start in enumerate(range(0, len(sims), size)):
+        part = sims[start:start + size]
+        waves = -(-len(part) // cores)
+        script = f'{outdir}/bundle_{cfg.time}_{chunk}.sh'
+        with open(simlist(script), 'w') as f:
+            f.write(''.join(f'{os.path.abspath(x)}\n' for x in part))
+        with open(script, 'w') as f:
+            f.write(_bundle_template.format(
+                partition=getattr(cfg, 'partition', 'normal'), cores=cores,
+                name=cfg.naming_schema, chunk=chunk,
+                timelimit=_timelimit(per_sim * waves),
+                python=getattr(cfg, 'python', 'python3'),
+                runner=os.path.abspath(__file__), simlist=simlist(script),
+                cmd=cfg.program,
+                status=f'{outdir}/bundle_{cfg.time}_{chunk}.status',
+                watch=watch, outdir=outdir))
+        scripts.append(script)
+    return scripts
+
+
+def submit_bundles(cfg, sims, outdir, sbatch='sbatch'):
+    """Write and submit the bundles of a sweep, returns {job id: script}."""
+    jobs = {}
+    for script in write_bundle_scripts(cfg, sims, outdir):
+        job = submit_array(script, sbatch)
+        if job:
+            print(f'Submitted bundle {job}...script: <{script}>')
+            jobs[job] = script
+        with open(f'{outdir}/slurm_master_restart_{cfg.time}.sh', 'a') as f:
+            f.write(f'sbatch {script} &\n')
+    return jobs
+
+
+def main(simlist, cores, cmd, status, watch=(), interval=60.,
+         encounter_au=0.):
+    """Main caller function."""
+    with open(simlist, 'r') as f:
+        sims = [x.strip() for x in f if x.strip()]
+    codes = run_bundle(sims, cores, cmd, status, watch, interval,
+                       encounter_au)
+    failed = [k for k, v in codes.items() if v != 0]
+    print(f'Ran {len(sims)} sims, {len(failed)} without a clean exit')
+    pass
+
+
+def test():
+    """Testing function for module."""
+    import types
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    sims = []
+    for i in range(6):
+        sim = f'{tmpdir}/sim{i}'
+        os.mkdir(sim)
+        with open(f'{sim}/mercury', 'w') as f:
+            f.write(f'#!/bin/sh\nsleep 0.1\nexit {i % 3 == 2:d}\n')
+        os.chmod(f'{sim}/mercury', 0o755)
+        sims.append(sim)
+    begin = time()
+    codes = run_bundle(sims, 3, 'mercury', f'{tmpdir}/status')
+    # 6 sims of 0.1 s on 3 cores take two waves, not six
+    assert time() - begin < 0.5
+    assert [codes[x] for x in sims] == [0, 0, 1, 0, 0, 1]
+    assert all(os.path.isfile(f'{x}/finished') for x in sims)
+    with open(f'{tmpdir}/status') as f:
+        status = [json.loads(x) for x in f]
+    assert sorted(x['status'] for x in status).count('failed') == 2
+    assert _seconds('1-00:15:00') == 87300 and _timelimit(87300) == \
+        '1-00:15:00'
+    # a watched sim reporting TESTP ejected is stopped early
+    with open(f'{sims[0]}/mercury', 'w') as f:
+        f.write('#!/bin/sh\necho " TESTP    ejected at  1 years" '
+                '> info.out\nsleep 10\n')
+    begin = time()
+    codes = run_bundle(sims[:1], 1, 'mercury', f'{tmpdir}/status',
+                       ('testp_ejected',), .05)
+    assert time() - begin < 5 and codes[sims[0]] != 0
+    with open(f'{tmpdir}/status') as f:
+        assert json.loads(f.readlines()[-1])['reason'] == 'testp_ejected'
+    # the encounter distance reaches the watch of a bundled sim
+    from watcher import _record
+    from xv_decoder import _re2c, _fl2c, _maxindex
+    c = _fl2c(1.) + _re2c(1, 0., _maxindex)[:3] + \
+        _re2c(2, 0., _maxindex)[:3] + _fl2c(.005)
+    with open(f'{sims[0]}/ce.out', 'wb') as f:
+        f.write(_record + c + b' ' * (70 - len(c)) + b'\n')
+    codes = run_bundle(sims[:1], 1, 'mercury', f'{tmpdir}/status',
+                       ('encounter',), .05, .01)
+    assert codes[sims[0]] != 0
+    with open(f'{tmpdir}/status') as f:
+        assert json.loads(f.readlines()[-1])['reason'] == 'encounter'
+    cfg = types.SimpleNamespace(time='0', naming_schema='test',
+                                timelimit='00:15:00', program='mercury',
+                                watch_conditions=('encounter',),
+                                watch_encounter_au=.01)
+    scripts = write_bundle_scripts(cfg, sims, tmpdir, cores=2, size=5)
+    with open(scripts[0]) as f:
+        text = f.read()
+    assert '-w encounter -i 60.0 -e 0.01' in text
+    assert '--cpus-per-task=2' in text and '--time=00:45:00' in text
+    assert f'#SBATCH --chdir={os.path.abspath(tmpdir)}\n' in text
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    parser = ap()
+    parser.add_argument('-l', help='file listing the sim directories')
+    parser.add_argument('-n', help='cores, mercury processes at once',
+                        type=int, default=os.cpu_count())
+    parser.add_argument('-p', help='mercury program in each sim directory')
+    parser.add_argument('-s', help='status file', default='bundle.status')
+    parser.add_argument('-w', help='comma separated watcher conditions',
+                        default='')
+    parser.add_argument('-i', help='seconds between watcher looks',
+                        type=float, default=60.)
+    parser.add_argument('-e', help='encounter distance (AU) of the '
+                        'encounter condition', type=float, default=0.)
+    parser.add_argument('--test', help='run the module test',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        main(args.l, args.n, args.p, args.s,
+             [x for x in args.w.split(',') if x], args.i, args.e)
+
+# end of code
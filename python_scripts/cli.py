@@ -0,0 +1,140 @@
+"""Single command line entry point for the sweep tools."""
+
+# internal modules
+import sys
+import importlib
+from argparse import ArgumentParser as ap
+
+# external modules
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'parser', 'main', 'commands')
+__doc__ = """python cli.py <command> [options]
+
+    construct     write one sim directory (construct_jobs)
+    submit        generate, submit and manage a sweep (submit_jobs)
+    post-process  convert the outputs of a sweep (post_process)
+    jacobi        jacobi constant of a run (find_jacobi)
+
+Only argparse is imported up front. The options of a command come from the
+add_arguments of its module, which is imported only for that command, and
+those modules import numpy, nkrpy, asyncio, matplotlib and the like only on
+the paths that use them. --import-only stops right after the
+command's module is imported, benchmark.py times that as the startup of
+the command."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+commands = {'construct': 'construct_jobs', 'submit': 'submit_jobs',
+            'post-process': 'post_process', 'jacobi': 'find_jacobi'}
+
+
+def _construct(mod, args):
+    """Run construct_jobs."""
+    print('Constructing')
+    mod.main(args.c, args.j, True, args.s)
+    print('Finished')
+
+
+def _submit(mod, args):
+    """Run submit_jobs."""
+    print('Running Job')
+    mod.main(args.c, args.array, args.resume, args.bundle, args.requeue,
+             args.watch)
+    print('Finished')
+
+
+def _post_process(mod, args):
+    """Run post_process."""
+    print('Post Processing')
+    mod.main(args.c, args.w, args.m, args.force)
+    print('Finished')
+
+
+def _jacobi(mod, args):
+    """Run find_jacobi."""
+    mod.main(args.input, args.follow, args.interval)
+
+
+_commands = {'construct': (_construct, 'write one sim directory'),
+             'submit': (_submit, 'generate, submit and manage a sweep'),
+             'post-process': (_post_process, 'convert the outputs of a sweep'),
+             'jacobi': (_jacobi, 'jacobi constant of a run')}
+
+
+def _command(argv):
+    """Return the command named in argv, or None."""
+    return next((x for x in argv if x in commands), None)
+
+
+def parser(command=None):
+    """Build the argument parser, with the options of command.
+
+    The options come from the add_arguments of the command's module, so only
+    that module is imported.
+    """
+    p = ap(description='Mercury cluster sweep tools.')
+    p.add_argument('--import-only', help='import the command and exit',
+                   action='store_true')
+    sub = p.add_subparsers(dest='command', required=True)
+    for name, (run, help) in _commands.items():
+        c = sub.add_parser(name, help=help)
+        c.set_defaults(run=run)
+        if name == command:
+            importlib.import_module(commands[name]).add_arguments(c)
+    return p
+
+
+def main(argv=None):
+    """Main caller function, returns the command's module."""
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser(_command(argv)).parse_args(argv)
+    mod = importlib.import_module(commands[args.command])
+    if not args.import_only:
+        args.run(mod, args)
+    return mod
+
+
+def test():
+    """Testing function for module."""
+    import subprocess
+    for name, module in commands.items():
+        run = subprocess.run([sys.executable, __file__, '--import-only',
+                              name], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        assert run.returncode == 0, run.stderr.decode('utf-8')
+    # heavy modules stay out of the commands that do not use them
+    run = subprocess.run(
+        [sys.executable, '-c', 'import sys, cli; cli.main(["--import-only", '
+         '"submit"]); cli.main(["--import-only", "jacobi"]); '
+         'print(" ".join(sorted(sys.modules)))'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=__path__ or None)
+    assert run.returncode == 0, run.stderr.decode('utf-8')
+    loaded = run.stdout.decode('utf-8').split()
+    for heavy in ('matplotlib', 'asyncio', 'sqlite3', 'nkrpy.load',
+                  'nkrpy.keplerian'):
+        assert heavy not in loaded, heavy
+    argv = ['submit', '--bundle', '-c', 'x.py']
+    args = parser(_command(argv)).parse_args(argv)
+    assert args.bundle and args.c == 'x.py' and args.run is _submit
+    # the modules run by hand take the same options
+    import submit_jobs
+    assert vars(submit_jobs.add_arguments(ap()).parse_args(argv[1:])) == \
+        {k: v for k, v in vars(args).items()
+         if k not in ('import_only', 'command', 'run')}
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    if sys.argv[1:] == ['--test']:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        main()
+
+# end of code
@@ -6,11 +6,38 @@ parent_mercury_inputs = '../mercury_parent/files/'  # noqa the template input fi
 parent_mercury_programs = '../mercury_parent/'  # the location for the programs
 destination = '/home/reynolds/mercury_results'  # destination for results, will end up as dest/naming_schema_simN
 naming_schema = 'multiprocessRestricted2body'  # naming schema as 'naming_schema_simN/'
+ledger = 'ledger.sqlite'  # sweep ledger in destination/naming_schema/, used by --resume
+template_link = 'hard'  # static input files are linked into sims: hard, sym or copy
+template_private = ()  # template files rewritten in place inside a sim, copied instead of linked (a linked file shares the template's inode)
 
 # oscer params
-num_threads = 10
+seed = None  # sweep seed, None draws fresh entropy (printed, stored with each sim)
+construct_workers = None  # processes building sim directories for --array/--bundle (None = all cores)
+generate_batch = 256  # sims sampled per batch by the submission pipeline
+sample_block = 1024  # sims drawn together from one stream of the seed, keep it fixed within a sweep (it changes the sims)
+render_workers = 4  # threads writing sim directories
+submit_workers = 4  # concurrent sbatch calls
+max_pending = 500  # hold submission while this many of our jobs are pending (0 = no limit)
+track_jobs = True  # keep polling after submission until every job left the queue (records finished/failed)
 num_simulations = 10  # number of simulations
 timelimit = '00:15:00'  # timelimit for each run hh:mm:ss
+max_timelimit = '2-00:00:00'  # longest time limit a --requeue continuation may ask for
+requeue_safety = 1.25  # continuation time limit = safety * remaining / measured rate
+max_array_size = 1000  # cluster MaxArraySize, larger sweeps are chunked
+array_throttle = 0  # with --array, max simultaneously running tasks (0 = no limit)
+status_ttl = 30  # seconds a squeue snapshot is reused for job status checks
+bundle_cores = 16  # with --bundle, cores per allocation = mercury runs at once
+bundle_size = 64  # with --bundle, sims per allocation (time limit scales with size / cores)
+watch_conditions = ('testp_ejected', 'bodies_lost')  # noqa stop sims early on: testp_ejected, bodies_lost, binary_lost, collision, encounter
+watch_interval = 60  # seconds between looks at info.out/ce.out
+watch_encounter_au = 0  # 'encounter' condition: close encounter within this many AU
+screen_sims = False  # drop sims the stability screen decides before submitting (see stability.py)
+screen_hill_unstable = 3.46  # skip-unstable below this many mutual Hill radii between adjacent bodies
+screen_hill_stable = 12.  # skip-stable above this spacing ...
+screen_ma_stable = 2.  # ... and this multiple of the Mardling-Aarseth limit ...
+screen_tidal_max = 1e-8  # ... and below this cluster tide / central gravity
+trace = None  # directory or file for the JSON-lines stage timings (python instrument.py <file> summarises)
+post_workers = 32  # processes for post_process.py (element6/xv conversion)
 program = 'mercury6_4mult_passstarsfeelplum_instantremove_closeenc_nogasdisk'  # noqa name of program to run
 
 # integrator config
@@ -4,6 +4,17 @@
 # file modifiers
 file_location = '../mercury_parent/files/'  # location of aei
 naming_schema = 'multiprocessRestricted2body'  # naming schema as 'naming_schema_simN/'
+store_location = '../mercury_parent/files/ensemble_store'  # memmapped masterbinaries/masterbody
+store_rebuild = False  # ingest the store again even when no sim output changed
+
+trace = None  # directory or file for the JSON-lines stage timings
+gallery_location = '../mercury_parent/files/plot_orbital'  # frames, chunk_<sweep>-<k>.gif and thumbnail.gif (gallery.py)
+gallery_chunk = 100  # sim number range per chunk GIF, only chunks with new or changed sims are rebuilt
+gallery_delay = 20  # GIF frame delay in 1/100 s
+gallery_size = 2.  # frame size in inches
+gallery_dpi = 100  # frame resolution
+gallery_extent = None  # half width of every frame in AU, None fits each sim
+gallery_workers = None  # processes drawing frames (None = all cores)
 
 # multithreading
 num_threads = 10
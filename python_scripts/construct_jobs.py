@@ -5,9 +5,7 @@ import os
 from argparse import ArgumentParser as ap
 import shutil
 from glob import glob
-from decimal import Decimal
-import subprocess
-from importlib import reload
+import types
 try:
     import cPickle as pickle
 except ModuleNotFoundError:
@@ -15,17 +13,17 @@ except ModuleNotFoundError:
 
 # external modules
 import numpy as np
-from nkrpy.keplerian import orbital_params, xyz_2_orbital
-from nkrpy.load import load_cfg, verify_dir, mod_2_dict
-from nkrpy.files import freplace
-from nkrpy.miscmath import plummer_radius, sample
-from nkrpy.functions import format_decimal
-from nkrpy.constants import msun, g, au, kepler
+from nkrpy.constants import kepler
 
 # relative modules
+import instrument
+from param_sampling import sample_sims, sim_params, sample_each, \
+    sample_plummer
+from render import materialize_sim
 
 # global attributes
-__all__ = ('test', 'main')
+__all__ = ('test', 'main', 'add_arguments', 'generate_sim', 'construct_sweep',
+           'prepare_destination')
 __doc__ = """."""
 __filename__ = __file__.split('/')[-1].strip('.py')
 __path__ = __file__.strip('.py').strip(__filename__)
@@ -35,61 +33,64 @@ if _cwd_ == '':
     _cwd_ = os.getcwd()
 
 
-def generate_sim(cfg, orbitals, jobnumber, verbose=False):
-    """Generate the simulations wrapper."""
-    # generate a tmp directory
-    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
-    os.makedirs(dest, exist_ok=True)
-    verify_dir(dest)
-    os.chdir(dest)
+def _cfg_dict(cfg):
+    """Plain, picklable dict of a configuration module or namespace."""
+    return {k: v for k, v in vars(cfg).items()
+            if not k.startswith('__') and not callable(v) and
+            not isinstance(v, type(os))}
 
-    # bodies for a single sim
-    sim_name = f'{dest}{cfg.naming_schema}_sim{jobnumber}'
-    # copy over program files
-    if verbose:
-        print('Copying Files')
-    try:
-        shutil.copytree(f'{_cwd_}/{cfg.parent_mercury_inputs}',
-                        f'{sim_name}', symlinks=True)
-    except shutil.Error:
-        print(f'Jobnumber: <{jobnumber}> must be purely unique within directory <{dest}> and isn\'t.') # noqa
-        exit()
-    except Exception as e:
-        print(f'Error: {e}')
-        pass
 
-    for x in glob(f'{_cwd_}/{cfg.parent_mercury_programs}/*'):
+def prepare_destination(cfg):
+    """Create the destination and copy the mercury programs in, once."""
+    from nkrpy.load import verify_dir
+    dest = os.path.abspath(f'{cfg.destination}/{cfg.naming_schema}') + '/'
+    os.makedirs(dest, exist_ok=True)
+    verify_dir(dest)
+    # relative to this directory unless absolute
+    for x in glob(os.path.join(_cwd_, cfg.parent_mercury_programs, '*')):
         dname = x.split("/")[-1]
         if not os.path.isfile(f'{dest}/{dname}') and os.path.isfile(x):
             print(f'Creating program: {x} in \n{dest}/{dname}')
             shutil.copyfile(x, f'{dest}/{dname}')
             shutil.copystat(x, f'{dest}/{dname}')
-    if verbose:
-        print('Made files')
     if not os.path.isfile(f'{dest}/{cfg.program}'):
         print(f'Could not find the compiled mercury file: <{dest}/{cfg.program}>\nPlease go into the <{dest}> and run the makefile.')
         exit()
+    return dest
+
+
+def generate_sim(cfg, jobnumber, seed=None, params=None, verbose=False):
+    """Write one sim directory, returns its path.
+
+    A pure function of (cfg, jobnumber, seed): only absolute paths are
+    used, neither the working directory nor cfg are touched and all
+    randomness comes from seed (a SeedSequence, int or None). params, the
+    param_sampling.sim_params dict, is drawn from seed when not given.
+    """
+    from nkrpy.keplerian import xyz_2_orbital
+    from nkrpy.functions import format_decimal
+    rng = np.random.default_rng(seed)
+    if params is None:
+        with instrument.span('construct.sample'):
+            sims, bodies = sample_sims(cfg, 1, rng)
+            params = sim_params(sims, bodies, 0)
+    orbitals = params['orbitals']
+    dest = os.path.abspath(f'{cfg.destination}/{cfg.naming_schema}') + '/'
+    sim_name = f'{dest}{cfg.naming_schema}_sim{jobnumber}'
 
     # handle the 'big.in' file
     # generating binary
     if verbose:
         print('Writing Big.in')
-    central_mass = cfg.sub[f'{jobnumber}']['central_mass']
-    binary_params = orbital_params(cfg.binary_l_sma,
-                                   cfg.binary_u_sma,
-                                   cfg.binary_l_ecc,
-                                   cfg.binary_u_ecc,
-                                   cfg.binary_l_inc,
-                                   cfg.binary_u_inc,
-                                   central_mass, size=1)[1][0]
+    central_mass = params['central_mass']
     binary_params = [x for x in list(map(lambda x: format_decimal(x, 4),
-                                         list(binary_params)))]
+                                         list(params['binary_params'])))]
 
     inp_repl = ''
     # insert logic for binary
     if verbose:
         print('Writing Binary')
-    binary_mass = cfg.sub[f'{jobnumber}']['binary_mass']
+    binary_mass = params['binary_mass']
     inp_repl += f' WB m={binary_mass}D0 r=0.D0 d={cfg.binary_density}D0\n'
     inp_repl += f'  {" ".join(binary_params[0:3])}\n'
     inp_repl += f'  {" ".join(binary_params[3:])}\n'
@@ -98,12 +99,8 @@ def generate_sim(cfg, orbitals, jobnumber, verbose=False):
     # now handle bodies
     if verbose:
         print('Writing Bodies')
-    cfg.sub[f'{jobnumber}']['mass_bodies'] = sample(cfg.bodies_l_mass,
-        cfg.bodies_u_mass, size=cfg.sub[f'{jobnumber}']['num_bodies']) # noqa
-    cfg.sub[f'{jobnumber}']['den_bodies'] = sample(cfg.bodies_l_density,
-        cfg.bodies_u_density, size=cfg.sub[f'{jobnumber}']['num_bodies']) # noqa
     for b, body in enumerate(orbitals):
-        inp_repl += f" BODY{b}    m={cfg.sub[f'{jobnumber}']['mass_bodies'][b]}D0 r=0.D0 d={cfg.sub[f'{jobnumber}']['den_bodies'][b]}D0\n" # noqa
+        inp_repl += f" BODY{b}    m={params['mass_bodies'][b]}D0 r=0.D0 d={params['den_bodies'][b]}D0\n" # noqa
         tmp = [x for x in list(map(lambda x: format_decimal(x, 4),
                                    list(body)))]
         inp_repl += f'  {" ".join(tmp[0:3])}\n'
@@ -112,36 +109,17 @@ def generate_sim(cfg, orbitals, jobnumber, verbose=False):
     # insert login for testp
     if verbose:
         print('Writing TestP')
+    record = {}
     if cfg.plummer_model:
-        plum_mass_enc = np.random.rand(1)[0]
-        plum_radius = plummer_radius(plum_mass_enc, cfg.cluster_radius)
-        cfg.plum_mass_enc = plum_mass_enc
-        cfg.plum_radius = plum_radius
-        random_xyz = False
-        # choose
-        while not isinstance(random_xyz, np.ndarray):
-            points = np.abs(np.array(sample(0, 1, size=3)))
-            norm = np.sqrt(np.sum(points ** 2))
-            if norm == 0:
-                random_xyz = False
-            else:
-                points *= plum_radius
-                random_xyz = points
-        # now get the velocity
-        vel = np.sqrt(cfg.cluster_mass * msun * g / (plum_radius * au)) / au
-        random_vel = False
-        while not isinstance(random_vel, np.ndarray):
-            points = np.array([np.random.choice([-1,1]) * x
-                               for x in np.array(sample(0, 1, size=3))])
-            norm = np.sqrt(np.sum(points ** 2))
-            if norm == 0:
-                random_vel = False
-            else:
-                points *= vel
-                random_vel = points
-        testp = np.concatenate([random_xyz, random_vel])
+        if 'testp' not in params:
+            states, enc, r = sample_plummer(1, cfg.cluster_mass,
+                                            cfg.cluster_radius, rng)
+            params = dict(params, testp=states[0], plum_mass_enc=enc[0],
+                          plum_radius=r[0])
+        record['plum_mass_enc'] = params['plum_mass_enc']
+        record['plum_radius'] = params['plum_radius']
         testp = [x for x in list(map(lambda x: format_decimal(x, 4),
-                                     list(testp)))]
+                                     list(params['testp'])))]
     else:
         testp = ['0.D0' for x in range(6)]
     inp_repl += f'TESTP m=1.D-81 r=0.D0 d=0.D0\n'
@@ -149,14 +127,15 @@ def generate_sim(cfg, orbitals, jobnumber, verbose=False):
     inp_repl += f'  {" ".join(testp[3:])}\n'
     inp_repl += f'  0.D0 0.D0 0.D0\n'
 
-    freplace(f'{sim_name}/big.in', '<input>', inp_repl)
+    subs = {'big.in': {'<input>': inp_repl}}
 
     # handle cluster.in file
     if verbose:
         print('Cluster File')
-    freplace(f'{sim_name}/cluster.in', '<mass>', '{}'.format(cfg.cluster_mass, '.15f'))
-    freplace(f'{sim_name}/cluster.in', '<radius>', '{}'.format(cfg.cluster_radius, '.2f'))
-    freplace(f'{sim_name}/cluster.in', '<days_for_interaction>', '{}'.format(int(cfg.days_for_interaction)))
+    subs['cluster.in'] = {
+        '<mass>': '{}'.format(cfg.cluster_mass, '.15f'),
+        '<radius>': '{}'.format(cfg.cluster_radius, '.2f'),
+        '<days_for_interaction>': '{}'.format(int(cfg.days_for_interaction))}
 
     # handle param.in
     if verbose:
@@ -166,74 +145,122 @@ def generate_sim(cfg, orbitals, jobnumber, verbose=False):
         return ((1. / (kepler * mass)) * (orb[0] ** 3)) ** 0.5 / 20.
 
     timestep = compute_timestep(central_mass, orbitals[0])
-    freplace(f'{sim_name}/param.in', '<stop>', '{}'.format(cfg.stop_time))
-    freplace(f'{sim_name}/param.in', '<interval>', '{}'.format(cfg.output_time))
-    freplace(f'{sim_name}/param.in', '<timestep>', '{}'.format(int(np.ceil(timestep))))
-    freplace(f'{sim_name}/param.in', '<mass>', '{}'.format(float(cfg.sub[f'{jobnumber}']['central_mass'])))
-    freplace(f'{sim_name}/param.in', '<bb>', '{}'.format(int(cfg.sub[f'{jobnumber}']['num_bodies'])))
+    subs['param.in'] = {
+        '<stop>': '{}'.format(cfg.stop_time),
+        '<interval>': '{}'.format(cfg.output_time),
+        '<timestep>': '{}'.format(int(np.ceil(timestep))),
+        '<mass>': '{}'.format(float(central_mass)),
+        '<bb>': '{}'.format(int(params['num_bodies']))}
+
+    # handle slurm.sh
+    subs['slurm.sh'] = {'<name>': cfg.naming_schema,
+                        '<timelimit>': cfg.timelimit,
+                        '<workdir>': sim_name,
+                        '<cmd>': cfg.program}
+
+    # render the templates once, copy or link the static files
+    if verbose:
+        print('Writing Files')
+    try:
+        with instrument.span('construct.materialize'):
+            materialize_sim(os.path.join(_cwd_, cfg.parent_mercury_inputs),
+                            sim_name, subs,
+                            getattr(cfg, 'template_link', 'hard'),
+                            getattr(cfg, 'template_private', ()))
+    except FileExistsError:
+        print(f'Jobnumber: <{jobnumber}> must be purely unique within directory <{dest}> and isn\'t.') # noqa
+        exit()
 
     # save config
     if verbose:
         print('Saving Config')
-    write_cfg = mod_2_dict(cfg)
-    write_cfg['sub'] = write_cfg['sub'][f'{jobnumber}']
-    write_cfg['sub']['job_number'] = f'{jobnumber}'
-    with open(f'{sim_name}/configuration_params.pickle', 'wb') as f:
+    write_cfg = _cfg_dict(cfg)
+    write_cfg.update(record)
+    write_cfg['sub'] = dict(params, job_number=f'{jobnumber}')
+    if isinstance(seed, np.random.SeedSequence):
+        write_cfg['sub']['seed'] = {'entropy': seed.entropy,
+                                    'spawn_key': seed.spawn_key}
+    with instrument.span('construct.pickle'), \
+            open(f'{sim_name}/configuration_params.pickle', 'wb') as f:
         pickle.dump(write_cfg, f, pickle.HIGHEST_PROTOCOL)
-    pass
+    instrument.count('construct.sims')
+    return sim_name
+
+
+_worker_cfg = None
+
+
+def _init_worker(cfg):
+    """Keep the sweep configuration in each worker process."""
+    global _worker_cfg
+    _worker_cfg = types.SimpleNamespace(**cfg)
+
+
+def _construct(args):
+    """Pool entry point: (jobnumber, seed, params) -> sim directory."""
+    jobnumber, seed, params = args
+    return generate_sim(_worker_cfg, jobnumber, seed, params)
+
+
+def construct_sweep(cfg, jobnumbers, seed=None, workers=None, params=None):
+    """Build many sim directories in parallel processes.
+
+    jobnumbers is a list of (index, jobnumber); the parameters of sim index
+    are drawn here by param_sampling.sample_each out of the sample blocks
+    of seed, so a sim is the same whatever the number of workers or the
+    order it is built in, and its seed record is pickled with it. params
+    optionally maps index to already drawn parameters (see
+    stability.screen_sweep).
+    Returns the sim directories in jobnumbers order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    seed = seed if isinstance(seed, np.random.SeedSequence) else \
+        np.random.SeedSequence(seed)
+    print(f'Sweep seed entropy: {seed.entropy}')
+    prepare_destination(cfg)
+    params = dict(params or {})
+    missing = [index for index, job in jobnumbers if index not in params]
+    if missing:
+        with instrument.span('construct.sample', sims=len(missing)):
+            params.update(sample_each(cfg, missing, seed)[2])
+    tasks = [(job, None, params[index]) for index, job in jobnumbers]
+    workers = workers or getattr(cfg, 'construct_workers', None)
+    with instrument.span('construct.sweep', sims=len(tasks)), \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(_cfg_dict(cfg),)) as pool:
+        return list(pool.map(_construct, tasks,
+                             chunksize=max(1, len(tasks) // 256)))
 
 
-def main(config_name, jobnumber, verbose=False):
+def add_arguments(parser):
+    """Add the command line options of main to an argparse parser."""
+    parser.add_argument('-c', help='configuration file', default='config.py')
+    parser.add_argument('-j', help='jobnumber', type=int, default=0)
+    parser.add_argument('-s', help='seed', type=int, default=None)
+    return parser
+
+
+def main(config_name, jobnumber, verbose=False, seed=None):
     """Main caller function."""
     # load cfg
     if verbose:
         print('Load Config')
     if isinstance(config_name, str):
+        from nkrpy.load import load_cfg
         config = load_cfg(config_name)
     else:
         config = config_name
-    try:
-        config.sub[f'{jobnumber}'] = {}
-    except:
-        config.sub = {}
-        config.sub[f'{jobnumber}'] = {}
-    if verbose:
-        print('Sampling Binary')
-    config.sub[f'{jobnumber}']['central_mass'] = sample(config.central_l_mass, config.central_u_mass, size=1)[0]
-    nb_u, nb_l, avgdist, lsma, usma, lecc, uecc, linc, uinc = \
-        config.num_bodies_u, config.num_bodies_l, config.avg_dist, \
-        config.lower_smajora, config.upper_smajora, \
-        config.lower_ecc, config.upper_ecc, \
-        config.lower_inc, config.upper_inc
-    config.sub[f'{jobnumber}']['binary_mass'] = sample(config.binary_l_mass, config.binary_u_mass, size=1, resample=True, lim=config.sub[f'{jobnumber}']['central_mass'], logic='<')[0]
-    if verbose:
-        print('Sampling Bodies')
-    mass = config.sub[f'{jobnumber}']['central_mass']
-    # generate lower orbit runs
-    orbits = []
-    nbod = np.int(np.abs(sample(nb_l, nb_u, size=1)))
-    config.sub[f'{jobnumber}']['num_bodies'] = nbod
-    for n in range(nbod):
-        orbits.append(
-            orbital_params(lsma + n * avgdist, usma +
-                    n * avgdist, lecc, uecc, # noqa
-                    linc, uinc, mass, # noqa
-                    size=1)[1][0]) # noqa
-    config.sub[f'{jobnumber}']['orbitals'] = orbits
+    prepare_destination(config)
     if verbose:
         print('Generating')
-    generate_sim(config, orbits, jobnumber, verbose)
-    pass
+    return generate_sim(config, jobnumber, seed, verbose=verbose)
 
 if __name__ == "__main__":
     """Directly Called."""
-    parser = ap()
-    parser.add_argument('-c', help='configuration file', default='config.py')
-    parser.add_argument('-j', help='jobnumber', type=int, default=0)
-    args = parser.parse_args()
+    args = add_arguments(ap()).parse_args()
 
     print('Constructing')
-    main(args.c, args.j, True)
+    main(args.c, args.j, True, args.s)
     print('Finished')
 
 # end of code
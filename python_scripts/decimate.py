@@ -0,0 +1,90 @@
+"""Reduce long time series to what a plot can show."""
+
+# internal modules
+
+# external modules
+import numpy as np
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'bin_edges', 'envelope', 'binned')
+__doc__ = """Per pixel decimation.
+
+A series of n samples drawn into w pixels only shows, per pixel column,
+the range of the samples falling in it. envelope keeps the min and max of
+each of nbins consecutive slices, so every outlier survives, binned keeps
+the mean and standard deviation. Both are single reduceat passes over the
+series and return nbins points whatever n is; series shorter than nbins
+are returned as they are."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+
+def bin_edges(n, nbins):
+    """Start index of each of at most nbins equal slices of n samples."""
+    return np.unique(np.linspace(0, n, min(n, nbins) + 1).astype(np.intp))[:-1]
+
+
+def envelope(x, y, nbins):
+    """Return (x centre, y min, y max) of nbins slices, NaNs ignored."""
+    x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+    if y.shape[0] <= nbins:
+        return x, y, y
+    edges = bin_edges(y.shape[0], nbins)
+    centre = x[edges + np.diff(np.append(edges, y.shape[0])) // 2]
+    with np.errstate(invalid='ignore'):
+        lo = np.fmin.reduceat(y, edges)
+        hi = np.fmax.reduceat(y, edges)
+    return centre, lo, hi
+
+
+def binned(x, y, nbins):
+    """Return (x centre, mean, std, count) of nbins slices, NaNs ignored."""
+    x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+    if y.shape[0] <= nbins:
+        return x, y, np.zeros_like(y), np.isfinite(y).astype(np.intp)
+    edges = bin_edges(y.shape[0], nbins)
+    centre = x[edges + np.diff(np.append(edges, y.shape[0])) // 2]
+    good = np.isfinite(y)
+    yz = np.where(good, y, 0.)
+    count = np.add.reduceat(good.astype(np.intp), edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(yz, edges) / count
+        # second pass about the bin mean keeps the variance accurate
+        dev = np.where(good, y - np.repeat(mean, np.diff(
+            np.append(edges, y.shape[0]))), 0.)
+        std = np.sqrt(np.add.reduceat(dev ** 2, edges) / count)
+    return centre, mean, std, count
+
+
+def test():
+    """Testing function for module."""
+    y = np.random.default_rng(0).normal(size=10 ** 6)
+    y[123456] = 50.
+    y[777] = np.nan
+    x = np.arange(y.shape[0])
+    xc, lo, hi = envelope(x, y, 1000)
+    assert xc.shape == lo.shape == hi.shape == (1000,)
+    assert np.nanmax(hi) == 50. and np.min(lo) == np.nanmin(y)
+    assert np.all(lo <= hi)
+    xc, mean, std, count = binned(x, y, 1000)
+    assert count.sum() == y.shape[0] - 1
+    k = 123456 // 1000
+    assert np.isclose(mean[k], np.nanmean(y[k * 1000:(k + 1) * 1000]))
+    assert np.isclose(std[1], np.std(y[1000:2000]))
+    xc, lo, hi = envelope(x[:10], y[:10], 1000)
+    assert np.array_equal(lo, y[:10])
+    assert bin_edges(7, 3).tolist() == [0, 2, 4]
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
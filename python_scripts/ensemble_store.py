@@ -0,0 +1,291 @@
+"""Memory-mapped on disk store of a whole ensemble of sims."""
+
+# internal modules
+import os
+import re
+import json
+from glob import glob
+
+# external modules
+import numpy as np
+
+# relative modules
+import instrument
+from aei_reader import read_aei, _open_aei, _count_lines
+from xv_decoder import read_xv
+
+# global attributes
+__all__ = ('test', 'sim_sources', 'load_sim', 'store_sources', 'is_current',
+           'ingest', 'open_store', 'sim_slice', 'body_slice')
+__doc__ = """Build and slice the masterbinaries/masterbody arrays.
+
+ingest walks the sim directories once and writes
+    binaries.npy  sims x 9 x steps
+                  (sim number, mass, density, x, y, z, vx, vy, vz)
+    bodies.npy    bodies x sims x 10 x steps
+                  (sim number, body num, mass, density, x, y, z, vx, vy, vz)
+as preallocated .npy memmaps filled with NaN, plus boolean masks of the
+valid steps and an index.json mapping sim names and body names to array
+positions. Sims of different lengths or body counts are padded. open_store
+memory-maps everything read only, so a slice across thousands of sims only
+pages in what it touches. The index also records the size and mtime of
+every output the store was built from, is_current tells whether a set of
+sims still matches it (no sim added, removed or grown since)."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__binary__ = 'WB'
+__chunk__ = 2 ** 22
+_xv_record = b'\x0c6b'
+_big_line = re.compile(r'^\s*(\S+)\s+m=(\S+)\s+r=\S+\s+d=(\S+)')
+
+
+def _fortran_float(x):
+    """Float from a Fortran literal like 1.D-81."""
+    return float(x.upper().replace('D', 'E'))
+
+
+def read_big(fname):
+    """Return {name: (mass, density)} from a big.in file."""
+    ret = {}
+    if not os.path.isfile(fname):
+        return ret
+    with open(fname, 'r', errors='replace') as f:
+        for line in f:
+            match = _big_line.match(line)
+            if match:
+                ret[match.group(1)] = (_fortran_float(match.group(2)),
+                                       _fortran_float(match.group(3)))
+    return ret
+
+
+def sim_sources(sim):
+    """Return ('npy'|'aei'|'xv', {name: path}) for the outputs of a sim."""
+    npy = glob(f'{sim}/*.xv.npy')
+    if npy:
+        return 'npy', {os.path.basename(x)[:-7]: x for x in npy}
+    aei = glob(f'{sim}/*.aei')
+    if aei:
+        return 'aei', {os.path.basename(x)[:-4]: x for x in aei}
+    if os.path.isfile(f'{sim}/xv.out'):
+        return 'xv', {}
+    return None, {}
+
+
+def _steps(kind, files, sim):
+    """Cheaply find the longest series of a sim without parsing it."""
+    if kind == 'npy':
+        return max(np.load(x, mmap_mode='r').shape[-1]
+                   for x in files.values())
+    if kind == 'aei':
+        steps = 0
+        for x in files.values():
+            with open(x, 'rb') as f:
+                _, ncols, first = _open_aei(f)
+                if ncols:
+                    f.seek(f.tell() - len(first))
+                    steps = max(steps, _count_lines(f))
+        return steps
+    count, tail = 0, b''
+    with open(f'{sim}/xv.out', 'rb') as f:
+        # chunked, a record marker split over two chunks is seen once
+        for buf in iter(lambda: f.read(__chunk__), b''):
+            count += (tail + buf).count(_xv_record)
+            tail = buf[-(len(_xv_record) - 1):]
+    return count
+
+
+def load_sim(kind, files, sim):
+    """Return {name: (8, steps)} for a sim."""
+    if kind == 'npy':
+        return {k: np.load(v, mmap_mode='r') for k, v in files.items()}
+    if kind == 'aei':
+        return {k: read_aei(v)[1] for k, v in files.items()}
+    return read_xv(f'{sim}/xv.out')
+
+
+def store_sources(sims):
+    """Return {sim: [[file, size, mtime]]} of the outputs of the sims."""
+    ret = {}
+    for sim in sims:
+        kind, files = sim_sources(sim)
+        if kind is None:
+            continue
+        paths = [f'{sim}/xv.out'] if kind == 'xv' else sorted(files.values())
+        ret[os.path.abspath(sim)] = [
+            [os.path.basename(x), st.st_size, st.st_mtime_ns]
+            for x, st in ((x, os.stat(x)) for x in paths)]
+    return ret
+
+
+def is_current(store_dir, sims):
+    """Whether the store in store_dir was built from exactly these outputs."""
+    fname = f'{store_dir}/index.json'
+    if not os.path.isfile(fname):
+        return False
+    with open(fname, 'r') as f:
+        index = json.load(f)
+    return index.get('sources') == store_sources(sims)
+
+
+def ingest(sims, store_dir, naming_schema=''):
+    """Write the ensemble of the given sim directories into store_dir."""
+    os.makedirs(store_dir, exist_ok=True)
+    plan = []
+    names = set()
+    steps = 0
+    for sim in sims:
+        kind, files = sim_sources(sim)
+        if kind is None:
+            print('No outputs found, skipping:', sim)
+            continue
+        if kind == 'xv':
+            files = {}
+        nstep = _steps(kind, files, sim)
+        plan.append((sim, kind, files))
+        names.update(x for x in files if x != __binary__)
+        steps = max(steps, nstep)
+    if any(kind == 'xv' for _, kind, _ in plan):
+        # names are only known after decoding, use the initial conditions
+        for sim, kind, _ in plan:
+            if kind == 'xv':
+                names.update(x for x in read_big(f'{sim}/big.in')
+                             if x != __binary__)
+    bodies = sorted(names)
+    nsim, nbody = len(plan), len(bodies)
+    print(f'Ingesting {nsim} sims, {nbody} bodies, {steps} steps')
+
+    fmt = np.lib.format
+    binaries = fmt.open_memmap(f'{store_dir}/binaries.npy', mode='w+',
+                               dtype=np.float64, shape=(nsim, 9, steps))
+    body = fmt.open_memmap(f'{store_dir}/bodies.npy', mode='w+',
+                           dtype=np.float64,
+                           shape=(nbody, nsim, 10, steps))
+    bmask = fmt.open_memmap(f'{store_dir}/binaries_mask.npy', mode='w+',
+                            dtype=bool, shape=(nsim, steps))
+    mask = fmt.open_memmap(f'{store_dir}/bodies_mask.npy', mode='w+',
+                           dtype=bool, shape=(nbody, nsim, steps))
+    time = fmt.open_memmap(f'{store_dir}/time.npy', mode='w+',
+                           dtype=np.float64, shape=(nsim, steps))
+    binaries[:] = np.nan
+    body[:] = np.nan
+    time[:] = np.nan
+
+    index = {'sims': {}, 'bodies': {x: i for i, x in enumerate(bodies)},
+             'lengths': {}, 'members': {}, 'steps': steps,
+             'sources': store_sources(x[0] for x in plan)}
+    for s, (sim, kind, files) in enumerate(plan):
+        name = os.path.basename(os.path.normpath(sim))
+        if naming_schema and name.startswith(f'{naming_schema}_sim'):
+            name = name[len(f'{naming_schema}_sim'):]
+        index['sims'][name] = s
+        index['members'][name] = []
+        big = read_big(f'{sim}/big.in')
+        longest = 0
+        with instrument.span('store.load_sim', kind=kind):
+            loaded = load_sim(kind, files, sim)
+        instrument.count('store.sims_ingested')
+        for bname, data in loaded.items():
+            n = data.shape[-1]
+            density = big.get(bname, (np.nan, np.nan))[1]
+            if bname == __binary__:
+                binaries[s, 0, :n] = s
+                binaries[s, 1, :n] = data[7]
+                binaries[s, 2, :n] = density
+                binaries[s, 3:9, :n] = data[1:7]
+                bmask[s, :n] = True
+            elif bname in index['bodies']:
+                b = index['bodies'][bname]
+                body[b, s, 0, :n] = s
+                body[b, s, 1, :n] = b
+                body[b, s, 2, :n] = data[7]
+                body[b, s, 3, :n] = density
+                body[b, s, 4:10, :n] = data[1:7]
+                mask[b, s, :n] = True
+                index['members'][name].append(bname)
+            if n > longest:
+                longest = n
+                time[s, :n] = data[0]
+        index['lengths'][name] = longest
+    for x in (binaries, body, bmask, mask, time):
+        x.flush()
+    with open(f'{store_dir}/index.json', 'w') as f:
+        json.dump(index, f)
+    return open_store(store_dir)
+
+
+def open_store(store_dir):
+    """Memory-map a store read only, returns a dict of arrays and index."""
+    store = {'index': None}
+    with open(f'{store_dir}/index.json', 'r') as f:
+        store['index'] = json.load(f)
+    for name in ('binaries', 'bodies', 'binaries_mask', 'bodies_mask',
+                 'time'):
+        store[name] = np.load(f'{store_dir}/{name}.npy', mmap_mode='r')
+    return store
+
+
+def sim_slice(store, sim):
+    """Return (time, binary, binary mask) views of one sim."""
+    s = store['index']['sims'][str(sim)]
+    return store['time'][s], store['binaries'][s], \
+        store['binaries_mask'][s]
+
+
+def body_slice(store, body, sims=None):
+    """Return (data, mask) views of one body across all or some sims."""
+    b = store['index']['bodies'][body]
+    if sims is None:
+        return store['bodies'][b], store['bodies_mask'][b]
+    rows = [store['index']['sims'][str(x)] for x in sims]
+    return store['bodies'][b, rows], store['bodies_mask'][b, rows]
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    sims = []
+    for i, nbod in enumerate((1, 2)):
+        sim = f'{tmpdir}/test_sim{i}'
+        os.makedirs(sim)
+        sims.append(sim)
+        with open(f'{sim}/big.in', 'w') as f:
+            f.write(' WB m=1.D0 r=0.D0 d=5.43D0\n')
+            for b in range(nbod):
+                f.write(f' BODY{b}    m=0.01D0 r=0.D0 d=3.D0\n')
+        for b in ['WB'] + [f'BODY{x}' for x in range(nbod)]:
+            np.save(f'{sim}/{b}.xv.npy', np.full((8, 3 + i), i + 1.))
+    store = ingest(sims, f'{tmpdir}/store', 'test')
+    assert store['binaries'].shape == (2, 9, 4)
+    assert store['bodies'].shape == (2, 2, 10, 4)
+    data, mask = body_slice(store, 'BODY1')
+    assert not mask[0].any() and mask[1].all()
+    assert np.isnan(data[0]).all() and data[1, 3, 0] == 3.
+    t, binary, bmask = sim_slice(store, 0)
+    assert bmask.sum() == 3 and binary[2, 0] == 5.43
+    assert is_current(f'{tmpdir}/store', sims)
+    np.save(f'{sims[0]}/BODY0.xv.npy', np.full((8, 5), 1.))
+    assert not is_current(f'{tmpdir}/store', sims)
+    assert not is_current(f'{tmpdir}/store', sims[1:])
+    # xv.out records are counted across chunk boundaries
+    global __chunk__
+    chunk, __chunk__ = __chunk__, 2
+    with open(f'{sims[0]}/xv.out', 'wb') as f:
+        f.write((_xv_record + b'x' * 5) * 7)
+    try:
+        assert _steps('xv', {}, sims[0]) == 7
+    finally:
+        __chunk__ = chunk
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
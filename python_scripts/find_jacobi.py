@@ -2,36 +2,56 @@
 
 # standard
 import os
-from sys import version, float_info
+import json
+from sys import version_info
+from time import sleep
 # external
-import matplotlib.pyplot as plt
 import numpy as np
-import math
-from decimal import Decimal
-
-print('Max Float Precision', float_info.max)
-
-__version__ = float(version[0:3])
+# relative modules
+from aei_reader import read_aei, tail_aei
+from aei_cache import load_aei
+from jacobi import jacobi_constant
+from decimate import envelope, binned
+import instrument
+from xv_decoder import read_xv, header as xv_header
+
+__version__ = version_info[:2]
 __cpath__ = '/'.join(os.path.realpath(__file__).split('/')[:-1])
 _filetypes = ('.aei',)
 
 __cwd__ = os.getcwd()
 
+# config overridable, parsed .aei files are kept as .npy next to the source
+use_cache = True
+cache_dir = None
+cache_max_bytes = None
+# config overridable, decode this xv.out directly instead of element6 .aei
+# files, test_particle/m2/m3 are then body names
+xv_out = None
+# config overridable, directory or file the stage timings are written to
+trace = None
+# config overridable, how the series is drawn: 'envelope' (per pixel
+# min/max), 'binned' (per pixel mean, std and min/max) or 'points' (every
+# sample); plot_bins defaults to the axes width in pixels
+plot_mode = 'envelope'
+plot_bins = None
+plot_dpi = 150
+
 
 def load_cfg(fname):
     """Load configuration file as module."""
     if '/' not in fname:
         fname = __cwd__ + '/' + fname
     try:
-        if __version__ >= 3.5:
+        if __version__ >= (3, 5):
             import importlib.util
             spec = importlib.util.spec_from_file_location("config", fname)
             cf = importlib.util.module_from_spec(spec)
             spec.loader.exec_module(cf)
-        elif __version__ >= 3.3:
+        elif __version__ >= (3, 3):
             from importlib.machinery import SourceFileLoader
             cf = SourceFileLoader("config", fname).load_module()
-        elif __version__ <= 3.0:
+        elif __version__ <= (3, 0):
             import imp
             cf = imp.load_source('config', fname)
     except:
@@ -52,127 +72,195 @@ def load_variables(mod):
             globals()[k] = getattr(mod, k)
 
 
-def _list_array(ite, dtype=np.float64):
-    """Transform list to numpy array of dtype."""
-    try:
-        _shape = tuple([len(ite), len(ite[0])][::-1])
-        _return = np.zeros(_shape, dtype=dtype)
-        for i, x in enumerate(ite):
-            for j, y in enumerate(x):
-                _return[j, i] = y
-    except TypeError as te:
-        print('Not a 2D array...')
-        _shape = len(ite)
-        _return = np.zeros(_shape, dtype=dtype)
-        for i, x in enumerate(ite):
-            _return[i] = x
-    print('Converted to shape with:',_return.shape)
-    return _return
-
-
-def _resolve_header(ite):
-    _return = []
-    for i, x in enumerate(ite):
-        if ('(' in x) and (')' in x):
-            _return[-1] = _return[-1] + x
-        else:
-            _return.append(x)
-    return _return
-
-
-def read_file(fname, _try=0):
+def read_file(fname, usecols=None):
     """Read various Mercury filetypes."""
     if not os.path.isfile(fname):
         print('File not found: ', fname)
         exit()
 
-    _max = 10
+    header = None
     try:
         if '.aei' in fname:
             """Some logic for aei."""
-            _header = 4 - _try - 1
-            _to_start = 5 - _try
-            header, data = None, []
-            with open(fname, 'r') as f:
-                for i, line in enumerate(f):
-                    _tmp = [x for x in line.strip('\n').strip(' ')
-                                           .split(' ') if x != '']
-                    if i == (_header):
-                        header = _tmp
-                    elif i > _header:
-                        data.append(_tmp)
-
+            if use_cache:
+                header, data = load_aei(fname, cache_dir=cache_dir,
+                                        max_bytes=cache_max_bytes,
+                                        usecols=usecols)
+            else:
+                header, data = read_aei(fname, usecols=usecols)
         else:
             print('Filetype not recognized. Currently supported: {}'
                   .format(','.join(_filetypes)))
             exit()
-    except UnicodeDecodeError as ue:
-        print(ue, ' while reading file... cutting file to resolve')
-        if _try == 0:
-            os.system(f'sed -i.bak "1d" {fname}')
-        else:
-            os.system(f'sed -i "1d" {fname}')
-        if _try >= _max:
-            print('Failed', _max, ' times. Restoring file and exitting')
-            os.system(f'mv -f {fname}.bak {fname}')
-            exit()
-        return None, None
     except ValueError as ve:
         print(ve, ' while reading file...')
-        print(f'try:{_try}\nHeader:{header}')
-        os.system(f'mv -f {fname}.bak {fname}')
+        print(f'Header:{header}')
         exit()
     else:
-        if os.path.isfile(f'{fname}.bak'):
-            os.system(f'mv -f {fname}.bak {fname}')
-        return _resolve_header(header), _list_array(data)
+        print('Converted to shape with:', data.shape)
+        return header, data
 
 
-def cross(a, b):
-    """Compute cross product between a, b."""
-    assert len(a) == len(b)
-    if len(a) == 3:
-        c = (a[1] * b[2] - a[2] * b[1],
-             a[2] * b[0] - a[0] * b[2],
-             a[0] * b[1] - a[1] * b[0])
-    elif len(a) == 2:
-        c = (0, 0, a[0] * b[1] - a[1] * b[0])
-    return c
+def find_jacobi(ob3, ob2):
+    """Given values, return jacobi constant.
 
+    Accepts single timesteps, (fields, steps) or (sims, fields, steps).
+    """
+    if np.ndim(ob3) == 1:
+        return jacobi_constant(np.asarray(ob3)[:, np.newaxis],
+                               np.asarray(ob2)[:, np.newaxis])[0]
+    return jacobi_constant(ob3, ob2)
 
-def dot(a, b):
-    """Compute dot product between a and b."""
-    ret = 0
-    for i in range(len(a)):
-        ret += a[i] * b[i]
-    return ret
 
+def _new_follow():
+    """Empty follow checkpoint."""
+    return {'offsets': {}, 'rows': 0,
+            'stats': {'n': 0, 'mean': 0., 'm2': 0., 'std': 0.,
+                      'first': None, 'last': None, 'min': None, 'max': None,
+                      'drift': 0., 'max_drift': 0.}}
+
+
+def _merge_stats(stats, E):
+    """Fold a batch of jacobi values into the running drift statistics."""
+    E = E[~np.isnan(E)]
+    if E.shape[0] == 0:
+        return stats
+    if stats['n'] == 0:
+        stats['first'] = stats['min'] = stats['max'] = float(E[0])
+    n_a, n_b = stats['n'], E.shape[0]
+    mean_b = np.mean(E)
+    delta = mean_b - stats['mean']
+    n = n_a + n_b
+    # pairwise update (Chan et al.) so batches of any size can be merged
+    stats['mean'] = float(stats['mean'] + delta * n_b / n)
+    stats['m2'] = float(stats['m2'] + np.sum((E - mean_b) ** 2) +
+                        delta ** 2 * n_a * n_b / n)
+    stats['n'] = int(n)
+    stats['std'] = (stats['m2'] / n) ** 0.5
+    stats['min'] = float(min(stats['min'], np.min(E)))
+    stats['max'] = float(max(stats['max'], np.max(E)))
+    drift = E / stats['first'] - 1.
+    stats['last'] = float(E[-1])
+    stats['drift'] = float(drift[-1])
+    stats['max_drift'] = float(max(stats['max_drift'],
+                                   np.max(np.abs(drift))))
+    return stats
+
+
+def follow_jacobi(state, series):
+    """Extend the jacobi series with the rows appended since the last call.
+
+    state holds the byte offset reached in each input file and the running
+    statistics, series is the binary file that (time, jacobi) pairs are
+    appended to. Only the rows present in both files are consumed, the rest
+    wait for the next call.
+    """
+    new = []
+    for fname in (m3, m2):
+        key = os.path.realpath(fname)
+        offset = state['offsets'].get(key, 0)
+        if os.path.getsize(fname) < offset:
+            print('File was truncated, restarting follow:', fname)
+            if os.path.isfile(series):
+                os.remove(series)
+            return follow_jacobi(_new_follow(), series)
+        new.append((key, tail_aei(fname, offset)))
+    (skey, (_, small, sends)), (bkey, (_, big, bends)) = new
+    steps = min(small.shape[-1], big.shape[-1])
+    if steps == 0:
+        return state
+    E = find_jacobi(small[:, :steps], big[:, :steps])
+    with open(series, 'ab') as f:
+        np.stack([small[0, :steps], E], axis=-1).tofile(f)
+    state['offsets'][skey] = int(sends[steps - 1])
+    state['offsets'][bkey] = int(bends[steps - 1])
+    state['rows'] += steps
+    _merge_stats(state['stats'], E)
+    return state
+
+
+def follow(interval=0.):
+    """Incrementally update the jacobi series, once or every interval s."""
+    checkpoint = output_dir + '/jacobi_follow.json'
+    series = output_dir + '/jacobi_follow.f8'
+    if os.path.isfile(checkpoint):
+        with open(checkpoint, 'r') as f:
+            state = json.load(f)
+    else:
+        state = _new_follow()
+    if os.path.isfile(series):
+        # drop rows appended after the last checkpoint made it to disk
+        os.truncate(series, state['rows'] * 2 * 8)
+    while True:
+        state = follow_jacobi(state, series)
+        with open(checkpoint + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(checkpoint + '.tmp', checkpoint)
+        stats = state['stats']
+        print('Rows: {} drift: {:.4e} max drift: {:.4e} normed std: {:.4e}'
+              .format(state['rows'], stats['drift'], stats['max_drift'],
+                      stats['std'] / stats['mean'] if stats['n'] else 0.))
+        if interval <= 0:
+            break
+        sleep(interval)
+    return state
+
+
+def plot_series(t, E, fname, mode=None, bins=None):
+    """Plot the normalised jacobi series, decimated to the axes pixels.
+
+    Dense layers are rasterized so the PDF size does not grow with the
+    number of samples. matplotlib is only imported here, with the Agg
+    canvas, so the other modes never pay for it.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    mode = mode or plot_mode
+    y = E / np.mean(E) - 1.
+    label = 'normed std: {0:.4}%'.format(np.std(E) / np.mean(E) * 100.)
+    fig = Figure(figsize=(10, 10), dpi=plot_dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    bins = bins or plot_bins or max(1, int(ax.bbox.width))
+    if mode == 'points':
+        ax.plot(t, y, 'b.', label=label, rasterized=True)
+    else:
+        x, lo, hi = envelope(t, y, bins)
+        if mode == 'binned':
+            x, mean, std, _ = binned(t, y, bins)
+            ax.fill_between(x, lo, hi, color='b', alpha=.2, lw=0,
+                            rasterized=True, label='min/max')
+            ax.fill_between(x, mean - std, mean + std, color='b', alpha=.4,
+                            lw=0, rasterized=True, label='std')
+            ax.plot(x, mean, 'b-', lw=.5, label=label)
+        else:
+            ax.fill_between(x, lo, hi, color='b', lw=0, rasterized=True,
+                            label=label)
+            # keeps single sample bins visible
+            ax.vlines(x, lo, hi, color='b', lw=.5, rasterized=True)
+    ax.set_xlabel('Time (Integration Units)')
+    ax.set_ylabel('Normalized Jacobi Constant')
+    ax.set_title('Jacobi Constant')
+    ax.legend()
+    fig.savefig(fname, dpi=plot_dpi)
+    return fname
+
+
+def add_arguments(parser):
+    """Add the command line options of main to an argparse parser."""
+    parser.add_argument('-i', '--input', dest='input', type=str, help='Input' +
+                        ' config file')
 
-def mag(a):
-    """Mag of a vector."""
-    ret = 0
-    for x in a:
-        ret += x ** 2
-    return (ret) ** 0.5
+    parser.add_argument('-f', '--follow', dest='follow', action='store_true',
+                        help='Only parse rows appended since the last call' +
+                        ' and update the running jacobi drift')
+    parser.add_argument('--interval', dest='interval', type=float,
+                        default=0., help='With --follow, seconds between' +
+                        ' updates. 0 updates once and exits')
+    return parser
 
 
-def find_jacobi(ob3, ob2):
-    """Given values, return jacobi constant."""
-    # https://farside.ph.utexas.edu/teaching/336k/Newtonhtml/node121.html
-    t, x, y, z, vx, vy, vz, mass3 = ob3
-    pe = -1. * mass3 / mag((x, y, z))
-    ke = 0.5 * mass3 * mag((vx, vy, vz)) ** 2
-    energy = pe + ke
-    angular_momentum = (x * vx, y * vy, z * vz)
-    t, x, y, z, vx, vy, vz, m2 = ob2
-    angular_velocity = cross((x, y, z),(vx, vy, vz)) / mag((x, y, z)) ** 2
-    # c = 2*(E-w*h)
-    #print(cross((x, y, z),(vx, vy, vz)))
-    #print(energy,angular_momentum,angular_velocity)
-    return 2. * (energy - dot(angular_momentum,angular_velocity))
-
-
-def main(fname):
+def main(fname, follow_mode=False, interval=0.):
     """Main caller for the program."""
     """Input filename for configuration file."""
     mod = load_cfg(fname)
@@ -180,55 +268,47 @@ def main(fname):
 
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
-
-    _try = 0
-    header, testdata = read_file(test_particle, _try)
-    while (not header) and (not testdata):
-        _try += 1
-        print('On try', _try + 1)
-        header, testdata = read_file(test_particle, _try)
-    _try = 0
-    header, bigdata = read_file(m2, _try)
-    while (not header) and (not bigdata):
-        _try += 1
-        print('On try', _try + 1)
-        header, bigdata = read_file(m2, _try)
-    _try = 0
-    header, smalldata = read_file(m3, _try)
-    while (not header) and (not smalldata):
-        _try += 1
-        print('On try', _try + 1)
-        header, smalldata = read_file(m3, _try)
+    if trace:
+        print('Recording timings to', instrument.enable(trace))
+
+    if follow_mode:
+        follow(interval)
+        return
+
+    if xv_out:
+        with instrument.span('jacobi.read'):
+            bodies = read_xv(xv_out)
+        for name in (test_particle, m2, m3):
+            if name not in bodies:
+                print(f'Body <{name}> not found in {xv_out}:',
+                      ', '.join(bodies))
+                exit()
+        header = xv_header
+        testdata, bigdata, smalldata = bodies[test_particle], bodies[m2], \
+            bodies[m3]
+    else:
+        with instrument.span('jacobi.read'):
+            header, testdata = read_file(test_particle)
+            header, bigdata = read_file(m2)
+            header, smalldata = read_file(m3)
 
     print('Header:', header)
     print('Data:', testdata.shape)
 
-    E = []
-    for i in range(testdata.shape[-1]):
-        # print('Row',i)
-        small_vals = smalldata[:, i]
-        big_vals = bigdata[:, i]
-        E.append(find_jacobi(small_vals, big_vals))
-
-    E = _list_array(E)
+    # bodies that are removed early stop writing rows
+    steps = min(smalldata.shape[-1], bigdata.shape[-1])
+    with instrument.span('jacobi.reduce', steps=steps):
+        E = find_jacobi(smalldata[:, :steps], bigdata[:, :steps])
     E = E[~np.isnan(E)]
     print(E)
-    t = [x for x in range(E.shape[0])]
+    t = np.arange(E.shape[0])
 
     print('Jacobi:', E.shape)
 
-    plt.figure(figsize=(10, 10))
-    if True:
-        plt.plot(t, E / np.mean(E) - 1., 'b.', label='normed std: {0:.4}%'.format(np.std(E)/np.mean(E) * 100.))
-    else:
-        plt.loglog(t, E/ np.mean(E), 'b.', label='normed std: {0:.4}%'.format(np.std(E)/np.mean(E) * 100.))
-    plt.xlabel('Time (Integration Units)')
-    plt.ylabel('Normalized Jacobi Constant')
-    plt.title('Jacobi Constant')
-    plt.legend()
-    plt.savefig(output_dir + '/jacobi.pdf')
-    np.savetxt(output_dir + '/jacobi.npy', E)
-    #plt.show()
+    with instrument.span('jacobi.plot', mode=plot_mode):
+        plot_series(t, E, output_dir + '/jacobi.pdf')
+    with instrument.span('jacobi.save'):
+        np.save(output_dir + '/jacobi.npy', E)
 
 if __name__ == '__main__':
     import argparse
@@ -236,12 +316,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This programs finds the' +
                                      ' Jacobi constant given the appropriate' +
                                      ' files.')
+    args = add_arguments(parser).parse_args()
 
-    parser.add_argument('-i', '--input', dest='input', type=str, help='Input' +
-                        ' config file')
-
-    args = parser.parse_args()
-
-    main(args.input)
+    main(args.input, args.follow, args.interval)
 
 # end of file
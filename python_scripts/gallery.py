@@ -0,0 +1,344 @@
+"""Incremental orbit frames and animated thumbnail GIFs of a sweep."""
+
+# internal modules
+import os
+import json
+import hashlib
+from glob import glob
+from argparse import ArgumentParser as ap
+from concurrent.futures import ProcessPoolExecutor
+
+# external modules
+import numpy as np
+
+# relative modules
+import instrument
+from aei_cache import file_identity
+from ensemble_store import sim_sources, load_sim
+
+# global attributes
+__all__ = ('test', 'frame_key', 'render_frame', 'write_gif', 'splice_gifs',
+           'refresh')
+__doc__ = """Replacement for thumbnail_gifgen.sh and sshfeed.sh.
+
+Every sim gets one frame, the x-y tracks of its bodies drawn with the Agg
+canvas in a process pool. A frame is keyed by the identity (size, mtime,
+edge hash) of the sim's outputs and the drawing options; frames.json in the
+gallery directory maps each sim to the key its frame was drawn from, so a
+refresh only draws the sims that are new or whose outputs changed. Frames
+are grouped by sim number range, sim n of a sweep goes to chunk n // chunk
+written as chunk_<sweep>-<k>.gif, so sims finishing out of order only
+rebuild their own chunks; a chunk is rebuilt when one of its frames
+changed. The full thumbnail.gif is then spliced from the chunk GIFs byte
+wise, every chunk's global palette becomes the local palette of its
+frames, so no frame is decoded again."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__index__ = 'frames.json'
+__chunks__ = 'chunks.json'
+_options = {'size': 2., 'dpi': 100, 'max_points': 2000, 'extent': None}
+
+
+def _sim_order(sim):
+    """Sort key (sweep, sim number, name) of a <schema>_sim<sweep>-<n> dir."""
+    name = os.path.basename(os.path.normpath(sim))
+    sweep, _, number = name.split('sim')[-1].rpartition('-')
+    digits = ''.join(x for x in number if x.isdigit())
+    return (sweep, int(digits) if digits else -1, name)
+
+
+def _chunk(sim, chunk):
+    """Chunk label of a sim, its sweep and sim number // chunk."""
+    sweep, number, _ = _sim_order(sim)
+    k = max(number, 0) // chunk
+    return f'{sweep}-{k}' if sweep else str(k)
+
+
+def frame_key(sim, options):
+    """Hash of the sim's output identities and the drawing options."""
+    kind, files = sim_sources(sim)
+    if kind is None:
+        return None
+    if kind == 'xv':
+        files = {'xv.out': f'{sim}/xv.out'}
+    h = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for name in sorted(files):
+        h.update(name.encode())
+        h.update(json.dumps(file_identity(files[name]),
+                            sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def render_frame(args):
+    """Pool entry point: (sim, fname, options) -> fname, draws one frame."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    sim, fname, options = args
+    with instrument.span('gallery.load'):
+        kind, files = sim_sources(sim)
+        bodies = load_sim(kind, files, sim)
+    fig = Figure(figsize=(options['size'], options['size']),
+                 dpi=options['dpi'])
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0., 0., 1., 1.))
+    extent = options['extent'] or 0.
+    for name in sorted(bodies):
+        data = bodies[name]
+        stride = max(1, data.shape[-1] // options['max_points'])
+        x, y = np.asarray(data[1, ::stride]), np.asarray(data[2, ::stride])
+        ax.plot(x, y, lw=.5)
+        if not options['extent'] and x.shape[0]:
+            extent = max(extent, np.nanmax(np.abs(x)), np.nanmax(np.abs(y)))
+    extent = extent or 1.
+    ax.plot([0.], [0.], 'k*', ms=4)
+    ax.set_xlim(-extent, extent)
+    ax.set_ylim(-extent, extent)
+    ax.set_aspect('equal')
+    ax.set_axis_off()
+    ax.text(.02, .98, os.path.basename(os.path.normpath(sim)), fontsize=5,
+            va='top', transform=ax.transAxes)
+    with instrument.span('gallery.draw'):
+        fig.savefig(f'{fname}.tmp.png', facecolor='white')
+    os.replace(f'{fname}.tmp.png', fname)
+    return fname
+
+
+def write_gif(fname, frames, delay=20):
+    """Write frames (png paths) as one animated GIF, delay in 1/100 s."""
+    from PIL import Image
+    images = [Image.open(x).convert('RGB').quantize(
+        method=Image.Quantize.MEDIANCUT) for x in frames]
+    images[0].save(f'{fname}.tmp', format='GIF', save_all=True,
+                   append_images=images[1:], duration=10 * delay, loop=0)
+    os.replace(f'{fname}.tmp', fname)
+    return fname
+
+
+def _sub_blocks(buf, i):
+    """Index just past a chain of data sub-blocks starting at i."""
+    while buf[i]:
+        i += buf[i] + 1
+    return i + 1
+
+
+def _gif_frames(buf):
+    """Split a GIF into (screen flags, global palette, [(ext, image)])."""
+    if buf[:3] != b'GIF':
+        raise ValueError('Not a GIF file')
+    packed = buf[10]
+    i = 13
+    palette = b''
+    if packed & 0x80:
+        palette = buf[i:i + 3 * 2 ** ((packed & 7) + 1)]
+        i += len(palette)
+    frames, ext = [], b''
+    while i < len(buf) and buf[i] != 0x3b:
+        if buf[i] == 0x21:
+            end = _sub_blocks(buf, i + 2)
+            # the loop count is written once for the whole file
+            if buf[i + 1] != 0xff:
+                ext += buf[i:end]
+            i = end
+        elif buf[i] == 0x2c:
+            flags = buf[i + 9]
+            end = i + 10
+            if flags & 0x80:
+                end += 3 * 2 ** ((flags & 7) + 1)
+            end = _sub_blocks(buf, end + 1)
+            frames.append((ext, buf[i:end]))
+            ext, i = b'', end
+        else:
+            raise ValueError(f'Unexpected GIF block {buf[i]:#x} at {i}')
+    return packed, palette, frames
+
+
+def splice_gifs(fname, chunks):
+    """Concatenate animated GIFs without decoding them, returns frames."""
+    out, n = None, 0
+    for chunk in chunks:
+        with open(chunk, 'rb') as f:
+            buf = f.read()
+        packed, palette, frames = _gif_frames(buf)
+        if out is None:
+            # header and screen descriptor without a global palette
+            out = bytearray(buf[:10] + bytes([packed & 0x70]) + buf[11:13])
+            out += b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+        for ext, image in frames:
+            out += ext
+            if image[9] & 0x80 or not palette:
+                out += image
+            else:
+                size = (packed & 7)
+                out += image[:9] + bytes([image[9] | 0x80 | size]) + \
+                    palette + image[10:]
+            n += 1
+    out += b'\x3b'
+    with open(f'{fname}.tmp', 'wb') as f:
+        f.write(out)
+    os.replace(f'{fname}.tmp', fname)
+    return n
+
+
+def _read_json(fname):
+    """Dict from a JSON file, empty when missing."""
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def _write_json(fname, data):
+    """Replace a JSON file atomically."""
+    with open(f'{fname}.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(f'{fname}.tmp', fname)
+
+
+def refresh(sims, outdir, workers=None, chunk=100, delay=20, **options):
+    """Bring the frames, chunk GIFs and thumbnail.gif of sims up to date.
+
+    Returns (frames drawn, chunks written).
+    """
+    options = dict(_options, **options)
+    os.makedirs(f'{outdir}/frames', exist_ok=True)
+    index = _read_json(f'{outdir}/{__index__}')
+    sims = sorted((os.path.abspath(x) for x in sims), key=_sim_order)
+    keys, todo = {}, []
+    with instrument.span('gallery.keys', sims=len(sims)):
+        for sim in sims:
+            key = frame_key(sim, options)
+            if key is None:
+                continue
+            name = os.path.basename(sim)
+            fname = f'{outdir}/frames/thumbnail_{name}.png'
+            keys[name] = key
+            if index.get(name, {}).get('key') != key or \
+                    not os.path.isfile(fname):
+                todo.append((sim, fname, options))
+    if todo:
+        with instrument.span('gallery.frames', frames=len(todo)), \
+                ProcessPoolExecutor(max_workers=workers) as pool:
+            for (sim, fname, _), _ in zip(todo, pool.map(render_frame,
+                                                         todo)):
+                name = os.path.basename(sim)
+                index[name] = {'key': keys[name], 'frame': fname}
+        _write_json(f'{outdir}/{__index__}', index)
+    parts = {}
+    for sim in sims:
+        name = os.path.basename(sim)
+        if name in keys:
+            parts.setdefault(_chunk(sim, chunk), []).append(name)
+    built = _read_json(f'{outdir}/{__chunks__}')
+    written, gifs = 0, []
+    for label, part in parts.items():
+        key = hashlib.sha1(json.dumps(
+            [delay] + [(x, keys[x]) for x in part]).encode()).hexdigest()
+        gif = f'{outdir}/chunk_{label}.gif'
+        gifs.append(gif)
+        if built.get(label) == key and os.path.isfile(gif):
+            continue
+        with instrument.span('gallery.chunk', frames=len(part)):
+            write_gif(gif, [index[x]['frame'] for x in part], delay)
+        built[label] = key
+        written += 1
+    for label in set(built) - set(parts):
+        built.pop(label)
+        if os.path.isfile(f'{outdir}/chunk_{label}.gif'):
+            os.remove(f'{outdir}/chunk_{label}.gif')
+    _write_json(f'{outdir}/{__chunks__}', built)
+    if gifs and (written or todo or
+                 not os.path.isfile(f'{outdir}/thumbnail.gif')):
+        with instrument.span('gallery.splice', chunks=len(gifs)):
+            splice_gifs(f'{outdir}/thumbnail.gif', gifs)
+    return len(todo), written
+
+
+def main(cfgname_plotter, cfgname_job, workers=None):
+    """Main caller function."""
+    from nkrpy.load import load_cfg
+    cfg_p = load_cfg(cfgname_plotter)
+    cfg_j = load_cfg(cfgname_job)
+    sims = [x for x in glob(f'{cfg_p.file_location}/'
+                            f'{cfg_j.naming_schema}_sim*')
+            if os.path.isdir(x)]
+    outdir = getattr(cfg_p, 'gallery_location',
+                     f'{cfg_p.file_location}/plot_orbital')
+    drawn, chunks = refresh(
+        sims, outdir, workers or getattr(cfg_p, 'gallery_workers', None),
+        getattr(cfg_p, 'gallery_chunk', 100),
+        getattr(cfg_p, 'gallery_delay', 20),
+        size=getattr(cfg_p, 'gallery_size', _options['size']),
+        dpi=getattr(cfg_p, 'gallery_dpi', _options['dpi']),
+        extent=getattr(cfg_p, 'gallery_extent', None))
+    print(f'{len(sims)} sims: drew {drawn} frames, wrote {chunks} chunks, '
+          f'<{outdir}/thumbnail.gif>')
+    pass
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    from PIL import Image
+    tmpdir = tempfile.mkdtemp()
+    t = np.linspace(0., 2. * np.pi, 50)
+
+    def write_sim(i, scale=1.):
+        sim = f'{tmpdir}/test_sim{i}'
+        os.makedirs(sim, exist_ok=True)
+        for b, a in (('WB', 5.), ('BODY0', 1. + i / 10.)):
+            data = np.zeros((8, t.shape[0]))
+            data[1], data[2] = a * scale * np.cos(t), a * scale * np.sin(t)
+            np.save(f'{sim}/{b}.xv.npy', data)
+        return sim
+
+    # sims finish out of order, sim 2 is not there yet
+    sims = [write_sim(i) for i in (0, 1, 3, 4)]
+    out = f'{tmpdir}/gallery'
+    assert refresh(sims, out, workers=2, chunk=2, size=1.) == (4, 3)
+    with Image.open(f'{out}/thumbnail.gif') as im:
+        assert im.n_frames == 4 and im.size == (100, 100)
+    # nothing changed, nothing is drawn
+    assert refresh(sims, out, workers=2, chunk=2, size=1.) == (0, 0)
+    # a new last sim only adds its frame and builds its chunk
+    sims.append(write_sim(5))
+    assert refresh(sims, out, workers=2, chunk=2, size=1.) == (1, 1)
+    # a middle sim only rebuilds its own chunk, not every later one
+    stamps = {x: os.path.getmtime(f'{out}/chunk_{x}.gif') for x in '02'}
+    sims.append(write_sim(2))
+    assert refresh(sims, out, workers=2, chunk=2, size=1.) == (1, 1)
+    assert stamps == {x: os.path.getmtime(f'{out}/chunk_{x}.gif')
+                      for x in '02'}
+    # changed outputs redraw that sim only
+    write_sim(0, 2.)
+    assert refresh(sims, out, workers=2, chunk=2, size=1.) == (1, 1)
+    with Image.open(f'{out}/thumbnail.gif') as im:
+        assert im.n_frames == 6 and im.info['loop'] == 0
+        im.seek(5)
+        assert im.info['duration'] == 200
+        im.convert('RGB')
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    parser = ap()
+    parser.add_argument('-p', help='plotter configuration file',
+                        default='configuration_plotter.py')
+    parser.add_argument('-j', help='job configuration file',
+                        default='configuration_jobsubmission.py')
+    parser.add_argument('-n', help='processes drawing frames', type=int,
+                        default=None)
+    parser.add_argument('--test', help='run the module test',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        main(args.p, args.j, args.n)
+
+# end of code
@@ -0,0 +1,227 @@
+"""Named timing spans and counters written as JSON lines."""
+
+# internal modules
+import os
+import json
+import contextlib
+from argparse import ArgumentParser as ap
+from time import perf_counter, time
+
+# external modules
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'enable', 'disable', 'enabled', 'span', 'count',
+           'summary', 'print_summary')
+__doc__ = """Stage level instrumentation.
+
+    with instrument.span('submit.sbatch'):
+        ...
+    instrument.count('submit.sbatch_retries')
+
+Disabled (the default) span returns one shared no-op context manager and
+count returns at once, so the calls can stay in production code. enable
+opens the run's JSON-lines file, every event is one line written with a
+single append so forked and spawned workers can share the file; the path
+is also put in the environment (__env__) so worker processes started later
+enable themselves on import. A span event holds name, seconds and the
+start time, a count event name and value, both carry the pid and any
+keyword attributes. summary aggregates one or more files into per name
+n, total, p50, p95 and max seconds for spans and n, total for counters."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__env__ = 'MERCURY_TRACE'
+_fd = None
+_null = contextlib.nullcontext()
+
+
+def enabled():
+    """Whether events are being recorded."""
+    return _fd is not None
+
+
+def enable(path, run=None):
+    """Record events to path, a directory gets trace_<run>.jsonl.
+
+    Returns the file name.
+    """
+    global _fd
+    disable()
+    if os.path.isdir(path):
+        run = run or str(time()).replace('.', '_')
+        path = os.path.join(path, f'trace_{run}.jsonl')
+    _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.environ[__env__] = path
+    return path
+
+
+def disable():
+    """Stop recording."""
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+    os.environ.pop(__env__, None)
+
+
+def _write(event):
+    """Append one event line."""
+    event['pid'] = os.getpid()
+    os.write(_fd, (json.dumps(event, default=str) + '\n').encode())
+
+
+class _Span(object):
+    """Times its with block."""
+
+    __slots__ = ('name', 'attrs', 'start')
+
+    def __init__(self, name, attrs):
+        """Name and attributes of the span."""
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        """Start the clock."""
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        """Write the span, marked failed when the block raised."""
+        seconds = perf_counter() - self.start
+        if _fd is not None:
+            event = dict(self.attrs, type='span', name=self.name,
+                         seconds=seconds, time=time() - seconds)
+            if kind is not None:
+                event['error'] = kind.__name__
+            _write(event)
+        return False
+
+
+def span(name, **attrs):
+    """Context manager timing a named stage."""
+    if _fd is None:
+        return _null
+    return _Span(name, attrs)
+
+
+def count(name, value=1, **attrs):
+    """Add value to a named counter."""
+    if _fd is None:
+        return
+    _write(dict(attrs, type='count', name=name, value=value))
+
+
+def summary(fnames):
+    """Aggregate event files, returns {'spans': {...}, 'counts': {...}}."""
+    import numpy as np
+    spans, counts = {}, {}
+    for fname in fnames:
+        with open(fname, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # a worker killed mid write leaves a partial line
+                    continue
+                if event.get('type') == 'span':
+                    spans.setdefault(event['name'], []).append(
+                        event['seconds'])
+                elif event.get('type') == 'count':
+                    counts.setdefault(event['name'], []).append(
+                        event['value'])
+    ret = {'spans': {}, 'counts': {}}
+    for name, x in spans.items():
+        x = np.asarray(x)
+        p50, p95 = np.percentile(x, (50, 95))
+        ret['spans'][name] = {'n': int(x.shape[0]), 'total': float(x.sum()),
+                              'p50': float(p50), 'p95': float(p95),
+                              'max': float(x.max())}
+    for name, x in counts.items():
+        ret['counts'][name] = {'n': len(x), 'total': sum(x)}
+    return ret
+
+
+def print_summary(stats):
+    """Print a summary as two tables, slowest stages first."""
+    spans = sorted(stats['spans'].items(), key=lambda x: -x[1]['total'])
+    if spans:
+        print(f'{"span":32s} {"n":>8s} {"total s":>10s} {"p50 s":>10s} '
+              f'{"p95 s":>10s} {"max s":>10s}')
+    for name, x in spans:
+        print(f'{name:32s} {x["n"]:8d} {x["total"]:10.3f} {x["p50"]:10.4f} '
+              f'{x["p95"]:10.4f} {x["max"]:10.4f}')
+    if stats['counts']:
+        print(f'{"counter":32s} {"n":>8s} {"total":>12s}')
+    for name, x in sorted(stats['counts'].items()):
+        print(f'{name:32s} {x["n"]:8d} {x["total"]:12g}')
+    pass
+
+
+if os.environ.get(__env__):
+    # started by an instrumented parent
+    enable(os.environ[__env__])
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    import multiprocessing
+    disable()
+    assert span('x') is _null and count('x') is None
+    tmpdir = tempfile.mkdtemp()
+    fname = enable(tmpdir, 'test')
+    assert fname == f'{tmpdir}/trace_test.jsonl' and enabled()
+    for i in range(20):
+        with span('stage', sim=i):
+            pass
+    try:
+        with span('stage'):
+            raise KeyError
+    except KeyError:
+        pass
+    count('retries', 2)
+
+    def child():
+        count('retries', 3)
+    proc = multiprocessing.get_context('fork').Process(target=child)
+    proc.start()
+    proc.join()
+    disable()
+    with span('stage'):
+        count('retries')
+    with open(fname, 'a') as f:
+        f.write('{"type": "sp')
+    stats = summary([fname])
+    assert stats['spans']['stage']['n'] == 21
+    assert stats['counts']['retries'] == {'n': 2, 'total': 5}
+    assert stats['spans']['stage']['p95'] <= stats['spans']['stage']['max']
+    with open(fname) as f:
+        assert sum('"error": "KeyError"' in x for x in f) == 1
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    parser = ap()
+    parser.add_argument('files', help='event files to summarise', nargs='*')
+    parser.add_argument('--json', help='print the summary as JSON',
+                        action='store_true')
+    parser.add_argument('--test', help='run the module test',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        stats = summary(args.files)
+        if args.json:
+            print(json.dumps(stats, indent=1))
+        else:
+            print_summary(stats)
+
+# end of code
@@ -0,0 +1,79 @@
+"""Vectorized Jacobi constant for Mercury outputs."""
+
+# internal modules
+
+# external modules
+import numpy as np
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'jacobi_constant')
+__doc__ = """Batched replacement for the per timestep find_jacobi loops.
+
+Inputs are laid out like read_aei output, fields along the second to last
+axis and timesteps along the last: (t, x, y, z, vx, vy, vz, mass) x steps.
+A leading sims axis can be stacked on so a whole ensemble is reduced in one
+pass."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+
+def _fields(ob):
+    """Split an (..., 8, steps) array into position, velocity and mass."""
+    ob = np.asarray(ob, dtype=np.float64)
+    if ob.shape[-2] < 8:
+        raise ValueError(f'Expected at least 8 fields, got {ob.shape[-2]}')
+    return ob[..., 1:4, :], ob[..., 4:7, :], ob[..., 7, :]
+
+
+def jacobi_constant(ob3, ob2):
+    """Given the test particle and perturber series, return jacobi constant.
+
+    ob3 and ob2 are (fields, steps) or (sims, fields, steps) arrays and the
+    result is (steps,) or (sims, steps) respectively.
+    """
+    # https://farside.ph.utexas.edu/teaching/336k/Newtonhtml/node121.html
+    r3, v3, mass3 = _fields(ob3)
+    r2, v2, _ = _fields(ob2)
+    pe = -1. * mass3 / np.sqrt(np.einsum('...ij,...ij->...j', r3, r3))
+    ke = 0.5 * mass3 * np.einsum('...ij,...ij->...j', v3, v3)
+    energy = pe + ke
+    angular_momentum = r3 * v3
+    angular_velocity = np.cross(r2, v2, axis=-2) / \
+        np.einsum('...ij,...ij->...j', r2, r2)[..., np.newaxis, :]
+    # c = 2*(E-w*h)
+    return 2. * (energy - np.einsum('...ij,...ij->...j', angular_momentum,
+                                    angular_velocity))
+
+
+def test():
+    """Testing function for module."""
+    rng = np.random.default_rng(0)
+    ob3 = rng.normal(size=(8, 5))
+    ob2 = rng.normal(size=(8, 5))
+    ret = jacobi_constant(ob3, ob2)
+    for i in range(ob3.shape[-1]):
+        t, x, y, z, vx, vy, vz, m3 = ob3[:, i]
+        t, bx, by, bz, bvx, bvy, bvz, m2 = ob2[:, i]
+        energy = -m3 / np.sqrt(x ** 2 + y ** 2 + z ** 2) + \
+            0.5 * m3 * (vx ** 2 + vy ** 2 + vz ** 2)
+        w = np.cross((bx, by, bz), (bvx, bvy, bvz)) / \
+            (bx ** 2 + by ** 2 + bz ** 2)
+        expect = 2. * (energy - np.dot((x * vx, y * vy, z * vz), w))
+        assert np.isclose(ret[i], expect)
+    stacked = jacobi_constant(np.stack([ob3, ob3]), np.stack([ob2, ob2]))
+    assert stacked.shape == (2, 5)
+    assert np.allclose(stacked[1], ret)
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,190 @@
+"""On-disk SQLite ledger of the sims of a sweep."""
+
+# internal modules
+import json
+import sqlite3
+from time import time
+
+# external modules
+import numpy as np
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'Ledger', 'states')
+__doc__ = """Resumable record of every sim of every sweep.
+
+One row per (sweep, sim number) holds the parameters, the sim directory,
+the Slurm job id and the current state, every state change is appended to
+a transitions table with its timestamp. Writes are buffered and committed
+in batches inside one transaction. incomplete() answers which sims of a
+sweep still need work with a single indexed query."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+states = ('generated', 'submitted', 'running', 'finished', 'failed',
+          'skipped')
+_done = ('finished', 'skipped')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    sweep TEXT PRIMARY KEY, total INTEGER, created REAL);
+CREATE TABLE IF NOT EXISTS sims (
+    sweep TEXT, sim INTEGER, modelnum TEXT, directory TEXT, params TEXT,
+    job_id TEXT, state TEXT, updated REAL, PRIMARY KEY (sweep, sim));
+CREATE INDEX IF NOT EXISTS sims_state ON sims (sweep, state);
+CREATE TABLE IF NOT EXISTS transitions (
+    sweep TEXT, sim INTEGER, state TEXT, job_id TEXT, time REAL);
+"""
+
+_upsert = """
+INSERT INTO sims (sweep, sim, modelnum, directory, params, job_id, state,
+                  updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (sweep, sim) DO UPDATE SET
+    modelnum = coalesce(excluded.modelnum, modelnum),
+    directory = coalesce(excluded.directory, directory),
+    params = coalesce(excluded.params, params),
+    job_id = coalesce(excluded.job_id, job_id),
+    state = excluded.state, updated = excluded.updated
+"""
+
+
+def _json(params):
+    """Serialise a cfg.sub style dict, numpy arrays included."""
+    if params is None:
+        return None
+    return json.dumps(params, default=lambda x: np.asarray(x).tolist())
+
+
+class Ledger(object):
+    """Buffered writer and reader of the ledger database."""
+
+    def __init__(self, fname, batch=256):
+        """Open or create the ledger at fname."""
+        self.fname = fname
+        self.batch = batch
+        self._rows = []
+        self._moves = []
+        self.db = sqlite3.connect(fname)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(_schema)
+
+    def start(self, sweep, total):
+        """Register a sweep, keeps the original total when resuming."""
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO sweeps VALUES (?, ?, ?)',
+                            (str(sweep), total, time()))
+
+    def total(self, sweep):
+        """Number of sims the sweep was started with, None if unknown."""
+        row = self.db.execute('SELECT total FROM sweeps WHERE sweep = ?',
+                              (str(sweep),)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, sweep, sim, state, modelnum=None, directory=None,
+               params=None, job_id=None):
+        """Queue a state change, committed with the next batch."""
+        now = time()
+        job_id = None if job_id is None else str(job_id)
+        self._rows.append((str(sweep), int(sim), modelnum, directory,
+                           _json(params), job_id, state, now))
+        self._moves.append((str(sweep), int(sim), state, job_id, now))
+        if len(self._rows) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Commit the queued changes in one transaction."""
+        if not self._rows:
+            return
+        with self.db:
+            self.db.executemany(_upsert, self._rows)
+            self.db.executemany('INSERT INTO transitions VALUES '
+                                '(?, ?, ?, ?, ?)', self._moves)
+        self._rows, self._moves = [], []
+
+    def incomplete(self, sweep):
+        """Return [(sim, modelnum, directory, job_id, state)] still to do.
+
+        Finished sims and sims skipped by the stability screen are done.
+        """
+        self.flush()
+        return self.db.execute(
+            'SELECT sim, modelnum, directory, job_id, state FROM sims '
+            'WHERE sweep = ? AND state NOT IN (?, ?) ORDER BY sim',
+            (str(sweep), *_done)).fetchall()
+
+    def known(self, sweep):
+        """Set of sim numbers of a sweep present in the ledger."""
+        self.flush()
+        return {x[0] for x in self.db.execute(
+            'SELECT sim FROM sims WHERE sweep = ?', (str(sweep),))}
+
+    def counts(self, sweep):
+        """Return {state: number of sims} of a sweep."""
+        self.flush()
+        return dict(self.db.execute(
+            'SELECT state, count(*) FROM sims WHERE sweep = ? '
+            'GROUP BY state', (str(sweep),)).fetchall())
+
+    def directories(self):
+        """Return [(sweep, sim, directory, job_id)] of every built sim."""
+        self.flush()
+        return self.db.execute(
+            'SELECT sweep, sim, directory, job_id FROM sims WHERE '
+            'directory IS NOT NULL ORDER BY updated').fetchall()
+
+    def params(self, sweep, sim):
+        """Return the stored parameters of a sim."""
+        self.flush()
+        row = self.db.execute('SELECT params FROM sims WHERE sweep = ? AND '
+                              'sim = ?', (str(sweep), int(sim))).fetchone()
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.db.close()
+
+
+def test():
+    """Testing function for module."""
+    import os
+    import tempfile
+    fname = os.path.join(tempfile.mkdtemp(), 'ledger.sqlite')
+    ledger = Ledger(fname, batch=4)
+    ledger.start('0', 5)
+    for i in range(5):
+        ledger.record('0', i, 'generated', f'0-{i}', f'/tmp/sim0-{i}',
+                      {'masses': np.arange(3.)})
+    ledger.record('0', 1, 'submitted', job_id=11)
+    ledger.record('0', 1, 'finished')
+    ledger.record('0', 2, 'submitted', job_id=12)
+    ledger.record('0', 5, 'skipped', params={'screen': 'skip-stable'})
+    ledger.close()
+    ledger = Ledger(fname)
+    ledger.start('0', 10)
+    assert ledger.total('0') == 5
+    todo = ledger.incomplete('0')
+    assert [x[0] for x in todo] == [0, 2, 3, 4]
+    assert todo[1] == (2, '0-2', '/tmp/sim0-2', '12', 'submitted')
+    assert ledger.counts('0') == {'generated': 3, 'submitted': 1,
+                                  'finished': 1, 'skipped': 1}
+    assert ledger.params('0', 1) == {'masses': [0., 1., 2.]}
+    assert ledger.known('0') == set(range(6))
+    assert ledger.directories()[-1] == ('0', 2, '/tmp/sim0-2', '12')
+    n = ledger.db.execute('SELECT count(*) FROM transitions').fetchone()[0]
+    assert n == 9
+    ledger.close()
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,186 @@
+"""Shared, cached Slurm job status."""
+
+# internal modules
+import os
+import getpass
+import subprocess
+import threading
+from time import time
+
+# external modules
+
+# relative modules
+import instrument
+
+# global attributes
+__all__ = ('test', 'username', 'poll_queue', 'poll_accounting',
+           'StatusCache', 'status_cache', 'check_status')
+__doc__ = """One scheduler query per poll interval for any number of jobs.
+
+poll_queue runs a single squeue in a machine readable format and returns a
+job id -> state map. StatusCache keeps that map for ttl seconds and is
+shared by every caller (it is thread safe), so checking N jobs costs one
+squeue per interval rather than 2N subprocesses. The user name is resolved
+once per process."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__ttl__ = 30.
+_user = None
+
+
+def username():
+    """Return the current user, resolved once."""
+    global _user
+    if _user is None:
+        try:
+            _user = getpass.getuser()
+        except Exception:
+            _user = subprocess.run(['whoami'], stdout=subprocess.PIPE)\
+                .stdout.decode('utf-8').strip()
+    return _user
+
+
+def _parse(text):
+    """Parse 'jobid|state' lines into a map, array tasks keep their id."""
+    ret = {}
+    for line in text.splitlines():
+        if '|' not in line:
+            continue
+        job, state = line.split('|', 1)
+        job, state = job.strip(), state.strip().split(' ')[0]
+        ret[job] = state
+    return ret
+
+
+def poll_queue(user=None, squeue='squeue'):
+    """Return {job id: state} of the user's queued and running jobs.
+
+    Returns None when squeue itself fails so callers can keep the old map.
+    """
+    with instrument.span('status.squeue'):
+        run = subprocess.run([squeue, '-h', '-u', user or username(),
+                              '-o', '%i|%T'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if run.returncode != 0:
+        print('squeue failed:', run.stderr.decode('utf-8').strip())
+        return None
+    return _parse(run.stdout.decode('utf-8'))
+
+
+def poll_accounting(user=None, sacct='sacct', since=None):
+    """Return {job id: state} from sacct, including finished jobs."""
+    cmd = [sacct, '-n', '-X', '-P', '-u', user or username(),
+           '-o', 'JobID,State']
+    if since:
+        cmd += ['-S', since]
+    run = subprocess.run(cmd, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    if run.returncode != 0:
+        print('sacct failed:', run.stderr.decode('utf-8').strip())
+        return None
+    return _parse(run.stdout.decode('utf-8'))
+
+
+class StatusCache(object):
+    """Job state map refreshed at most once every ttl seconds.
+
+    A failed poll keeps the last map. Until one poll succeeded the states
+    are unknown: states() and pending() return None and every job is in
+    the 'UNKNOWN' state, never reported as finished.
+    """
+
+    def __init__(self, ttl=__ttl__, squeue='squeue', user=None):
+        """Set up an empty cache."""
+        self.ttl = ttl
+        self.squeue = squeue
+        self.user = user
+        self._states = None
+        self._parents = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def states(self):
+        """Return the job state map (None while unknown), polling if stale."""
+        with self._lock:
+            if self._stamp is None or time() - self._stamp >= self.ttl:
+                states = poll_queue(self.user, self.squeue)
+                if states is not None:
+                    self._states = states
+                    # let the parent id of array tasks match too
+                    self._parents = {k.split('_')[0]: v
+                                     for k, v in states.items()}
+                self._stamp = time()
+            return self._states
+
+    def state(self, jobnum):
+        """Return the state of a job, None once it left the queue."""
+        jobnum = str(jobnum)
+        states = self.states()
+        if states is None:
+            return 'UNKNOWN'
+        state = states.get(jobnum)
+        return self._parents.get(jobnum) if state is None else state
+
+    def pending(self):
+        """Number of our jobs still waiting in the queue, None if unknown."""
+        states = self.states()
+        if states is None:
+            return None
+        return sum(1 for x in states.values() if x == 'PENDING')
+
+    def invalidate(self):
+        """Force the next lookup to poll the scheduler."""
+        with self._lock:
+            self._stamp = None
+
+
+status_cache = StatusCache()
+
+
+def check_status(jobnum, cache=None):
+    """Check jobstatus, True while the job is queued or running."""
+    if (cache or status_cache).state(jobnum) is not None:
+        return True
+    print('Job finished:', jobnum)
+    return False
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    fake = f'{tmpdir}/squeue'
+    with open(fake, 'w') as f:
+        f.write('#!/bin/sh\necho x >> "{}/calls"\n'.format(tmpdir) +
+                'echo "101|RUNNING"\necho "102|PENDING"\n'
+                'echo "103_[4-9%2]|PENDING"\n')
+    os.chmod(fake, 0o755)
+    # a failing first poll leaves the jobs unknown, not finished
+    with open(f'{tmpdir}/broken', 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(f'{tmpdir}/broken', 0o755)
+    cache = StatusCache(ttl=60., squeue=f'{tmpdir}/broken', user='nobody')
+    assert check_status(101, cache) and cache.pending() is None
+    cache = StatusCache(ttl=60., squeue=fake, user='nobody')
+    assert check_status(101, cache) and check_status('103', cache)
+    assert not check_status(104, cache)
+    assert cache.pending() == 2
+    with open(f'{tmpdir}/calls') as f:
+        assert len(f.read().split()) == 1
+    cache.invalidate()
+    cache.state(101)
+    with open(f'{tmpdir}/calls') as f:
+        assert len(f.read().split()) == 2
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
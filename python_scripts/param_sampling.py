@@ -0,0 +1,317 @@
+"""Vectorized sampling of the initial conditions for a batch of sims."""
+
+# internal modules
+
+# external modules
+import numpy as np
+from nkrpy.constants import kepler
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'sample_sims', 'sample_each', 'sample_block', 'sim_params',
+           'block_seed', 'block_size', 'kepler_to_xyz', 'sample_plummer',
+           'sim_dtype', 'body_dtype')
+__doc__ = """Draw the parameters of N sims in one pass.
+
+sample_sims returns two structured arrays: one row per sim (central and
+binary mass, binary orbit, number of bodies and where its bodies start)
+and one row per body (owning sim, index within the sim, cartesian orbit,
+mass and density). Bodies are stored ragged, the bodies of sim i are
+bodies[sims['body_start'][i]:][:sims['num_bodies'][i]].
+
+The sims of a sweep are drawn in fixed blocks of cfg.sample_block (1024)
+sim numbers, each block vectorized from its own stream of the sweep seed.
+sample_each picks any set of sims out of their blocks, a sim only depends
+on the seed, the block size and its number.
+
+Orbits are drawn uniformly in semi-major axis, eccentricity and inclination
+between the configured bounds with uniform angles, and converted to
+cartesian positions and velocities around the central mass.
+
+With plummer_model the passing star TESTP of every sim is drawn from a
+Plummer sphere of cluster_mass and scale radius cluster_radius: radius by
+inverting the cumulative mass profile, speed from the distribution function
+by rejection, both directions isotropic (Aarseth, Henon & Wielen 1974).
+Positions are in AU, velocities in AU/day."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+__block__ = 1024
+
+sim_dtype = np.dtype([('sim', np.int64), ('central_mass', np.float64),
+                      ('binary_mass', np.float64),
+                      ('binary_orbit', np.float64, (6,)),
+                      ('num_bodies', np.int64), ('body_start', np.int64),
+                      ('testp', np.float64, (6,)),
+                      ('plum_mass_enc', np.float64),
+                      ('plum_radius', np.float64)])
+body_dtype = np.dtype([('sim', np.int64), ('index', np.int64),
+                       ('orbit', np.float64, (6,)),
+                       ('mass', np.float64), ('density', np.float64)])
+
+
+def _eccentric_anomaly(mean, ecc, tol=1e-14, maxiter=50):
+    """Solve Kepler's equation for arrays of mean anomaly and e < 1."""
+    E = np.where(ecc < 0.8, mean, np.pi)
+    for i in range(maxiter):
+        dE = (E - ecc * np.sin(E) - mean) / (1. - ecc * np.cos(E))
+        E = E - dE
+        if np.all(np.abs(dE) < tol):
+            break
+    return E
+
+
+def kepler_to_xyz(a, ecc, inc, node, peri, mean, mass):
+    """Convert arrays of orbital elements (angles in rad) to (n, 6) states.
+
+    mass is the central mass the orbit is around, in solar masses.
+    """
+    mu = kepler * mass
+    E = _eccentric_anomaly(mean, ecc)
+    cosE, sinE = np.cos(E), np.sin(E)
+    root = np.sqrt(1. - ecc ** 2)
+    n = np.sqrt(mu / a ** 3)
+    denom = 1. - ecc * cosE
+    # perifocal frame
+    p = np.stack([a * (cosE - ecc), a * root * sinE])
+    v = np.stack([-a * n * sinE / denom, a * n * root * cosE / denom])
+    cO, sO = np.cos(node), np.sin(node)
+    cw, sw = np.cos(peri), np.sin(peri)
+    ci, si = np.cos(inc), np.sin(inc)
+    # columns of Rz(node) Rx(inc) Rz(peri) for the perifocal x and y axes
+    P = np.stack([cO * cw - sO * sw * ci, sO * cw + cO * sw * ci, sw * si])
+    Q = np.stack([-cO * sw - sO * cw * ci, -sO * sw + cO * cw * ci,
+                  cw * si])
+    pos = P * p[0] + Q * p[1]
+    vel = P * v[0] + Q * v[1]
+    return np.concatenate([pos, vel]).T
+
+
+def _isotropic(rng, n):
+    """n unit vectors uniform on the sphere, (n, 3)."""
+    cos = rng.uniform(-1., 1., n)
+    sin = np.sqrt(1. - cos ** 2)
+    phi = rng.uniform(0., 2. * np.pi, n)
+    return np.stack([sin * np.cos(phi), sin * np.sin(phi), cos], axis=1)
+
+
+def sample_plummer(n, mass, radius, rng=None, max_mass_enc=1.):
+    """Draw n phase space states (n, 6) from a Plummer sphere.
+
+    mass in solar masses, radius is the Plummer scale radius in AU.
+    max_mass_enc < 1 truncates the sphere at that enclosed mass fraction.
+    Returns (states, enclosed mass fraction, radius).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    # M(<r) / M = (1 + a^2 / r^2)^(-3/2), inverted
+    enc = rng.uniform(0., max_mass_enc, n)
+    enc = np.where(enc > 0., enc, np.finfo(float).tiny)
+    r = radius / np.sqrt(enc ** (-2. / 3.) - 1.)
+    # f(E) of the Plummer model gives q = v / v_esc with
+    # g(q) = q^2 (1 - q^2)^(7/2), max(g) < 0.1
+    q = np.empty(n)
+    todo = np.arange(n)
+    while todo.shape[0]:
+        x, y = rng.uniform(0., 1., (2, todo.shape[0]))
+        ok = 0.1 * y < x ** 2 * (1. - x ** 2) ** 3.5
+        q[todo[ok]] = x[ok]
+        todo = todo[~ok]
+    vesc = np.sqrt(2. * kepler * mass / np.sqrt(r ** 2 + radius ** 2))
+    states = np.concatenate([_isotropic(rng, n) * r[:, np.newaxis],
+                             _isotropic(rng, n) * (q * vesc)[:, np.newaxis]],
+                            axis=1)
+    return states, enc, r
+
+
+def _orbits(rng, lsma, usma, lecc, uecc, linc, uinc, mass):
+    """Draw len(mass) orbits between the given (array) bounds."""
+    size = np.shape(mass)[0]
+    a = rng.uniform(lsma, usma, size)
+    ecc = rng.uniform(lecc, uecc, size)
+    inc = np.radians(rng.uniform(linc, uinc, size))
+    node, peri, mean = rng.uniform(0., 2. * np.pi, (3, size))
+    return kepler_to_xyz(a, ecc, inc, node, peri, mean, mass)
+
+
+def sample_sims(cfg, n, rng=None, start=0):
+    """Draw the parameters of n sims, returns (sims, bodies)."""
+    if rng is None:
+        rng = np.random.default_rng()
+    sims = np.zeros(n, dtype=sim_dtype)
+    sims['sim'] = np.arange(start, start + n)
+    sims['central_mass'] = rng.uniform(cfg.central_l_mass,
+                                       cfg.central_u_mass, n)
+    # the binary has to be lighter than the central mass, drawing from the
+    # truncated range is the same distribution as resampling until it is
+    upper = np.maximum(np.minimum(cfg.binary_u_mass, sims['central_mass']),
+                       cfg.binary_l_mass)
+    sims['binary_mass'] = rng.uniform(cfg.binary_l_mass, upper)
+    sims['binary_orbit'] = _orbits(rng, cfg.binary_l_sma, cfg.binary_u_sma,
+                                   cfg.binary_l_ecc, cfg.binary_u_ecc,
+                                   cfg.binary_l_inc, cfg.binary_u_inc,
+                                   sims['central_mass'])
+    nbod = np.abs(rng.uniform(cfg.num_bodies_l, cfg.num_bodies_u, n))
+    sims['num_bodies'] = nbod.astype(np.int64)
+    sims['body_start'] = np.cumsum(sims['num_bodies']) - sims['num_bodies']
+
+    total = int(sims['num_bodies'].sum())
+    bodies = np.zeros(total, dtype=body_dtype)
+    owner = np.repeat(np.arange(n), sims['num_bodies'])
+    bodies['sim'] = sims['sim'][owner]
+    bodies['index'] = np.arange(total) - sims['body_start'][owner]
+    # body k of a sim sits k * avg_dist further out
+    shift = bodies['index'] * cfg.avg_dist
+    bodies['orbit'] = _orbits(rng, cfg.lower_smajora + shift,
+                              cfg.upper_smajora + shift,
+                              cfg.lower_ecc, cfg.upper_ecc,
+                              cfg.lower_inc, cfg.upper_inc,
+                              sims['central_mass'][owner])
+    bodies['mass'] = rng.uniform(cfg.bodies_l_mass, cfg.bodies_u_mass, total)
+    bodies['density'] = rng.uniform(cfg.bodies_l_density,
+                                    cfg.bodies_u_density, total)
+    if getattr(cfg, 'plummer_model', False):
+        sims['testp'], sims['plum_mass_enc'], sims['plum_radius'] = \
+            sample_plummer(n, cfg.cluster_mass, cfg.cluster_radius, rng)
+    return sims, bodies
+
+
+def block_size(cfg):
+    """Number of sims drawn together from one seed stream."""
+    return max(1, int(getattr(cfg, 'sample_block', __block__)))
+
+
+def block_seed(seed, block):
+    """Independent, reproducible SeedSequence of a sample block of a sweep."""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.SeedSequence(seed.entropy, spawn_key=(int(block),))
+
+
+def sample_block(cfg, seed, block):
+    """Draw the block_size(cfg) sims of block of a sweep, (sims, bodies)."""
+    size = block_size(cfg)
+    return sample_sims(cfg, size, np.random.default_rng(block_seed(seed,
+                                                                   block)),
+                       start=block * size)
+
+
+def sim_params(sims, bodies, i):
+    """Return the cfg.sub style dict of the i-th sim of a batch."""
+    row = sims[i]
+    body = bodies[row['body_start']:row['body_start'] + row['num_bodies']]
+    return {'central_mass': float(row['central_mass']),
+            'binary_mass': float(row['binary_mass']),
+            'binary_params': row['binary_orbit'].copy(),
+            'num_bodies': int(row['num_bodies']),
+            'orbitals': [x.copy() for x in body['orbit']],
+            'mass_bodies': body['mass'].copy(),
+            'den_bodies': body['density'].copy(),
+            'testp': row['testp'].copy(),
+            'plum_mass_enc': float(row['plum_mass_enc']),
+            'plum_radius': float(row['plum_radius'])}
+
+
+def sample_each(cfg, indices, seed, cache=None):
+    """Draw sims indices of a sweep, returns (sims, bodies, {index: params}).
+
+    Sim index is row index % size of block index // size, drawn in one pass
+    from block_seed(seed, block), so a sim is the same whatever else is
+    drawn with it. Every params dict carries that seed record. cache, a
+    dict, keeps the drawn blocks for the next call.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    size = block_size(cfg)
+    indices = np.asarray(list(indices), dtype=np.int64)
+    cache = {} if cache is None else cache
+    blocks = np.unique(indices // size)
+    for block in blocks.tolist():
+        if block not in cache:
+            cache[block] = sample_block(cfg, seed, block)
+    if not blocks.shape[0]:
+        return (np.zeros(0, dtype=sim_dtype), np.zeros(0, dtype=body_dtype),
+                {})
+    sims = np.concatenate([cache[x][0] for x in blocks.tolist()])
+    bodies = np.concatenate([cache[x][1] for x in blocks.tolist()])
+    sims['body_start'] = np.cumsum(sims['num_bodies']) - sims['num_bodies']
+    # blocks are contiguous, the row of sim index is a searchsorted away
+    sims = sims[np.searchsorted(sims['sim'], indices)]
+    start = np.cumsum(sims['num_bodies']) - sims['num_bodies']
+    bodies = bodies[np.repeat(sims['body_start'] - start, sims['num_bodies'])
+                    + np.arange(int(sims['num_bodies'].sum()))]
+    sims['body_start'] = start
+    params = {}
+    for k, index in enumerate(indices.tolist()):
+        params[index] = sim_params(sims, bodies, k)
+        params[index]['seed'] = {'entropy': seed.entropy,
+                                 'block': index // size,
+                                 'offset': index % size, 'block_size': size}
+    return sims, bodies, params
+
+
+def test():
+    """Testing function for module."""
+    class cfg:
+        central_l_mass, central_u_mass = 1., 1.
+        binary_l_mass, binary_u_mass = .5, 2.
+        binary_l_sma, binary_u_sma = 5, 10
+        binary_l_ecc, binary_u_ecc = 0., .5
+        binary_l_inc, binary_u_inc = 0, 90
+        num_bodies_l, num_bodies_u = 1, 8
+        bodies_l_mass, bodies_u_mass = .001, .1
+        bodies_l_density, bodies_u_density = 5.43, 5.43
+        avg_dist = 100
+        lower_smajora, upper_smajora = 5, 8
+        lower_ecc, upper_ecc = 0., .1
+        lower_inc, upper_inc = 0, 90
+    sims, bodies = sample_sims(cfg, 1000, np.random.default_rng(0))
+    assert (sims['binary_mass'] <= sims['central_mass']).all()
+    assert ((sims['num_bodies'] >= 1) & (sims['num_bodies'] < 8)).all()
+    assert bodies.shape[0] == sims['num_bodies'].sum()
+    # energy of the sampled orbits gives back the semi-major axis
+    r = np.linalg.norm(bodies['orbit'][:, :3], axis=1)
+    v2 = np.sum(bodies['orbit'][:, 3:] ** 2, axis=1)
+    a = 1. / (2. / r - v2 / kepler)
+    lo = cfg.lower_smajora + bodies['index'] * cfg.avg_dist
+    assert ((a >= lo - 1e-6) & (a <= lo + 3 + 1e-6)).all()
+    params = sim_params(sims, bodies, 3)
+    assert len(params['orbitals']) == params['num_bodies']
+    # Plummer sphere: half the mass within a (2^(2/3) - 1)^(-1/2), virial
+    # equilibrium 2T = -W with W = -3 pi G M^2 / (32 a)
+    states, enc, r = sample_plummer(200000, 1., 1., np.random.default_rng(1))
+    assert abs(np.median(r) - (2 ** (2. / 3.) - 1) ** -.5) < 0.01
+    assert abs(np.mean(states[:, :3], axis=0)).max() < 0.05
+    T = 0.5 * np.mean(np.sum(states[:, 3:] ** 2, axis=1))
+    assert abs(2 * T / (3 * np.pi * kepler / 32.) - 1.) < 0.02
+    # block streams depend only on the sweep seed and the block
+    a = np.random.default_rng(block_seed(7, 5)).random(3)
+    b = np.random.default_rng(block_seed(np.random.SeedSequence(7), 5))
+    assert (a == b.random(3)).all()
+    assert (a != np.random.default_rng(block_seed(7, 6)).random(3)).all()
+    # a sim is the same whatever it is drawn with, in any order
+    cfg.sample_block = 8
+    sims, bodies, params = sample_each(cfg, [19, 3, 4, 20], 7)
+    assert list(sims['sim']) == [19, 3, 4, 20]
+    full, fbodies = sample_block(cfg, 7, 2)
+    assert np.array_equal(params[19]['orbitals'],
+                          sim_params(full, fbodies, 3)['orbitals'])
+    assert params[19]['seed']['block'] == 2 and \
+        params[19]['seed']['offset'] == 3
+    alone = sample_each(cfg, [4], 7)[2][4]
+    assert np.array_equal(alone['mass_bodies'], params[4]['mass_bodies'])
+    first = bodies[sims['body_start'][1]:][:sims['num_bodies'][1]]
+    assert np.array_equal(first['orbit'], np.array(params[3]['orbitals']))
+    assert (first['sim'] == 3).all()
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
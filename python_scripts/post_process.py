@@ -0,0 +1,186 @@
+"""Post process finished mercury sims in parallel."""
+
+# internal modules
+import os
+from argparse import ArgumentParser as ap
+from glob import glob
+import json
+import subprocess
+from time import time
+import traceback
+
+# external modules
+import numpy as np
+
+# relative modules
+from xv_decoder import read_xv
+
+# global attributes
+__all__ = ('test', 'main', 'add_arguments', 'find_sims', 'convert_sim',
+           'post_process')
+__doc__ = """Replacement for the serial refresh_outputs_<time>.sh script.
+
+Every sim directory under destination/naming_schema is converted on a
+process pool, either by running element6 in it (the .aei files) or by
+decoding xv.out in python and saving each body as <name>.xv.npy. Sims
+whose outputs are newer than their xv.out are skipped, a failing sim is
+recorded and does not stop the others, and a json summary is written next
+to the sims."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+_methods = {'element6': '*.aei', 'xv': '*.xv.npy'}
+
+
+def find_sims(cfg):
+    """Return the sorted sim directories of a sweep."""
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    return sorted(x for x in glob(f'{dest}{cfg.naming_schema}_sim*')
+                  if os.path.isdir(x))
+
+
+def is_done(sim, method='element6'):
+    """Check whether the outputs of a sim are newer than its xv.out."""
+    xv = f'{sim}/xv.out'
+    outputs = glob(f'{sim}/{_methods[method]}')
+    if not os.path.isfile(xv) or not outputs:
+        return False
+    return min(os.path.getmtime(x) for x in outputs) >= \
+        os.path.getmtime(xv)
+
+
+def convert_sim(item):
+    """Convert one sim, never raising so the pool keeps going."""
+    sim, method, timeout = item
+    start = time()
+    result = {'sim': sim, 'status': 'ok', 'error': '', 'seconds': 0.}
+    try:
+        if method == 'element6':
+            # element6 refuses to overwrite existing .aei files
+            for x in glob(f'{sim}/*.aei'):
+                os.remove(x)
+            run = subprocess.run(['./element6'], cwd=sim, timeout=timeout,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            if run.returncode != 0 or not glob(f'{sim}/*.aei'):
+                result['status'] = 'failed'
+                result['error'] = (run.stderr or run.stdout)\
+                    .decode('utf-8', errors='replace')[-500:]
+        else:
+            for name, data in read_xv(f'{sim}/xv.out').items():
+                np.save(f'{sim}/{name}.xv.npy', data)
+    except subprocess.TimeoutExpired:
+        result['status'] = 'timeout'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()[-500:]
+    result['seconds'] = time() - start
+    return result
+
+
+def post_process(cfg, workers=1, method='element6', force=False,
+                 timeout=None):
+    """Convert every sim of a sweep on a pool of workers."""
+    if method not in _methods:
+        print(f'Method <{method}> not recognized. Currently supported: ' +
+              ','.join(_methods))
+        exit()
+    sims = find_sims(cfg)
+    summary = {'method': method, 'ok': [], 'failed': {}, 'timeout': [],
+               'skipped': [], 'missing': []}
+    todo = []
+    for sim in sims:
+        if not os.path.isfile(f'{sim}/xv.out'):
+            summary['missing'].append(sim)
+        elif not force and is_done(sim, method):
+            summary['skipped'].append(sim)
+        else:
+            todo.append((sim, method, timeout))
+    print(f'Converting {len(todo)} of {len(sims)} sims with ' +
+          f'{workers} workers')
+    start = time()
+    from multiprocessing import Pool
+    with Pool(processes=workers) as pool:
+        for i, res in enumerate(pool.imap_unordered(convert_sim, todo)):
+            if res['status'] == 'failed':
+                summary['failed'][res['sim']] = res['error']
+            else:
+                summary[res['status']].append(res['sim'])
+            print(f'Finished {i + 1}/{len(todo)} [{res["status"]}] ' +
+                  f'{res["sim"]} in {res["seconds"]:.1f}s')
+    summary['seconds'] = time() - start
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    with open(f'{dest}post_process_{str(time()).replace(".", "_")}.json',
+              'w') as f:
+        json.dump(summary, f, indent=1)
+    print('ok: {} failed: {} timeout: {} skipped: {} missing: {}'
+          .format(*[len(summary[x]) for x in ('ok', 'failed', 'timeout',
+                                              'skipped', 'missing')]))
+    return summary
+
+
+def add_arguments(parser):
+    """Add the command line options of main to an argparse parser."""
+    parser.add_argument('-c', help='configuration file', default='config.py')
+    parser.add_argument('-w', help='number of worker processes', type=int,
+                        default=None)
+    parser.add_argument('-m', help='conversion: element6 or xv',
+                        default='element6')
+    parser.add_argument('--force', help='reconvert finished sims',
+                        action='store_true')
+    return parser
+
+
+def main(cfg_name, workers=None, method='element6', force=False):
+    """Main caller function."""
+    from nkrpy.load import load_cfg
+    config = load_cfg(cfg_name)
+    if workers is None:
+        workers = getattr(config, 'post_workers', os.cpu_count())
+    return post_process(config, workers, method, force)
+
+
+def test():
+    """Testing function for module."""
+    import types
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    cfg = types.SimpleNamespace(destination=tmpdir, naming_schema='test')
+    # fake element6: sim0 converts, sim1 fails, sim2 hangs, sim3 has no
+    # xv.out, sim4 is already converted
+    scripts = {0: 'echo x > BODY0.aei', 1: 'echo broken >&2; exit 3',
+               2: 'sleep 10', 3: 'true', 4: 'echo x > BODY0.aei'}
+    sims = []
+    for i, text in scripts.items():
+        sim = f'{tmpdir}/test/test_sim{i}'
+        os.makedirs(sim)
+        with open(f'{sim}/element6', 'w') as f:
+            f.write(f'#!/bin/sh\n{text}\n')
+        os.chmod(f'{sim}/element6', 0o755)
+        if i != 3:
+            open(f'{sim}/xv.out', 'w').close()
+        sims.append(sim)
+    open(f'{sims[4]}/BODY0.aei', 'w').close()
+    summary = post_process(cfg, 3, timeout=1.)
+    assert summary['ok'] == sims[:1] and list(summary['failed']) == sims[1:2]
+    assert 'broken' in summary['failed'][sims[1]]
+    assert summary['timeout'] == sims[2:3]
+    assert summary['missing'] == sims[3:4]
+    assert summary['skipped'] == sims[4:]
+    assert len(glob(f'{tmpdir}/test/post_process_*.json')) == 1
+    # the outputs are newer now, force converts them again
+    assert post_process(cfg, 2, timeout=1.)['skipped'] == [sims[0], sims[4]]
+    assert sims[4] in post_process(cfg, 2, force=True, timeout=1.)['ok']
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    args = add_arguments(ap()).parse_args()
+
+    print('Post Processing')
+    main(args.c, args.w, args.m, args.force)
+    print('Finished')
+
+# end of code
@@ -0,0 +1,138 @@
+"""Render the mercury input templates for a sim in one pass."""
+
+# internal modules
+import os
+import re
+import shutil
+
+# external modules
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'render', 'materialize_sim')
+__doc__ = """Replacement for copytree + repeated freplace calls.
+
+Templates are read once per process and kept in memory. For each sim every
+placeholder of a file is filled with a single regex pass and the file is
+written exactly once. Files without placeholders are read only inputs of
+mercury and element6, they are hard linked into the sim directory (falling
+back to a symlink, then a copy, when the filesystem refuses). A linked file
+shares its inode with the template, files that are rewritten in place in a
+sim directory are named as private and copied instead. Symlinks in the
+template directory are recreated as-is."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+_templates = {}
+_patterns = {}
+
+
+def _template(fname):
+    """Return the cached text of a template, reloading if it changed."""
+    mtime = os.path.getmtime(fname)
+    cached = _templates.get(fname)
+    if cached is None or cached[0] != mtime:
+        with open(fname, 'r') as f:
+            cached = (mtime, f.read())
+        _templates[fname] = cached
+    return cached[1]
+
+
+def render(text, subs):
+    """Fill every placeholder of subs in text in a single pass."""
+    if not subs:
+        return text
+    key = tuple(sorted(subs))
+    pattern = _patterns.get(key)
+    if pattern is None:
+        # longest first so '<mass>' never shadows a longer placeholder
+        pattern = re.compile('|'.join(re.escape(x) for x in
+                                      sorted(key, key=len, reverse=True)))
+        _patterns[key] = pattern
+    return pattern.sub(lambda m: str(subs[m.group(0)]), text)
+
+
+def _link(src, dst, link):
+    """Hard link, symlink or copy a static file into place."""
+    if link == 'hard':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            link = 'sym'
+    if link == 'sym':
+        try:
+            os.symlink(os.path.realpath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def materialize_sim(template_dir, sim_dir, subs, link='hard', private=()):
+    """Create sim_dir from template_dir.
+
+    subs maps a template file name to its {placeholder: value} dict, those
+    files are rendered and written once. The files named in private are
+    copied, everything else is linked with link (hard, sym or copy).
+    Raises FileExistsError if sim_dir already exists.
+    """
+    os.mkdir(sim_dir)
+    for entry in os.scandir(template_dir):
+        dst = os.path.join(sim_dir, entry.name)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), dst)
+        elif entry.name in subs:
+            text = render(_template(entry.path), subs[entry.name])
+            with open(dst, 'w') as f:
+                f.write(text)
+            shutil.copymode(entry.path, dst)
+        elif entry.is_file():
+            _link(entry.path, dst, 'copy' if entry.name in private else link)
+        elif entry.is_dir():
+            shutil.copytree(entry.path, dst, symlinks=True)
+    pass
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    template = f'{tmpdir}/template'
+    os.mkdir(template)
+    with open(f'{template}/param.in', 'w') as f:
+        f.write('mass = <mass>\nbb = <bb> <mass>\n')
+    with open(f'{template}/files.in', 'w') as f:
+        f.write(' big.in\n')
+    os.symlink('../element6', f'{template}/element6')
+    materialize_sim(template, f'{tmpdir}/sim0',
+                    {'param.in': {'<mass>': 1.5, '<bb>': 3}})
+    with open(f'{tmpdir}/sim0/param.in', 'r') as f:
+        assert f.read() == 'mass = 1.5\nbb = 3 1.5\n'
+    assert os.path.samefile(f'{template}/files.in', f'{tmpdir}/sim0/files.in')
+    assert os.readlink(f'{tmpdir}/sim0/element6') == '../element6'
+    try:
+        materialize_sim(template, f'{tmpdir}/sim0', {})
+    except FileExistsError:
+        pass
+    else:
+        assert False
+    # a private input rewritten in one sim leaves the template alone
+    materialize_sim(template, f'{tmpdir}/sim1', {}, private=('files.in',))
+    with open(f'{tmpdir}/sim1/files.in', 'w') as f:
+        f.write(' other.in\n')
+    with open(f'{template}/files.in', 'r') as f:
+        assert f.read() == ' big.in\n'
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
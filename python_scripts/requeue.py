@@ -0,0 +1,382 @@
+"""Resubmit interrupted sims as continuations from their dump files."""
+
+# internal modules
+import os
+import json
+import shutil
+import subprocess
+from glob import glob
+
+# external modules
+
+# relative modules
+import job_status
+from bundle_runner import _seconds, _timelimit
+from slurm_array import submit_array
+
+# global attributes
+__all__ = ('test', 'read_dumps', 'continuation_limit', 'job_owners',
+           'find_continuations', 'requeue')
+__doc__ = """Checkpoint aware requeue.
+
+Mercury restarts from its dump files by itself whenever restart.dmp exists
+next to the outputs, so a continuation is the sim's own slurm.sh submitted
+again with a new --time. A sim qualifies when it has no finished marker,
+is not in the queue and its dump set is whole: every dump parses, big.dmp
+has its epoch and complete body records, param.dmp runs to its last
+option. Mercury writes the .tmp set completely before overwriting the
+.dmp set, so when the .dmp set is torn but the .tmp set is whole the .tmp
+files are restored first. The time limit comes from the progress rate of
+the attempts so far, (epoch - start) over the wall time they were given,
+recorded in requeue.json in the sim.
+
+Array tasks and bundles run in the submit directory, not the sim's, so
+"in the queue" is decided from the job owning the sim (job_owners: the
+sweep ledger, then the continuation history) against the queued job ids,
+pending array ranges expanded. Only sims without a recorded job fall back
+to the working directory of the queued jobs, and sims listed for an array
+or bundle without one are never touched."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+_dumps = ('big', 'small', 'param', 'cluster', 'restart')
+__history__ = 'requeue.json'
+
+
+def _float(x):
+    """Float from a Fortran literal."""
+    return float(x.strip().upper().replace('D', 'E'))
+
+
+def _value(lines, key):
+    """Value of the first 'key ... = value' line, None if missing."""
+    for line in lines:
+        if key in line and '=' in line:
+            try:
+                return _float(line.split('=', 1)[1])
+            except ValueError:
+                return None
+    return None
+
+
+def _check(sim, ext):
+    """Parse a dump set, returns {epoch, start, stop} or None if torn."""
+    text = {}
+    for name in _dumps:
+        fname = os.path.join(sim, f'{name}.{ext}')
+        if not os.path.isfile(fname) or os.path.getsize(fname) == 0:
+            return None
+        with open(fname, 'r', errors='replace') as f:
+            text[name] = [x.rstrip('\n') for x in f if x.strip()]
+    # big/small: header and options, then 4 lines per body
+    for name in ('big', 'small'):
+        lines = text[name]
+        if not lines[0].startswith(')O+_0'):
+            return None
+        body = [x for x in lines[1:] if not x.startswith(')') and
+                'style' not in x and 'epoch' not in x]
+        if len(body) % 4:
+            return None
+        for i in range(0, len(body), 4):
+            for line in body[i + 1:i + 4]:
+                try:
+                    if len([_float(x) for x in line.split()[:3]]) != 3:
+                        return None
+                except ValueError:
+                    return None
+    epoch = _value(text['big'], 'epoch')
+    start = _value(text['param'], 'start time')
+    stop = _value(text['param'], 'stop time')
+    # nfun is the last option mio_dump writes
+    last = _value(text['param'][-1:], 'periodic effects')
+    if None in (epoch, start, stop, last):
+        return None
+    try:
+        if len([_float(x) for x in text['restart'][1:]]) != 7 or \
+                len([_float(x.split()[0]) for x in text['cluster']]) != 3:
+            return None
+    except (ValueError, IndexError):
+        return None
+    return {'epoch': epoch, 'start': start, 'stop': stop}
+
+
+def read_dumps(sim, restore=True):
+    """Return {epoch, start, stop} of a sim's usable dump set, or None.
+
+    With restore, a whole .tmp set replaces a torn .dmp set.
+    """
+    state = _check(sim, 'dmp')
+    if state is None:
+        state = _check(sim, 'tmp')
+        if state is None:
+            return None
+        if restore:
+            for name in _dumps:
+                shutil.copyfile(os.path.join(sim, f'{name}.tmp'),
+                                os.path.join(sim, f'{name}.dmp'))
+    # the stop time of the sim's param.in wins over the dumped one
+    param = os.path.join(sim, 'param.in')
+    if os.path.isfile(param):
+        with open(param, 'r', errors='replace') as f:
+            stop = _value(f, 'stop time')
+        if stop is not None:
+            state['stop'] = stop
+    return state
+
+
+def _history(sim, timelimit):
+    """Wall seconds given to earlier attempts, the first used timelimit."""
+    fname = os.path.join(sim, __history__)
+    if os.path.isfile(fname):
+        with open(fname, 'r') as f:
+            return json.load(f)
+    return [{'seconds': _seconds(timelimit), 'epoch': None}]
+
+
+def continuation_limit(state, history, safety=1.25, floor='00:10:00',
+                       ceiling='2-00:00:00'):
+    """Seconds for the next attempt from the progress rate so far."""
+    used = sum(x['seconds'] for x in history)
+    done = state['epoch'] - state['start']
+    left = state['stop'] - state['epoch']
+    if done <= 0 or used <= 0:
+        limit = history[-1]['seconds'] * 2
+    else:
+        limit = safety * left / (done / used)
+    return int(min(max(limit, _seconds(floor)), _seconds(ceiling)))
+
+
+def _expand(job):
+    """Ids a squeue job id stands for, 12_[0-3,7%2] gives 12, 12_0..."""
+    parent, _, tasks = job.partition('_')
+    ret = {parent}
+    if not tasks.startswith('['):
+        return ret | ({job} if tasks else set())
+    for part in tasks.strip('[]').split('%')[0].split(','):
+        first, _, last = part.partition('-')
+        ret.update(f'{parent}_{i}' for i in
+                   range(int(first), int(last or first) + 1))
+    return ret
+
+
+def _queue(squeue='squeue'):
+    """Return (job ids, working directories) of our queued jobs or None."""
+    run = subprocess.run([squeue, '-h', '-u', job_status.username(),
+                          '-o', '%i|%Z'],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if run.returncode != 0:
+        return None
+    jobs, dirs = set(), set()
+    for line in run.stdout.decode('utf-8').splitlines():
+        if '|' not in line:
+            continue
+        job, workdir = line.split('|', 1)
+        jobs.update(_expand(job.strip()))
+        dirs.add(os.path.normpath(workdir.strip()))
+    return jobs, dirs
+
+
+def job_owners(dest, ledger=None):
+    """Return {sim directory: job id} of the job that last ran each sim.
+
+    Read from the ledger in dest (every sweep in it) and the continuation
+    history in the sims. Sims in an array or bundle list of dest that
+    neither knows map to None.
+    """
+    owners = {}
+    for fname in glob(f'{dest}array_*.txt') + glob(f'{dest}bundle_*.txt'):
+        with open(fname, 'r') as f:
+            owners.update((os.path.normpath(x.strip()), None) for x in f
+                          if x.strip())
+    if ledger is not None:
+        for sweep, n, sim, job in ledger.directories():
+            if job:
+                owners[os.path.normpath(sim)] = job
+    for sim in list(owners):
+        fname = os.path.join(sim, __history__)
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                job = json.load(f)[-1].get('job')
+            if job:
+                owners[sim] = str(job)
+    return owners
+
+
+def find_continuations(sims, queued=(), owners=None, jobs=()):
+    """Return [(sim, dump state)] of interrupted sims with usable dumps.
+
+    A sim is left alone while a job in the queued job ids jobs owns it
+    (owners, see job_owners), while a queued job runs in its directory
+    (queued) or when it is owned by an unrecorded array/bundle job.
+    """
+    owners = owners or {}
+    ret = []
+    for sim in sims:
+        sim = os.path.normpath(sim)
+        if sim in queued or os.path.isfile(os.path.join(sim, 'finished')):
+            continue
+        if sim in owners and owners[sim] is None:
+            print(f'No job recorded for <{sim}>, not continuing')
+            continue
+        if owners.get(sim) in jobs:
+            continue
+        if not os.path.isfile(os.path.join(sim, 'restart.dmp')) and \
+                not os.path.isfile(os.path.join(sim, 'restart.tmp')):
+            continue
+        state = read_dumps(sim)
+        if state is None:
+            print(f'Dump files look truncated, not continuing: <{sim}>')
+            continue
+        if state['epoch'] >= state['stop']:
+            continue
+        ret.append((sim, state))
+    return ret
+
+
+def requeue(cfg, sims=None, sbatch='sbatch', squeue='squeue'):
+    """Resubmit the interrupted sims of cfg's destination as continuations.
+
+    Returns {job id: sim}.
+    """
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    if sims is None:
+        sims = sorted(x for x in glob(f'{dest}{cfg.naming_schema}_sim*')
+                      if os.path.isdir(x))
+    queue = _queue(squeue)
+    if queue is None:
+        print('Could not read the queue, not requeueing')
+        return {}
+    ledger = None
+    fname = dest + getattr(cfg, 'ledger', 'ledger.sqlite')
+    if os.path.isfile(fname):
+        import job_ledger
+        ledger = job_ledger.Ledger(fname)
+    try:
+        return _requeue(cfg, sims, queue, ledger, dest, sbatch)
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+
+def _requeue(cfg, sims, queue, ledger, dest, sbatch):
+    """Submit the continuations, recording them in the ledger."""
+    sweeps = {} if ledger is None else {
+        os.path.normpath(x[2]): x[:2] for x in ledger.directories()}
+    jobs = {}
+    owners = job_owners(dest, ledger)
+    for sim, state in find_continuations(sims, queue[1], owners, queue[0]):
+        history = _history(sim, cfg.timelimit)
+        limit = continuation_limit(
+            state, history, getattr(cfg, 'requeue_safety', 1.25),
+            ceiling=getattr(cfg, 'max_timelimit', '2-00:00:00'))
+        job = submit_array(f'{sim}/slurm.sh', sbatch,
+                           args=('--time', _timelimit(limit)))
+        if not job:
+            continue
+        done = (state['epoch'] - state['start']) / \
+            (state['stop'] - state['start'])
+        print(f'Continuing {sim} from {100 * done:.1f}% as {job} '
+              f'for {_timelimit(limit)}')
+        history[-1]['epoch'] = state['epoch']
+        history.append({'seconds': limit, 'epoch': None, 'job': job})
+        with open(os.path.join(sim, __history__), 'w') as f:
+            json.dump(history, f)
+        jobs[job] = sim
+        if sim in sweeps:
+            ledger.record(*sweeps[sim], 'submitted', job_id=job)
+    return jobs
+
+
+def test():
+    """Testing function for module."""
+    import types
+    import tempfile
+    import job_ledger
+    tmpdir = tempfile.mkdtemp()
+
+    def write_set(sim, ext, epoch, torn=False):
+        body = ' BODY0 r=3.0E+00 d=5.4E+00 m=1.0E-03\n' + \
+            ' 1.0E+00 2.0E+00 3.0E+00\n' * 3
+        big = ')O+_06 Big-body initial data\n) Lines\n style = Cartesian\n' \
+            f' epoch (in days) =  {epoch}\n)---\n' + body * 2
+        files = {'big': big[:-30] if torn else big,
+                 'small': ')O+_06 Small-body initial data\n)---\n',
+                 'param': ')O+_06 Integration parameters\n'
+                          ' start time (days) =  0.0\n'
+                          ' stop time (days) =  1000.0\n'
+                          ' number of timesteps between periodic '
+                          'effects =  10\n',
+                 'cluster': ' 1.0E-12\n 5.0E+04\n 3.6E+09\n',
+                 'restart': ' 0\n' + ' 1.0E+00\n' * 7}
+        for name, text in files.items():
+            with open(f'{sim}/{name}.{ext}', 'w') as f:
+                f.write(text)
+
+    sims = []
+    for i in range(5):
+        sim = f'{tmpdir}/test_sim{i}'
+        os.mkdir(sim)
+        with open(f'{sim}/slurm.sh', 'w') as f:
+            f.write('#!/bin/sh\n')
+        with open(f'{sim}/param.in', 'w') as f:
+            f.write(' stop time (days) = 2000.0\n')
+        sims.append(sim)
+    write_set(sims[0], 'dmp', 500.)
+    write_set(sims[1], 'dmp', 600., torn=True)
+    write_set(sims[1], 'tmp', 600.)
+    write_set(sims[2], 'dmp', 700., torn=True)
+    write_set(sims[3], 'dmp', 800.)
+    open(f'{sims[3]}/finished', 'w').close()
+    write_set(sims[4], 'dmp', 900., torn=True)
+    write_set(sims[4], 'tmp', 900.)
+    found = dict(find_continuations(sims[:4]))
+    assert sorted(found) == sims[:2]
+    assert found[sims[0]] == {'epoch': 500., 'start': 0., 'stop': 2000.}
+    assert _check(sims[1], 'dmp') is not None
+    # 500 days in 15 minutes, 1500 left takes 45 minutes, plus 25%
+    limit = continuation_limit(found[sims[0]], _history(sims[0], '00:15:00'))
+    assert limit == int(1.25 * 2700)
+
+    # sim 1 runs as a single job in its own directory, sim 4 is a task of
+    # a pending array that runs from the submit directory
+    assert _expand('7_[1-3,6%2]') == {'7', '7_1', '7_2', '7_3', '7_6'}
+    for name, text in (('sbatch', 'echo "$@" >> "{0}/calls"\necho 42'),
+                       ('squeue', f'echo "5|{sims[1]}"\n'
+                                  f'echo "7_[1-3]|{tmpdir}"')):
+        with open(f'{tmpdir}/{name}', 'w') as f:
+            f.write('#!/bin/sh\n' + text.format(tmpdir) + '\n')
+        os.chmod(f'{tmpdir}/{name}', 0o755)
+    with open(f'{tmpdir}/array_0_0.txt', 'w') as f:
+        f.write(f'{sims[2]}\n{sims[4]}\n')
+    ledger = job_ledger.Ledger(f'{tmpdir}/ledger.sqlite')
+    ledger.record('0', 0, 'submitted', directory=sims[0], job_id=3)
+    ledger.record('0', 4, 'submitted', directory=sims[4], job_id='7_2')
+    ledger.close()
+    cfg = types.SimpleNamespace(destination=tmpdir, naming_schema='',
+                                timelimit='00:15:00')
+    owners = job_owners(f'{tmpdir}/', job_ledger.Ledger(
+        f'{tmpdir}/ledger.sqlite'))
+    assert owners == {sims[0]: '3', sims[2]: None, sims[4]: '7_2'}
+    jobs = requeue(cfg, sims, f'{tmpdir}/sbatch', f'{tmpdir}/squeue')
+    assert jobs == {42: sims[0]}
+    # the live dump set of the queued array task was left alone
+    assert _check(sims[4], 'dmp') is None
+    ledger = job_ledger.Ledger(f'{tmpdir}/ledger.sqlite')
+    assert ledger.incomplete('0')[0][3] == '42'
+    ledger.close()
+    with open(f'{tmpdir}/calls') as f:
+        assert f.read().split()[:3] == ['--parsable', '--time', '00:56:15']
+    with open(f'{sims[0]}/{__history__}') as f:
+        assert len(json.load(f)) == 2
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,178 @@
+"""Submit a whole sweep as Slurm job arrays."""
+
+# internal modules
+import os
+import re
+import subprocess
+from time import sleep
+
+# external modules
+
+# relative modules
+import instrument
+
+# global attributes
+__all__ = ('test', 'write_array_scripts', 'submit_array', 'submit_sweep',
+           'simlist', 'sim_jobs')
+__doc__ = """Job array submission mode for submit_jobs.
+
+Instead of one sbatch per sim, the sim directories are written to a list
+file and a single array script maps SLURM_ARRAY_TASK_ID to a line of that
+list. The tasks run in, and write their stdout/stderr to, the directory
+of the scripts rather than wherever sbatch was called from. Sweeps larger
+than the cluster MaxArraySize are split into chunks, each chunk is one
+sbatch --array call, optionally throttled with %N.
+The list of a script sits beside it (simlist), sim_jobs maps every sim
+directory back to the <array job>_<task> running it."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__max_array_size__ = 1000
+
+_array_template = """#!/bin/bash
+#SBATCH --partition={partition}
+#SBATCH --ntasks=1
+#SBATCH --chdir={outdir}
+#SBATCH --output={name}_%A_%a_stdout.txt
+#SBATCH --error={name}_%A_%a_stderr.txt
+#SBATCH --time={timelimit}
+#SBATCH --job-name={name}-array{chunk}
+#SBATCH --array=0-{last}{throttle}
+#SBATCH --requeue
+
+workdir=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "{simlist}")
+cd "$workdir"; ./{cmd} ; cd "$workdir"; touch ./finished
+
+exit 0
+"""
+
+
+def simlist(script):
+    """The sim list file of an array (or bundle) script."""
+    return script[:-len('.sh')] + '.txt'
+
+
+def write_array_scripts(cfg, sims, outdir, max_array_size=None, throttle=0):
+    """Write the sim lists and array scripts, returns the script paths."""
+    if max_array_size is None:
+        max_array_size = getattr(cfg, 'max_array_size', __max_array_size__)
+    outdir = os.path.abspath(outdir)
+    scripts = []
+    for chunk, start in enumerate(range(0, len(sims), max_array_size)):
+        part = sims[start:start + max_array_size]
+        script = f'{outdir}/array_{cfg.time}_{chunk}.sh'
+        with open(simlist(script), 'w') as f:
+            f.write(''.join(f'{os.path.abspath(x)}\n' for x in part))
+        with open(script, 'w') as f:
+            f.write(_array_template.format(
+                partition=getattr(cfg, 'partition', 'normal'),
+                name=cfg.naming_schema, timelimit=cfg.timelimit,
+                chunk=chunk, last=len(part) - 1,
+                throttle=f'%{throttle}' if throttle else '',
+                simlist=simlist(script), cmd=cfg.program, outdir=outdir))
+        scripts.append(script)
+    return scripts
+
+
+def submit_array(script, sbatch='sbatch', retries=5, args=()):
+    """Submit one array script, returns the array job id or False.
+
+    args are extra sbatch options placed before the script.
+    """
+    for i in range(retries):
+        with instrument.span('submit.sbatch'):
+            run = subprocess.run([sbatch, '--parsable', *args, script],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        # --parsable prints <jobid>[;cluster]
+        match = re.match(r'\s*(\d+)', run.stdout.decode('utf-8'))
+        if run.returncode == 0 and match:
+            return int(match.group(1))
+        print(f'sbatch failed for {script}:',
+              run.stderr.decode('utf-8').strip())
+        instrument.count('submit.sbatch_retries')
+        sleep(2 ** i)
+    return False
+
+
+def submit_sweep(cfg, sims, outdir, throttle=0, sbatch='sbatch'):
+    """Write and submit the array scripts of a sweep.
+
+    Returns {array job id: script} for every chunk that was accepted.
+    """
+    jobs = {}
+    for script in write_array_scripts(cfg, sims, outdir, throttle=throttle):
+        job = submit_array(script, sbatch)
+        if job:
+            print(f'Submitted array {job}...script: <{script}>')
+            jobs[job] = script
+        with open(f'{outdir}/slurm_master_restart_{cfg.time}.sh', 'a') as f:
+            f.write(f'sbatch {script} &\n')
+    return jobs
+
+
+def sim_jobs(jobs, tasks=True):
+    """Return {sim directory: job id} of submitted {job id: script}.
+
+    With tasks the id is <array job>_<task>, the line of the sim in the
+    list, as squeue and sacct report array tasks; without, the job id of
+    the script (bundles run their whole list in one job).
+    """
+    ret = {}
+    for job, script in jobs.items():
+        with open(simlist(script), 'r') as f:
+            for task, sim in enumerate(x.strip() for x in f):
+                ret[sim] = f'{job}_{task}' if tasks else str(job)
+    return ret
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    import types
+    tmpdir = tempfile.mkdtemp()
+    # fake sbatch, records its arguments and answers like --parsable
+    fake = f'{tmpdir}/sbatch'
+    with open(fake, 'w') as f:
+        f.write('#!/bin/sh\necho "$@" >> "{}/calls"\n'.format(tmpdir) +
+                'echo "$(wc -l < "{}/calls");cluster"\n'.format(tmpdir))
+    os.chmod(fake, 0o755)
+    cfg = types.SimpleNamespace(time='0', naming_schema='test',
+                                timelimit='00:15:00', program='mercury6',
+                                max_array_size=4)
+    sims = [f'{tmpdir}/test_sim{i}' for i in range(10)]
+    jobs = submit_sweep(cfg, sims, tmpdir, throttle=2, sbatch=fake)
+    assert list(jobs) == [1, 2, 3]
+    with open(f'{tmpdir}/calls') as f:
+        assert len(f.read().splitlines()) == 3
+    with open(jobs[3]) as f:
+        text = f.read()
+    assert '#SBATCH --array=0-1%2' in text
+    assert f'#SBATCH --chdir={os.path.abspath(tmpdir)}\n' in text
+    with open(f'{tmpdir}/array_0_2.txt') as f:
+        assert f.read().split() == sims[8:]
+    owners = sim_jobs(jobs)
+    assert owners[sims[0]] == '1_0' and owners[sims[9]] == '3_1'
+    assert sim_jobs(jobs, False)[sims[5]] == '2'
+    # a refused submission is retried and counted
+    with open(fake, 'a') as f:
+        f.write('exit 1\n')
+    fname = instrument.enable(tmpdir, 'test')
+    try:
+        assert not submit_array(jobs[1], fake, retries=2)
+    finally:
+        instrument.disable()
+    stats = instrument.summary([fname])
+    assert stats['counts']['submit.sbatch_retries']['total'] == 2
+    assert stats['spans']['submit.sbatch']['n'] == 2
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -0,0 +1,239 @@
+"""Vectorized pre-flight stability screening of sampled sims."""
+
+# internal modules
+import json
+
+# external modules
+import numpy as np
+from nkrpy.constants import kepler
+
+# relative modules
+from param_sampling import sample_each
+
+# global attributes
+__all__ = ('test', 'screen', 'elements', 'screen_dtype', 'screen_sweep',
+           'write_screening')
+__doc__ = """Tag sims run / skip-unstable / skip-stable before submission.
+
+Works on the (sims, bodies) batch of param_sampling.sample_sims, every
+criterion is computed for all sims at once:
+    unbound       a body or the binary is not bound to the central mass
+    crossing      adjacent orbits cross, a_i (1 + e_i) > a_j (1 - e_j)
+    hill          smallest spacing of adjacent bodies in mutual Hill radii
+                  R_H = ((m_i + m_j) / 3 M)^(1/3) (a_i + a_j) / 2
+    mardling      Mardling & Aarseth (2001) for each body against the
+                  binary, the closer orbit being the inner one,
+                  R_p / a_in > 2.8 (1 + q)^(2/5) (1 + e)^(2/5)
+                               (1 - e)^(-1/5) (1 - 0.3 i / pi)
+                  reported as the smallest ratio to the critical value
+    tidal         cluster tide over central gravity at the outermost
+                  apocentre, M_cl r^3 / (M a_cl^3) (Plummer core)
+A sim is skip-unstable when it is unbound, crosses, is closer than
+hill_unstable or below the Mardling-Aarseth limit; skip-stable when it is
+wider than hill_stable, ma_stable times the limit and the tide is below
+tidal_max; otherwise run. Screening is off unless cfg.screen_sims is set."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+screen_dtype = np.dtype([('sim', np.int64), ('tag', 'U13'),
+                         ('reason', 'U160'), ('hill', np.float64),
+                         ('mardling', np.float64), ('tidal', np.float64)])
+_defaults = {'hill_unstable': 2. * np.sqrt(3.), 'hill_stable': 12.,
+             'ma_stable': 2., 'tidal_max': 1e-8}
+
+
+def elements(states, mu):
+    """Semi-major axis, eccentricity and unit angular momentum of states."""
+    r = np.linalg.norm(states[:, :3], axis=1)
+    v2 = np.sum(states[:, 3:] ** 2, axis=1)
+    h = np.cross(states[:, :3], states[:, 3:])
+    hn = np.linalg.norm(h, axis=1)
+    energy = v2 / 2. - mu / r
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = -mu / (2. * energy)
+        e = np.sqrt(np.maximum(0., 1. + 2. * energy * hn ** 2 / mu ** 2))
+        hunit = h / hn[:, np.newaxis]
+    return a, e, hunit
+
+
+def _mardling(a_in, a_out, e_out, q_out, inc):
+    """Ratio of outer periapsis over inner sma to the critical value."""
+    crit = 2.8 * (1. + q_out) ** .4 * (1. + e_out) ** .4 * \
+        (1. - e_out) ** -.2 * (1. - 0.3 * inc / np.pi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return a_out * (1. - e_out) / a_in / crit
+
+
+def screen(cfg, sims, bodies, **thresholds):
+    """Screen a batch of sims, returns a screen_dtype row per sim.
+
+    Thresholds default to cfg.screen_<name>, then to the module defaults.
+    """
+    limit = {k: thresholds.get(k, getattr(cfg, f'screen_{k}', v))
+             for k, v in _defaults.items()}
+    n = sims.shape[0]
+    # row of the owning sim of every body, sims may come in any order
+    order = np.argsort(sims['sim'], kind='stable')
+    index = order[np.searchsorted(sims['sim'][order], bodies['sim'])]
+    mc = sims['central_mass']
+    # binary around the central mass
+    ba, be, bh = elements(sims['binary_orbit'],
+                          kepler * (mc + sims['binary_mass']))
+    # bodies around the central mass
+    a, e, h = elements(bodies['orbit'],
+                       kepler * (mc[index] + bodies['mass']))
+
+    unbound = ~((ba > 0) & (be < 1))
+    np.logical_or.at(unbound, index, ~((a > 0) & (e < 1)))
+
+    # adjacent bodies, ordered by sma within each sim
+    order = np.lexsort((a, index))
+    same = index[order][1:] == index[order][:-1]
+    i, j = order[:-1][same], order[1:][same]
+    owner = index[i]
+    rhill = np.cbrt((bodies['mass'][i] + bodies['mass'][j]) /
+                    (3. * mc[owner])) * (a[i] + a[j]) / 2.
+    hill = np.full(n, np.inf)
+    np.minimum.at(hill, owner, (a[j] - a[i]) / rhill)
+    crossing = np.zeros(n, dtype=bool)
+    np.logical_or.at(crossing, owner, a[i] * (1. + e[i]) >
+                     a[j] * (1. - e[j]))
+
+    # every body against the binary, the closer orbit is the inner one
+    inc = np.arccos(np.clip(np.sum(h * bh[index], axis=1), -1., 1.))
+    mb = sims['binary_mass'][index]
+    inside = a < ba[index]
+    ratio = np.where(
+        inside,
+        _mardling(a, ba[index], be[index], mb / (mc[index] + bodies['mass']),
+                  inc),
+        _mardling(ba[index], a, e, bodies['mass'] / (mc[index] + mb), inc))
+    mardling = np.full(n, np.inf)
+    np.minimum.at(mardling, index, np.where(np.isfinite(ratio), ratio, 0.))
+
+    # cluster tide at the outermost apocentre
+    apo = ba * (1. + be)
+    np.maximum.at(apo, index, a * (1. + e))
+    tidal = np.zeros(n)
+    if getattr(cfg, 'cluster_mass', 0) and getattr(cfg, 'cluster_radius', 0):
+        tidal = cfg.cluster_mass * apo ** 3 / (mc * cfg.cluster_radius ** 3)
+
+    out = np.zeros(n, dtype=screen_dtype)
+    out['sim'] = sims['sim']
+    out['hill'], out['mardling'], out['tidal'] = hill, mardling, tidal
+    out['tag'] = 'run'
+    unstable = unbound | crossing | (hill < limit['hill_unstable']) | \
+        (mardling < 1.)
+    stable = ~unstable & (hill >= limit['hill_stable']) & \
+        (mardling >= limit['ma_stable']) & (tidal <= limit['tidal_max'])
+    out['tag'][unstable] = 'skip-unstable'
+    out['tag'][stable] = 'skip-stable'
+    for k in np.flatnonzero(unstable | stable):
+        if unbound[k]:
+            reason = 'unbound orbit'
+        elif crossing[k]:
+            reason = 'adjacent orbits cross'
+        elif hill[k] < limit['hill_unstable']:
+            reason = f'bodies {hill[k]:.2f} mutual Hill radii apart < ' + \
+                f'{limit["hill_unstable"]:.2f}'
+        elif mardling[k] < 1.:
+            reason = f'Mardling-Aarseth ratio {mardling[k]:.2f} < 1'
+        else:
+            reason = f'Hill spacing {hill[k]:.1f} >= ' + \
+                f'{limit["hill_stable"]:g}, Mardling-Aarseth ratio ' + \
+                f'{mardling[k]:.1f} >= {limit["ma_stable"]:g}, tide ' + \
+                f'{tidal[k]:.1e} <= {limit["tidal_max"]:g}'
+        out['reason'][k] = reason
+    return out
+
+
+def screen_sweep(cfg, indices, seed):
+    """Sample the sims of a sweep and screen them at once.
+
+    The sims are drawn by param_sampling.sample_each out of the sample
+    blocks of seed, exactly as construct_jobs.construct_sweep would, so the
+    returned {index: params} builds the same directories. Returns (screen
+    rows in indices order, params).
+    """
+    sims, bodies, params = sample_each(cfg, indices, seed)
+    return screen(cfg, sims, bodies), params
+
+
+def write_screening(fname, rows):
+    """Write the tag and reason of the skipped sims, returns the counts."""
+    counts = {k: int(np.sum(rows['tag'] == k))
+              for k in ('run', 'skip-unstable', 'skip-stable')}
+    skipped = rows[rows['tag'] != 'run']
+    with open(fname, 'w') as f:
+        json.dump({'counts': counts,
+                   'skipped': [{'sim': int(x['sim']), 'tag': str(x['tag']),
+                                'reason': str(x['reason'])}
+                               for x in skipped]}, f, indent=1)
+    return counts
+
+
+def test():
+    """Testing function for module."""
+    from param_sampling import sim_dtype, body_dtype, kepler_to_xyz
+
+    def orbit(a, e=0., inc=0., m=1.):
+        return kepler_to_xyz(np.array([a]), np.array([e]), np.array([inc]),
+                             np.zeros(1), np.zeros(1), np.zeros(1),
+                             np.array([m]))[0]
+
+    class cfg:
+        cluster_mass, cluster_radius = 1e-12, 5e4
+    # 0: close bodies, 1: wide bodies far inside a wide binary,
+    # 2: body next to the binary, 3: crossing orbits,
+    # 4: body inside an eccentric binary, above the limit but not by 2x
+    layout = [(50., 0., [(5., 0.), (5.2, 0.)]),
+              (1000., 0., [(1., 0.), (4., 0.)]),
+              (10., 0., [(8., 0.)]),
+              (1000., 0., [(5., .5), (8., .5)]),
+              (20., .6, [(1., 0.)])]
+    sims = np.zeros(len(layout), dtype=sim_dtype)
+    bodies = np.zeros(sum(len(x[2]) for x in layout), dtype=body_dtype)
+    k = 0
+    for s, (ab, eb, orbits) in enumerate(layout):
+        sims[s]['sim'] = s
+        sims[s]['central_mass'] = 1.
+        sims[s]['binary_mass'] = .5
+        sims[s]['binary_orbit'] = orbit(ab, eb, m=1.5)
+        for a, e in orbits:
+            bodies[k]['sim'] = s
+            bodies[k]['mass'] = 1e-3
+            bodies[k]['orbit'] = orbit(a, e, m=1.001)
+            k += 1
+    a, e, _ = elements(bodies['orbit'][3:4], kepler * 1.001)
+    assert abs(a[0] - 4.) < 1e-9 and e[0] < 1e-9
+    out = screen(cfg, sims, bodies)
+    assert list(out['tag']) == ['skip-unstable', 'skip-stable',
+                                'skip-unstable', 'skip-unstable', 'run']
+    assert 'Hill' in out['reason'][0] and 'cross' in out['reason'][3]
+    assert 'Mardling' in out['reason'][2]
+    assert 1.6 < out['mardling'][4] < 1.8
+    # an eccentric binary outside a body, R_p / a_in against the limit
+    ratio = _mardling(1., 10., .6, 0., 0.)
+    assert abs(ratio - 4. / (2.8 * 1.6 ** .4 * .4 ** -.2)) < 1e-12
+    out = screen(cfg, sims, bodies, tidal_max=0.)
+    assert out['tag'][1] == 'run' and out['reason'][1] == ''
+
+    import os
+    import tempfile
+    fname = os.path.join(tempfile.mkdtemp(), 'screening.json')
+    counts = write_screening(fname, out)
+    assert counts == {'run': 2, 'skip-unstable': 3, 'skip-stable': 0}
+    with open(fname) as f:
+        assert [x['sim'] for x in json.load(f)['skipped']] == [0, 2, 3]
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code
@@ -3,94 +3,47 @@
 # internal modules
 import os
 from argparse import ArgumentParser as ap
-import threading
-import queue
 import re
-from time import sleep, time
+from time import time
 import itertools
 
 # external modules
-from nkrpy.load import load_cfg, verify_dir
-from nkrpy.files import freplace
-from nkrpy.mp import run_seq_command as run_command
-from nkrpy.coordinates import checkconv
+import numpy as np
 
 # relative modules
 import construct_jobs
+import instrument
+import job_status
+# the submission modes import their own modules (asyncio, sqlite3, ...)
+# when they are used
 
 # global attributes
-__all__ = ('test', 'main')
+__all__ = ('test', 'main', 'add_arguments')
 __doc__ = """."""
 __filename__ = __file__.split('/')[-1].strip('.py')
 __path__ = __file__.strip('.py').strip(__filename__)
 __version__ = 0.1
 
-__max_queue__ = -1
-
 """
 read config > timelimit jobname dir cmd num_sim
-run job checker in bg (threading)
+generate, render, submit and track sims in one event loop (async_submit)
 write slurm file > above
 slurm file calls construct_jobs
 slurm file cd and calls the mercury program
 """
 
 
-def worker(q, f, wkr):
-    """Worker wrapper for threading queue."""
-    """Receives call to being queue, gets qeueue
-    item val, submits job, checks for job status,
-    adds to final array and quits."""
-    while True:
-        try:
-            item = q.get(block=True, timeout=10)
-            if item is None:
-                break
-            date = str(time()).replace('.', '-')
-            print(f'Working on {item[0] + 1}')
-            construct_jobs.main(item[1], date)
-            build_slurm(item[1], date)
-            item = sub_job(item[1], item[0] + 1, date)
-            f.add(item)
-            q.task_done()
-        except queue.Empty:
-            print(f'Worker {wkr} is exiting due to timeout.')
-            break
-        sleep(0.01)
-    pass
-
-
-def fill_queue(cfg, q):
-    count = itertools.count()
-    limit = checkconv(cfg.timelimit) * 3600.
-    while True:
-        n = count.__next__()
-        try:
-            q.put([n, cfg], block=True, timeout=limit)
-        except queue.Full:
-            print("Filler exiting, timeout/full")
-            break
-        if (n >= cfg.num_simulations) and (cfg.num_simulations != -1):
-            print(f'Queue filled: {n}')
-            break
-        sleep(0.01)
-    pass
-
-
 def build_slurm(cfg, modelnum):
+    """Record the sim in the restart script.
+
+    slurm.sh itself is rendered by construct_jobs.generate_sim, the outputs
+    are converted afterwards by post_process.py.
+    """
     dest = f'{cfg.destination}/{cfg.naming_schema}/' +\
         f'{cfg.naming_schema}_sim{modelnum}'.replace('//', '/')
-    freplace(f'{dest}/slurm.sh', '<name>', cfg.naming_schema)
-    freplace(f'{dest}/slurm.sh', '<timelimit>', cfg.timelimit)
-    freplace(f'{dest}/slurm.sh', '<workdir>', dest)
-    freplace(f'{dest}/slurm.sh', '<cmd>', cfg.program)
     with open(f'{cfg.destination}/{cfg.naming_schema}/' +
               f'slurm_master_restart_{cfg.time}.sh', 'a') as f:
         f.write(f'sbatch {dest}/slurm.sh &\n')
-    with open(f'{cfg.destination}/{cfg.naming_schema}/' +
-              f'refresh_outputs_{cfg.time}.sh', 'a') as f:
-        f.write(f'set -e;cd {cfg.naming_schema}_sim{modelnum} ;' +
-                f' ./element6 ;echo "Finished {modelnum}";cd ../\n')
 
 def recover_job(string):
     """Parse jobnumber."""
@@ -105,84 +58,253 @@ def recover_job(string):
 
 
 def check_status(jobnum):
-    """Check jobstatus."""
-    uname = 'whoami'
-    result = run_command([uname]).__next__().decode("utf-8").strip('\n')
-    queue = "squeue -u <uname>".replace('<uname>', result)  # noqa
-    for i, output in enumerate(run_command(queue.split(' '))):
-        output = output.decode("utf-8").strip('\n')
-        if str(jobnum) in output:
-            return True
-    print('Job finished:', jobnum)
-    return False
-
-
-def sub_job(cfg, jobnum, modelnum):
-    dest = f'{cfg.destination}/{cfg.naming_schema}/' +\
-           f'{cfg.naming_schema}_sim{modelnum}/'.replace('//', '/')
-    job = False
-    sub_count = 0
-    while not job and ((sub_count / 60.) < checkconv(cfg.timelimit) *
-                       3600. * 1.1):
-        run = f'sbatch {dest}slurm.sh'
-        result = run_command(run.split(' ')).__next__()\
-            .decode("utf-8").strip('\n')
-        job = recover_job(result)
-        sub_count += 1
-        sleep(1)
-    if job:
-        print(f'Submitted Job {jobnum} ID: {job}...in dir: <{dest}>')
-        return job
-    else:
-        print('Timeout occured')
+    """Check jobstatus, one shared squeue per status_ttl for all jobs."""
+    return job_status.check_status(jobnum)
 
 
-def job_manager(cfg):
-    """Main job handler."""
-    # startup workers
-    __job_start__ = queue.Queue(maxsize=__max_queue__)
-    __job_finish__ = set()
-    cfg.sub = {}
+def render_sim(cfg, modelnum, params):
+    """Write one sim from its sampled parameters, returns its slurm.sh."""
+    sim = construct_jobs.generate_sim(cfg, modelnum, params=params)
+    build_slurm(cfg, modelnum)
+    return f'{sim}/slurm.sh'
 
-    threads = [threading.Thread(target=worker, args=(__job_start__,
-                                __job_finish__, i))
-               for i in range(cfg.num_threads)]
 
-    threads.insert(0, threading.Thread(target=fill_queue,
-                                       args=(cfg, __job_start__)))
+def open_ledger(cfg):
+    """Open the sweep ledger in the destination directory."""
+    import job_ledger
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    return job_ledger.Ledger(dest + getattr(cfg, 'ledger', 'ledger.sqlite'))
 
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
-    print(f'Finished Submitting these jobs:\n{__job_finish__}')
-    pass
 
+def job_manager(cfg, resume=False):
+    """Main job handler, runs the async generate/render/submit pipeline.
+
+    With resume, only the sims of sweep cfg.time the ledger does not list
+    as finished are acted on.
+    """
+    construct_jobs.prepare_destination(cfg)
+    ledger = open_ledger(cfg)
+    numbers, todo = None, ()
+    if resume:
+        total = ledger.total(cfg.time)
+        if total is None:
+            print(f'Sweep <{cfg.time}> is not in the ledger <{ledger.fname}>')
+            exit()
+        cfg.num_simulations = total
+        todo = ledger.incomplete(cfg.time)
+        known = ledger.known(cfg.time)
+        if total == -1:
+            numbers = itertools.count(max(known, default=-1) + 1)
+        else:
+            numbers = sorted(set(range(total)) - known)
+        print(f'Resuming {cfg.time}: {ledger.counts(cfg.time)}')
+    ledger.start(cfg.time, cfg.num_simulations)
+    import async_submit
+    try:
+        with instrument.span('submit.sweep'):
+            jobs = async_submit.run(cfg, render_sim, ledger=ledger,
+                                    numbers=numbers, resume=todo)
+    finally:
+        ledger.close()
+    instrument.count('submit.jobs', len(jobs))
+    print(f'Finished Submitting these jobs:\n{set(jobs)}')
+    return jobs
+
+
+def construct_all(cfg, ledger=None):
+    """Construct every sim of the sweep.
+
+    Returns {sim directory: sim number} in sim order. With a ledger the
+    screened out sims are recorded skipped and the built ones generated.
+    """
+    jobnumbers = [(n, f'{cfg.time}-{n}')
+                  for n in range(cfg.num_simulations)]
+    seed = np.random.SeedSequence(getattr(cfg, 'seed', None))
+    params = None
+    if getattr(cfg, 'screen_sims', False):
+        import stability
+        with instrument.span('construct.screen', sims=len(jobnumbers)):
+            rows, params = stability.screen_sweep(
+                cfg, [x[0] for x in jobnumbers], seed)
+        dest = construct_jobs.prepare_destination(cfg)
+        counts = stability.write_screening(f'{dest}screening_{cfg.time}.json',
+                                           rows)
+        print(f'Screened {len(rows)} sims: {counts}')
+        keep = set(rows['sim'][rows['tag'] == 'run'].tolist())
+        jobnumbers = [x for x in jobnumbers if x[0] in keep]
+        if ledger is not None:
+            for row in rows[rows['tag'] != 'run']:
+                n = int(row['sim'])
+                ledger.record(cfg.time, n, 'skipped', params=dict(
+                    params[n], screen=str(row['tag']),
+                    reason=str(row['reason'])))
+    print(f'Constructing {len(jobnumbers)} sims')
+    sims = construct_jobs.construct_sweep(cfg, jobnumbers, seed,
+                                          params=params)
+    ret = {}
+    for (n, modelnum), sim in zip(jobnumbers, sims):
+        ret[os.path.abspath(sim)] = n
+        if ledger is not None:
+            ledger.record(cfg.time, n, 'generated', modelnum=modelnum,
+                          directory=sim)
+    return ret
 
-def main(cfg_name):
+
+def _record_submitted(cfg, ledger, sims, owners):
+    """Record the job (or array task) of every submitted sim."""
+    for sim, job in owners.items():
+        if sim in sims:
+            ledger.record(cfg.time, sims[sim], 'submitted', job_id=job)
+    ledger.close()
+
+
+def array_manager(cfg):
+    """Construct every sim, then submit them as Slurm job arrays."""
+    import slurm_array
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    ledger = open_ledger(cfg)
+    ledger.start(cfg.time, cfg.num_simulations)
+    sims = construct_all(cfg, ledger)
+    with instrument.span('submit.arrays'):
+        jobs = slurm_array.submit_sweep(cfg, list(sims), dest,
+                                        getattr(cfg, 'array_throttle', 0))
+    _record_submitted(cfg, ledger, sims, slurm_array.sim_jobs(jobs))
+    print(f'Finished Submitting these arrays:\n{set(jobs)}')
+    return jobs
+
+
+def bundle_manager(cfg):
+    """Construct every sim, then submit them in bundles of bundle_cores."""
+    import slurm_array
+    import bundle_runner
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    ledger = open_ledger(cfg)
+    ledger.start(cfg.time, cfg.num_simulations)
+    sims = construct_all(cfg, ledger)
+    with instrument.span('submit.bundles'):
+        jobs = bundle_runner.submit_bundles(cfg, list(sims), dest)
+    _record_submitted(cfg, ledger, sims, slurm_array.sim_jobs(jobs, False))
+    print(f'Finished Submitting these bundles:\n{set(jobs)}')
+    return jobs
+
+
+def requeue_manager(cfg):
+    """Resubmit timed out or preempted sims as continuations."""
+    import requeue
+    jobs = requeue.requeue(cfg)
+    print(f'Requeued these continuations:\n{set(jobs)}')
+    return jobs
+
+
+def watch_manager(cfg):
+    """Stop running sims once their outcome is decided."""
+    import watcher
+    stopped = watcher.watch(cfg)
+    print(f'Stopped these sims early:\n{stopped}')
+    return stopped
+
+
+def add_arguments(parser):
+    """Add the command line options of main to an argparse parser."""
+    parser.add_argument('-c', help='configuration file', default='config.py')
+    parser.add_argument('--array', help='submit the sweep as job arrays',
+                        action='store_true')
+    parser.add_argument('--resume', help='sweep (its time stamp) to resume '
+                        'from the ledger', default=None)
+    parser.add_argument('--bundle', help='pack the sims into allocations of '
+                        'bundle_cores cores', action='store_true')
+    parser.add_argument('--requeue', help='resubmit interrupted sims from '
+                        'their dump files', action='store_true')
+    parser.add_argument('--watch', help='stop running sims whose outcome '
+                        'is decided', action='store_true')
+    return parser
+
+
+def main(cfg_name, array=False, resume=None, bundle=False, cont=False,
+         watch=False):
     """Main caller function."""
+    from nkrpy.load import load_cfg, verify_dir
     config = load_cfg(cfg_name)
-    config.time = str(time()).replace('.', '_')
+    config.time = resume or str(time()).replace('.', '_')
     dest = f'{config.destination}/{config.naming_schema}/'.replace('//', '/')
     verify_dir(dest, True)
-    job_manager(config)
+    job_status.status_cache.ttl = getattr(config, 'status_ttl',
+                                          job_status.__ttl__)
+    if getattr(config, 'trace', None):
+        print('Recording timings to',
+              instrument.enable(config.trace, config.time))
+    if resume is not None and (array or bundle):
+        # arrays and bundles are built and submitted whole, only the
+        # default pipeline knows how to pick up a sweep half way
+        print('--resume only works with the default submission, not with '
+              '--array or --bundle')
+        exit()
+    if watch:
+        watch_manager(config)
+    elif cont:
+        requeue_manager(config)
+    elif bundle:
+        bundle_manager(config)
+    elif array:
+        array_manager(config)
+    else:
+        job_manager(config, resume is not None)
     exit()
     pass
 
 
 def test():
     """Testing function for module."""
+    import types
+    import shutil
+    import tempfile
+    import configuration_jobsubmission
+    tmpdir = tempfile.mkdtemp()
+    # fake sbatch numbers its calls
+    with open(f'{tmpdir}/sbatch', 'w') as f:
+        f.write('#!/bin/sh\necho "$@" >> "{0}/calls"\n'
+                'echo "$(wc -l < "{0}/calls")"\n'.format(tmpdir))
+    os.chmod(f'{tmpdir}/sbatch', 0o755)
+    # sims link their inputs, never to the tracked template
+    template = f'{tmpdir}/template'
+    shutil.copytree(os.path.join(construct_jobs._cwd_,
+                                 configuration_jobsubmission.
+                                 parent_mercury_inputs), template,
+                    symlinks=True)
+    path = os.environ['PATH']
+    os.environ['PATH'] = f'{tmpdir}:{path}'
+    try:
+        for sweep, manager in (('0', array_manager), ('1', bundle_manager)):
+            cfg = types.SimpleNamespace(**construct_jobs._cfg_dict(
+                configuration_jobsubmission))
+            cfg.destination, cfg.naming_schema = tmpdir, 'test'
+            cfg.parent_mercury_inputs = template
+            cfg.time, cfg.seed, cfg.num_simulations = sweep, 0, 5
+            cfg.max_array_size, cfg.bundle_cores, cfg.bundle_size = 3, 2, 4
+            cfg.construct_workers = 2
+            os.makedirs(f'{tmpdir}/test', exist_ok=True)
+            open(f'{tmpdir}/test/{cfg.program}', 'w').close()
+            manager(cfg)
+        ledger = open_ledger(cfg)
+        assert ledger.counts('0') == {'submitted': 5}
+        assert ledger.counts('1') == {'submitted': 5}
+        jobs = {x[0]: x[3] for x in ledger.incomplete('0')}
+        assert jobs == {0: '1_0', 1: '1_1', 2: '1_2', 3: '2_0', 4: '2_1'}
+        assert {x[3] for x in ledger.incomplete('1')} == {'3', '4'}
+        ledger.close()
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(tmpdir)
     pass
 
 
 if __name__ == "__main__":
     """Directly Called."""
-    parser = ap()
-    parser.add_argument('-c', help='configuration file', default='config.py')
-    args = parser.parse_args()
+    args = add_arguments(ap()).parse_args()
 
     print('Running Job')
-    main(args.c)
+    main(args.c, args.array, args.resume, args.bundle, args.requeue,
+         args.watch)
     print('Finished')
 
 # end of code
@@ -0,0 +1,403 @@
+"""Stop running sims as soon as their outcome is decided."""
+
+# internal modules
+import os
+import re
+import signal
+import subprocess
+from argparse import ArgumentParser as ap
+from time import sleep, time
+try:
+    import cPickle as pickle
+except ModuleNotFoundError:
+    import pickle
+
+# external modules
+import numpy as np
+
+# relative modules
+import job_status
+from ensemble_store import read_big
+from xv_decoder import _c2re, _c2fl, _maxindex
+from slurm_array import simlist
+
+# global attributes
+__all__ = ('test', 'parse_info', 'parse_ce', 'SimWatch', 'stop_sim',
+           'record_reason', 'sim_of', 'watch', 'conditions')
+__doc__ = """Early termination watcher.
+
+Each running sim's info.out and ce.out are tailed incrementally, only the
+bytes appended since the last look are read. info.out gives the removals
+(ejections, collisions with the central body or another body, removals by
+encounter or small a), ce.out gives the close encounter minima. After
+every look the configured terminal conditions are checked, the first that
+holds ends the sim: its job is scancel'ed (or its local process sent
+SIGTERM), the reason is stored under 'termination' in the sim's
+configuration_params.pickle and the finished marker is written so the sim
+is not requeued. Array tasks run from the script directory and are matched
+to their sim through the sim list of the array (sim_of), other jobs
+through the sweep ledger or their work directory. Conditions:
+    testp_ejected  the passing star TESTP is gone
+    bodies_lost    every BODY is gone
+    binary_lost    the binary WB is gone
+    collision      any collision happened
+    encounter      a close encounter within encounter_au"""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+__conditions__ = ('testp_ejected', 'bodies_lost')
+_record = b'\x0c6b'
+_events = (
+    ('collision', re.compile(r'^\s*(\S+)\s+collided with the central body')),
+    ('ejected', re.compile(r'^\s*(\S+)\s+ejected at')),
+    ('collision', re.compile(r'^\s*(\S+)\s+was hit by\s+(\S+)')),
+    ('removed', re.compile(r'^\s*(\S+)\s+removed due to an encounter with'
+                           r'\s+(\S+)')),
+    ('removed', re.compile(r'^\s*(\S+)\s+removed due to small a')))
+
+
+def parse_info(lines):
+    """Return [(event, lost body)] of info.out lines."""
+    ret = []
+    for line in lines:
+        for event, regex in _events:
+            match = regex.match(line)
+            if match:
+                # 'i was hit by j' merges j into i
+                lost = match.group(2) if 'hit by' in regex.pattern \
+                    else match.group(1)
+                ret.append((event, lost))
+                break
+    return ret
+
+
+def parse_ce(buf):
+    """Decode complete ce.out records, returns (i, j, distance) arrays."""
+    recs = [x[:70] for x in buf.split(_record)[1:] if len(x) >= 70]
+    if not recs:
+        empty = np.zeros(0)
+        return empty.astype(np.int64), empty.astype(np.int64), empty
+    c = np.frombuffer(b''.join(recs), dtype=np.uint8).reshape(-1, 70)
+    i = (.5 + _c2re(c[:, 8:11], 0., _maxindex)).astype(np.int64) + 1
+    j = (.5 + _c2re(c[:, 11:14], 0., _maxindex)).astype(np.int64) + 1
+    return i, j, _c2fl(c[:, 14:22])
+
+
+class _Tail(object):
+    """Read what was appended to a file since the last call."""
+
+    def __init__(self, fname, sep=b'\n'):
+        """Start at the beginning of fname."""
+        self.fname = fname
+        self.sep = sep
+        self.offset = 0
+        self.rest = b''
+
+    def read(self):
+        """Return the new complete bytes, up to the last separator."""
+        try:
+            with open(self.fname, 'rb') as f:
+                f.seek(self.offset)
+                new = f.read()
+        except FileNotFoundError:
+            return b''
+        self.offset += len(new)
+        buf = self.rest + new
+        end = buf.rfind(self.sep) + 1
+        self.rest = buf[end:]
+        return buf[:end]
+
+
+def _testp_ejected(w):
+    """The passing star was removed."""
+    return 'TESTP' in w.lost
+
+
+def _bodies_lost(w):
+    """Every body was removed."""
+    return bool(w.bodies) and w.bodies <= w.lost
+
+
+def _binary_lost(w):
+    """The binary was removed."""
+    return 'WB' in w.lost
+
+
+def _collision(w):
+    """Any collision happened."""
+    return any(x[0] == 'collision' for x in w.events)
+
+
+def _encounter(w):
+    """A close encounter within encounter_au."""
+    return w.encounter_au > 0 and w.closest < w.encounter_au
+
+
+conditions = {'testp_ejected': _testp_ejected, 'bodies_lost': _bodies_lost,
+              'binary_lost': _binary_lost, 'collision': _collision,
+              'encounter': _encounter}
+
+
+class SimWatch(object):
+    """Incremental state of one running sim."""
+
+    def __init__(self, sim, watch=__conditions__, encounter_au=0.):
+        """Watch sim for the named conditions."""
+        self.sim = sim
+        self.watch = tuple(watch)
+        self.encounter_au = encounter_au
+        self.bodies = {x for x in read_big(f'{sim}/big.in')
+                       if x.startswith('BODY')}
+        self.events = []
+        self.lost = set()
+        self.closest = np.inf
+        self.info = _Tail(f'{sim}/info.out')
+        self.ce = _Tail(f'{sim}/ce.out', b'\n')
+
+    def check(self):
+        """Read the new output, returns the first reason to stop or None."""
+        lines = self.info.read().decode('utf-8', errors='replace')
+        events = parse_info(lines.splitlines())
+        self.events.extend(events)
+        self.lost.update(x[1] for x in events)
+        if 'encounter' in self.watch:
+            d = parse_ce(self.ce.read())[2]
+            if d.shape[0]:
+                self.closest = min(self.closest, float(d.min()))
+        for name in self.watch:
+            if conditions[name](self):
+                return name
+        return None
+
+
+def stop_sim(job=None, proc=None, scancel='scancel'):
+    """scancel a job, or SIGTERM a local process (Popen or pid)."""
+    if job is not None:
+        run = subprocess.run([scancel, str(job)], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        return run.returncode == 0
+    if proc is not None:
+        try:
+            if isinstance(proc, int):
+                os.kill(proc, signal.SIGTERM)
+            else:
+                proc.terminate()
+        except (ProcessLookupError, OSError):
+            return False
+        return True
+    return False
+
+
+def record_reason(sim, reason, events=()):
+    """Store why the sim ended and mark it finished."""
+    fname = f'{sim}/configuration_params.pickle'
+    record = {}
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            record = pickle.load(f)
+    record['termination'] = {'reason': reason, 'time': time(),
+                             'events': list(events)}
+    with open(f'{fname}.tmp', 'wb') as f:
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{fname}.tmp', fname)
+    open(f'{sim}/finished', 'a').close()
+    pass
+
+
+def _queued(squeue='squeue'):
+    """[(job id, state, work dir, script)] of our pending and running jobs.
+
+    None when squeue fails.
+    """
+    run = subprocess.run([squeue, '-h', '-u', job_status.username(),
+                          '-t', 'PENDING,RUNNING', '-o', '%i|%T|%Z|%o'],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if run.returncode != 0:
+        print('squeue failed:', run.stderr.decode('utf-8').strip())
+        return None
+    ret = []
+    for line in run.stdout.decode('utf-8').splitlines():
+        if line.count('|') < 3:
+            continue
+        job, state, workdir, script = (x.strip() for x in
+                                       line.split('|', 3))
+        ret.append((job, state, os.path.normpath(workdir), script))
+    return ret
+
+
+def _ledger_jobs(cfg):
+    """{job id: sim} of the jobs the sweep ledger records for one sim."""
+    dest = f'{cfg.destination}/{cfg.naming_schema}/'.replace('//', '/')
+    fname = dest + getattr(cfg, 'ledger', 'ledger.sqlite')
+    if not os.path.isfile(fname):
+        return {}
+    import job_ledger
+    ledger = job_ledger.Ledger(fname)
+    sims = {}
+    for sweep, n, sim, job in ledger.directories():
+        if job:
+            sims.setdefault(job, set()).add(os.path.normpath(sim))
+    ledger.close()
+    # a bundle job runs many sims, it watches them itself
+    return {k: v.pop() for k, v in sims.items() if len(v) == 1}
+
+
+def sim_of(job, workdir, script, jobs=None):
+    """Sim directory a running job works on.
+
+    Array tasks run from the script directory, task T of an array runs
+    line T of the sim list beside its script; other jobs are looked up in
+    jobs ({job id: sim}, see the ledger) and last in their work directory.
+    """
+    parent, _, task = job.partition('_')
+    if task.isdigit() and script.endswith('.sh'):
+        fname = simlist(script)
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                lines = [x.strip() for x in f if x.strip()]
+            if int(task) < len(lines):
+                return os.path.normpath(lines[int(task)])
+    return (jobs or {}).get(job, workdir)
+
+
+def watch(cfg, interval=None, squeue='squeue', scancel='scancel',
+          once=False):
+    """Watch every running job of ours until none is left.
+
+    Pending jobs keep the loop going (submission may still be filling the
+    queue, or an array waits for its next throttled wave), only running
+    ones are watched. Returns {sim: reason} of the sims that were stopped.
+    """
+    interval = interval or getattr(cfg, 'watch_interval', 60.)
+    names = getattr(cfg, 'watch_conditions', __conditions__)
+    encounter_au = getattr(cfg, 'watch_encounter_au', 0.)
+    watches, stopped = {}, {}
+    jobs = _ledger_jobs(cfg) if hasattr(cfg, 'destination') else {}
+    while True:
+        queued = _queued(squeue)
+        if queued is None:
+            sleep(interval)
+            continue
+        running = {job: sim_of(job, workdir, script, jobs)
+                   for job, state, workdir, script in queued
+                   if state == 'RUNNING'}
+        for job, sim in running.items():
+            if sim in stopped or not os.path.isfile(f'{sim}/param.in'):
+                continue
+            if job not in watches:
+                watches[job] = SimWatch(sim, names, encounter_au)
+            reason = watches[job].check()
+            if reason and stop_sim(job=job, scancel=scancel):
+                print(f'Stopped {sim} ({job}): {reason}')
+                record_reason(sim, reason, watches[job].events)
+                stopped[sim] = reason
+        for job in set(watches) - set(running):
+            del watches[job]
+        if once or not queued:
+            break
+        sleep(interval)
+    return stopped
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    from xv_decoder import _re2c, _fl2c
+    tmpdir = tempfile.mkdtemp()
+    sim = f'{tmpdir}/test_sim0'
+    os.mkdir(sim)
+    with open(f'{sim}/big.in', 'w') as f:
+        f.write(' WB m=1.D0 r=0.D0 d=5.43D0\n BODY0 m=1.D-3 r=0 d=3.D0\n'
+                ' BODY1 m=1.D-3 r=0 d=3.D0\nTESTP m=1.D-81 r=0.D0 d=0.D0\n')
+    with open(f'{sim}/configuration_params.pickle', 'wb') as f:
+        pickle.dump({'sub': {'job_number': '0'}}, f)
+    w = SimWatch(sim, ('testp_ejected', 'bodies_lost', 'encounter'), 0.01)
+    with open(f'{sim}/info.out', 'w') as f:
+        f.write(' BODY0    collided with the central body at   10.0 years\n'
+                ' BODY1    was hit by WB at 1')
+    assert w.check() is None and w.lost == {'BODY0'}
+    with open(f'{sim}/info.out', 'a') as f:
+        f.write('2.0 years\n TESTP    ejected at  13.0 years\n')
+    assert w.check() == 'testp_ejected'
+    assert w.lost == {'BODY0', 'WB', 'TESTP'}
+
+    def ce_record(i, j, d):
+        c = _fl2c(100.) + _re2c(i - 1, 0., _maxindex)[:3] + \
+            _re2c(j - 1, 0., _maxindex)[:3] + _fl2c(d)
+        return _record + c + b' ' * (70 - len(c)) + b'\n'
+
+    w = SimWatch(sim, ('encounter',), 0.01)
+    with open(f'{sim}/ce.out', 'wb') as f:
+        f.write(ce_record(2, 3, 0.5) + ce_record(3, 5, 0.005)[:40])
+    assert w.check() is None and abs(w.closest - 0.5) < 1e-6
+    with open(f'{sim}/ce.out', 'ab') as f:
+        f.write(ce_record(3, 5, 0.005)[40:])
+    assert w.check() == 'encounter'
+    i, j, d = parse_ce(ce_record(3, 5, 0.005))
+    assert (i[0], j[0]) == (3, 5)
+
+    # sim0 is a single job running in its directory, sim1 task 1 of an
+    # array running from the script directory
+    import shutil
+    array = f'{sim[:-1]}1'
+    shutil.copytree(sim, array)
+    with open(f'{tmpdir}/array_0_0.txt', 'w') as f:
+        f.write(f'{tmpdir}/other_sim\n{array}\n')
+    for name, text in (('squeue', f'echo "77|RUNNING|{sim}|{sim}/slurm.sh"\n'
+                                  f'echo "80_1|RUNNING|{tmpdir}|'
+                                  f'{tmpdir}/array_0_0.sh"\n'
+                                  f'echo "80_[2-4]|PENDING|{tmpdir}|'
+                                  f'{tmpdir}/array_0_0.sh"'),
+                       ('scancel', f'echo "$@" >> {tmpdir}/cancelled')):
+        with open(f'{tmpdir}/{name}', 'w') as f:
+            f.write(f'#!/bin/sh\n{text}\n')
+        os.chmod(f'{tmpdir}/{name}', 0o755)
+    for x in (sim, array):
+        os.remove(f'{x}/ce.out')
+        open(f'{x}/param.in', 'w').close()
+    assert sim_of('80_1', tmpdir, f'{tmpdir}/array_0_0.sh') == array
+    assert sim_of('81', tmpdir, f'{tmpdir}/x.sh', {'81': sim}) == sim
+
+    class cfg:
+        watch_conditions = ('bodies_lost', 'testp_ejected')
+    stopped = watch(cfg, 1., f'{tmpdir}/squeue', f'{tmpdir}/scancel',
+                    once=True)
+    assert stopped == {sim: 'testp_ejected', array: 'testp_ejected'}
+    with open(f'{tmpdir}/cancelled') as f:
+        assert f.read().split() == ['77', '80_1']
+    with open(f'{sim}/configuration_params.pickle', 'rb') as f:
+        assert pickle.load(f)['termination']['reason'] == 'testp_ejected'
+    assert os.path.isfile(f'{sim}/finished')
+    # only pending jobs left: keep looking until the queue is empty
+    with open(f'{tmpdir}/squeue', 'w') as f:
+        f.write(f'#!/bin/sh\necho x >> {tmpdir}/polls\n'
+                f'[ $(wc -l < {tmpdir}/polls) -lt 3 ] && '
+                f'echo "90|PENDING|{tmpdir}|{tmpdir}/x.sh"\nexit 0\n')
+    assert watch(cfg, .01, f'{tmpdir}/squeue', f'{tmpdir}/scancel') == {}
+    with open(f'{tmpdir}/polls') as f:
+        assert len(f.readlines()) == 3
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+    parser = ap()
+    parser.add_argument('-c', help='configuration file', default='config.py')
+    parser.add_argument('-i', help='seconds between looks', type=float,
+                        default=None)
+    parser.add_argument('--test', help='run the module test',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        print('Testing module')
+        test()
+        print('Test Passed')
+    else:
+        from nkrpy.load import load_cfg
+        print('Watching')
+        watch(load_cfg(args.c), args.i)
+        print('Finished')
+
+# end of code
@@ -0,0 +1,315 @@
+"""Decode Mercury xv.out straight into numpy arrays."""
+
+# internal modules
+import os
+
+# external modules
+import numpy as np
+
+# relative modules
+
+# global attributes
+__all__ = ('test', 'read_xv', 'header')
+__doc__ = """Pure numpy port of the xv.out decoding done by element6.
+
+Follows the main loop of element6.for together with mio_c2re, mio_c2fl and
+mco_ov2x. Each body comes back as an (8, steps) array of
+(t, x, y, z, u, v, w, m), the same layout read_aei gives for the .aei files
+element6 writes with the element.in shipped in mercury_parent/files, so the
+element6 step and the text round trip can be skipped entirely.
+
+Only central body and barycentric coordinates are supported. The 'a'
+records are decoded for both the 8 character (mercury6 writer) and the 25
+character (element6 reader) name layouts."""
+__filename__ = __file__.split('/')[-1].strip('.py')
+__path__ = __file__.strip('.py').strip(__filename__)
+__version__ = 0.1
+
+# mercury.inc
+K2 = 2.959122082855911e-4
+PI = 3.141592653589793
+TWOPI = 2. * PI
+_maxindex = 11239424.
+_nchar = {1: 2, 2: 4, 3: 7}
+
+header = ['Time(years)', 'x', 'y', 'z', 'u', 'v', 'w', 'm']
+
+
+def _c2re(c, xmin, xmax):
+    """Vectorized mio_c2re over an (n, nchar) uint8 array."""
+    y = np.zeros(c.shape[0], dtype=np.float64)
+    for j in range(c.shape[1] - 1, -1, -1):
+        y = (y + (c[:, j].astype(np.float64) - 32.)) / 224.
+    return xmin + y * (xmax - xmin)
+
+
+def _c2fl(c):
+    """Vectorized mio_c2fl over an (n, 8) uint8 array."""
+    x = _c2re(c[:, :7], 0., 1.) * 2. - 1.
+    ex = c[:, 7].astype(np.float64) - 32. - 112.
+    return x * (10. ** ex)
+
+
+def _fixed(buf, starts, width):
+    """Gather a fixed width field from each line start into (n, width)."""
+    return buf[starts[:, np.newaxis] + np.arange(width)]
+
+
+def _special(raw, buf, starts, lengths, line):
+    """Decode an 'a' record: parameters and per body names and masses."""
+    s = starts[line]
+    algor = int(raw[s + 3:s + 5])
+    precision = int(raw[s + 67:s + 68])
+    cc = _fixed(buf, np.array([s + 5]), 62)
+    nbig = int(.5 + _c2re(cc[:, 8:11], 0., _maxindex)[0])
+    nsml = int(.5 + _c2re(cc[:, 11:14], 0., _maxindex)[0])
+    mcen = _c2fl(cc[:, 14:22])[0]
+    rcen = _c2fl(cc[:, 46:54])[0]
+    rmax = _c2fl(cc[:, 54:62])[0]
+    lines = np.arange(line + 1, line + 1 + nbig + nsml)
+    lines = lines[lines < starts.shape[0]]
+    # element6 reads 25 character names, the mercury6 writer uses 8
+    idlen = 25 if lengths[lines].min(initial=68) >= 68 else 8
+    c = _fixed(buf, starts[lines], 3 + idlen + 8)
+    code = (.5 + _c2re(c[:, :3], 0., _maxindex)).astype(np.int64)
+    mass = _c2fl(c[:, 3 + idlen:])
+    names = [bytes(x).decode('ascii', errors='replace').strip()
+             for x in c[:, 3:3 + idlen]]
+    return {'algor': algor, 'nchar': _nchar.get(precision, 7),
+            'mcen': mcen, 'rcen': rcen, 'rmax': rmax,
+            'code': code, 'mass': mass, 'names': names}
+
+
+def _thin(times, teval):
+    """Replicate element6's minimum interval between outputs."""
+    keep = np.zeros(times.shape[0], dtype=bool)
+    tprevious = None
+    for i, t in enumerate(times):
+        if tprevious is None or abs(t - tprevious) >= teval:
+            keep[i] = True
+            tprevious = t
+    return keep
+
+
+def read_xv(fname, centre='central', years=True, relative=True,
+            min_interval=1.):
+    """Decode xv.out into {name: (8, steps) array}.
+
+    centre is 'central' or 'barycentric', years/relative/min_interval
+    mirror the element.in options (time in years, relative to the first
+    output, at least min_interval days between outputs).
+    """
+    if not os.path.isfile(fname):
+        print('File not found: ', fname)
+        exit()
+    with open(fname, 'rb') as f:
+        raw = f.read()
+    # pad so fixed width gathers on a short last line stay in bounds
+    buf = np.frombuffer(raw + b' ' * 128, dtype=np.uint8)
+    ends = np.flatnonzero(buf[:len(raw)] == 10)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    lengths = ends - starts
+    nlines = starts.shape[0]
+    if nlines == 0:
+        return {}
+
+    # every record starts with a form feed, then the style and the type
+    head = (buf[starts] == 12) & (lengths >= 3)
+    kind = np.where(head, buf[np.minimum(starts + 2, len(raw))], 0)
+    hidx = np.maximum.accumulate(np.where(head, np.arange(nlines), -1))
+    aidx = np.maximum.accumulate(np.where(kind == ord('a'),
+                                          np.arange(nlines), -1))
+
+    a_lines = np.flatnonzero(kind == ord('a'))
+    if a_lines.shape[0] == 0:
+        print('No parameter records found in', fname)
+        return {}
+    specials = [_special(raw, buf, starts, lengths, x) for x in a_lines]
+    if any(x['algor'] == 11 for x in specials) and centre == 'central':
+        print('Close binary coordinates are not converted, output is' +
+              ' relative to the central body')
+
+    # per 'a' record lookup tables from index number to name and mass
+    names = sorted(set(n for x in specials for n in x['names']))
+    maxcode = max(x['code'].max(initial=0) for x in specials) + 1
+    name_tab = np.full((len(specials), maxcode), -1, dtype=np.int64)
+    mass_tab = np.full((len(specials), maxcode), np.nan)
+    for i, x in enumerate(specials):
+        ok = x['code'] < maxcode
+        name_tab[i, x['code'][ok]] = [names.index(n) for n, o in
+                                      zip(x['names'], ok) if o]
+        mass_tab[i, x['code'][ok]] = x['mass'][ok]
+    a_of = np.searchsorted(a_lines, aidx)
+
+    # normal records, decode the headers in one go
+    b_lines = np.flatnonzero((kind == ord('b')) & (aidx >= 0))
+    if b_lines.shape[0] == 0:
+        return {}
+    cc = _fixed(buf, starts[b_lines] + 3, 14)
+    rtime = _c2fl(cc[:, :8])
+    nbod = (.5 + _c2re(cc[:, 8:11], 0., _maxindex)).astype(np.int64) + \
+        (.5 + _c2re(cc[:, 11:14], 0., _maxindex)).astype(np.int64)
+
+    # body lines belong to the latest 'b' header and follow it directly
+    rec = np.searchsorted(b_lines, hidx)
+    rec = np.minimum(rec, b_lines.shape[0] - 1)
+    body = (~head) & (hidx >= 0) & (b_lines[rec] == hidx)
+    body &= (np.arange(nlines) - hidx) <= nbod[rec]
+    lines = np.flatnonzero(body)
+    rec = rec[lines]
+    a = a_of[lines]
+
+    nchar = np.array([x['nchar'] for x in specials])[a]
+    rcen = np.array([x['rcen'] for x in specials])[a]
+    rmax = np.array([x['rmax'] for x in specials])[a]
+    mcen = np.array([x['mcen'] for x in specials])[a]
+    cols = np.empty((6, lines.shape[0]))
+    code = np.zeros(lines.shape[0], dtype=np.int64)
+    valid = np.zeros(lines.shape[0], dtype=bool)
+    for n in np.unique(nchar):
+        sel = np.flatnonzero(nchar == n)
+        width = 3 + 6 * n
+        sel = sel[lengths[lines[sel]] >= width]
+        c = _fixed(buf, starts[lines[sel]], width)
+        code[sel] = (.5 + _c2re(c[:, :3], 0., _maxindex)).astype(np.int64)
+        for i in range(6):
+            cols[i, sel] = _c2re(c[:, 3 + i * n:3 + (i + 1) * n], 0., 1.)
+        valid[sel] = True
+    valid &= code < maxcode
+    lines, rec, a, code = lines[valid], rec[valid], a[valid], code[valid]
+    cols, rcen, rmax, mcen = cols[:, valid], rcen[valid], rmax[valid], \
+        mcen[valid]
+
+    # scale to the ranges used by mco_x2ov then mco_ov2x
+    fr = cols[0] * np.log10(rmax / rcen)
+    theta, phi = cols[1] * PI, cols[2] * TWOPI
+    fv = cols[3]
+    vtheta, vphi = cols[4] * PI, cols[5] * TWOPI
+    mass = mass_tab[a, code]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = rcen * 10. ** fr
+        temp = np.sqrt(.5 * (1. / fv - 1.))
+        v1 = np.sqrt(2. * temp * (mcen + mass) * K2 / r)
+    xv = np.stack([r * np.sin(theta) * np.cos(phi),
+                   r * np.sin(theta) * np.sin(phi),
+                   r * np.cos(theta),
+                   v1 * np.sin(vtheta) * np.cos(vphi),
+                   v1 * np.sin(vtheta) * np.sin(vphi),
+                   v1 * np.cos(vtheta)])
+
+    if centre == 'barycentric':
+        # mco_h2b, summed per record
+        mrec = np.bincount(rec, weights=mass, minlength=b_lines.shape[0])
+        mtot = mrec + np.array([x['mcen'] for x in specials])[
+            a_of[b_lines]]
+        for i in range(6):
+            shift = -np.bincount(rec, weights=mass * xv[i],
+                                 minlength=b_lines.shape[0]) / mtot
+            xv[i] += shift[rec]
+    elif centre != 'central':
+        print('Unsupported centre:', centre)
+        exit()
+
+    keep = _thin(rtime, abs(min_interval) * .999)
+    t = rtime - rtime[0] if relative else rtime
+    if years:
+        t = t / 365.25
+    sel = keep[rec]
+    name = name_tab[a, code]
+    sel &= name >= 0
+    order = np.argsort(name[sel], kind='stable')
+    idx = np.flatnonzero(sel)[order]
+    data = np.concatenate([t[rec][np.newaxis], xv,
+                           mass[np.newaxis]])[:, idx]
+    split = np.flatnonzero(np.diff(name[idx])) + 1
+    ret = {}
+    for block in np.split(np.arange(idx.shape[0]), split):
+        if block.shape[0] == 0:
+            continue
+        ret[names[name[idx[block[0]]]]] = np.ascontiguousarray(
+            data[:, block])
+    return ret
+
+
+def _re2c(x, xmin, xmax, nchar=8):
+    """mio_re2c, only used to build test input."""
+    y = (x - xmin) / (xmax - xmin)
+    out = bytearray(b' ' * nchar)
+    if y >= 1:
+        return bytes([255] * nchar)
+    z = y
+    for j in range(nchar):
+        z = (z % 1.) * 224.
+        out[j] = int(z) + 32
+    return bytes(out)
+
+
+def _fl2c(x):
+    """mio_fl2c, only used to build test input."""
+    if x == 0:
+        y, ex = .5, 0
+    else:
+        ax = abs(x)
+        ex = int(np.log10(ax))
+        if ax >= 1:
+            ex += 1
+        y = ax * 10. ** (-ex)
+        if y == 1:
+            y *= .1
+            ex += 1
+        y = np.copysign(y, x) * .5 + .5
+    ex = min(max(ex + 112, 0), 223)
+    return _re2c(y, 0., 1.)[:7] + bytes([ex + 32])
+
+
+def test():
+    """Testing function for module."""
+    import tempfile
+    rcen, rmax, mcen, nchar = .0455, 1e8, 1., 7
+    bodies = {'WB': (1., [5., 1., 2., 0.001, .01, .002]),
+              'TESTP': (1e-20, [-3., 2., 1., -.002, .003, .0001])}
+    out = bytearray()
+    head = _fl2c(0.) + _re2c(len(bodies), 0., 11239423.99)[:3] + \
+        _re2c(0, 0., 11239423.99)[:3] + _fl2c(mcen)
+    head += b''.join(_fl2c(x) for x in (0., 0., 0., rcen, rmax))
+    out += b'\x0c6a12' + head + b'3\n'
+    for k, (name, (m, _)) in enumerate(bodies.items()):
+        out += _re2c(k + 1, 0., 11239423.99)[:3] + name.encode().ljust(8) + \
+            _fl2c(m) + _fl2c(0.) * 3 + _fl2c(1.) + b'\n'
+    for step in range(3):
+        out += b'\x0c6b' + _fl2c(365.25 * step) + \
+            _re2c(len(bodies), 0., 11239423.99)[:3] + \
+            _re2c(0, 0., 11239423.99)[:3] + b'\n'
+        for k, (name, (m, s)) in enumerate(bodies.items()):
+            x, y, z, u, v, w = s
+            r = np.sqrt(x * x + y * y + z * z)
+            v2 = u * u + v * v + w * w
+            fv = 1. / (1. + 2. * (.5 * v2 / ((mcen + m) * K2 / r)) ** 2)
+            vals = [(np.log10(r / rcen), np.log10(rmax / rcen)),
+                    (np.arccos(z / r), PI),
+                    (np.arctan2(y, x) % TWOPI, TWOPI), (fv, 1.),
+                    (np.arccos(w / np.sqrt(v2)), PI),
+                    (np.arctan2(v, u) % TWOPI, TWOPI)]
+            out += _re2c(k + 1, 0., 11239423.99)[:3] + \
+                b''.join(_re2c(a, 0., b)[:nchar] for a, b in vals) + b'\n'
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(bytes(out))
+    ret = read_xv(f.name)
+    os.remove(f.name)
+    assert sorted(ret) == ['TESTP', 'WB']
+    for name, (m, s) in bodies.items():
+        assert ret[name].shape == (8, 3)
+        assert np.allclose(ret[name][1:7, 0], s, rtol=1e-9)
+        assert np.isclose(ret[name][7, 0], m)
+    assert np.allclose(ret['WB'][0], [0., 1., 2.])
+    pass
+
+
+if __name__ == "__main__":
+    """Directly Called."""
+
+    print('Testing module')
+    test()
+    print('Test Passed')
+
+# end of code